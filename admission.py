@@ -0,0 +1,154 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+
+from manifest import STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Limits shared by every backup on this host: the scheduler daemon, the web
+# workers' job executors and the runner.py processes started by systemd timers
+MAX_ARCHIVE_JOBS = int(os.environ.get("BACKUP_MAX_ARCHIVE_JOBS", "2"))
+MAX_UPLOADS = int(os.environ.get("BACKUP_MAX_UPLOADS", "2"))
+MAX_JOBS_PER_DISK = int(os.environ.get("BACKUP_MAX_JOBS_PER_DISK", "1"))
+# Total upload bandwidth in rclone --bwlimit syntax (e.g. "40M"), empty for no limit
+UPLOAD_BWLIMIT = os.environ.get("BACKUP_UPLOAD_BWLIMIT", "")
+# Slot files the processes lock to share the limits
+ADMISSION_DIR = os.path.join(STATE_DIR, 'admission')
+# How often a queued backup looks for slots freed by another process
+ADMISSION_POLL = 1.0
+
+_SIZE_SUFFIXES = {'': 1024, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_bandwidth(value):
+    """Parse an rclone-style bandwidth ("512K", "40M", "1G") into bytes per second"""
+    if not value:
+        return None
+    value = value.strip().upper()
+    suffix = value[-1] if value[-1].isalpha() else ''
+    number = value[:-1] if suffix else value
+    if suffix not in _SIZE_SUFFIXES:
+        raise ValueError(f"Invalid bandwidth: {value}")
+    return int(float(number) * _SIZE_SUFFIXES[suffix])
+
+def device_of(path):
+    """Device id of the filesystem holding path (or its nearest existing parent)"""
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+class Admission:
+    """Resources held by one admitted piece of work"""
+
+    def __init__(self, archive, upload, devices, waited, slots=()):
+        self.archive = archive
+        self.upload = upload
+        self.devices = devices
+        self.waited = waited
+        self.slots = list(slots)  # Locked slot files, unlocked by closing them
+        self.bwlimit = None
+
+class AdmissionController:
+    """Queues backups instead of letting them compete for disks and uplink
+
+    Work is admitted only while the number of concurrent archive jobs, the
+    number of concurrent uploads and the number of jobs per disk (keyed by the
+    device of the paths read or written) are under their limits. Each
+    admitted upload is limited to a fixed 1/max_uploads share of the global
+    bandwidth budget, so the uploads never exceed it together. A share is not
+    rebalanced while its upload runs: the rclone processes cannot be retuned
+    once started (the shared rclone rcd applies the whole budget itself).
+
+    The limits hold across processes, e.g. runner.py processes started by
+    systemd timers that fire together. Each limit is a set of slot files in
+    lock_dir; admitted work holds an flock on one free file per resource,
+    which the kernel drops if the process dies. Work queued behind another
+    process looks again every ADMISSION_POLL seconds; releases within the
+    process wake it at once.
+    """
+
+    def __init__(self, max_archive_jobs=MAX_ARCHIVE_JOBS, max_uploads=MAX_UPLOADS,
+                 max_jobs_per_disk=MAX_JOBS_PER_DISK, upload_bwlimit=UPLOAD_BWLIMIT, lock_dir=ADMISSION_DIR):
+        self.max_archive_jobs = max_archive_jobs
+        self.max_uploads = max_uploads
+        self.max_jobs_per_disk = max_jobs_per_disk
+        self.upload_budget = parse_bandwidth(upload_bwlimit)
+        self.lock_dir = lock_dir
+        self._cond = threading.Condition()
+
+    def _lock_slot(self, name, limit):
+        # flock conflicts between open files, so this also counts other threads' slots
+        for index in range(limit):
+            slot = open(os.path.join(self.lock_dir, f"{name}.{index}.lock"), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        return None
+
+    def _try_acquire(self, archive, upload, devices):
+        """Lock one slot of every requested resource, or none of them"""
+        wanted = []
+        if archive:
+            wanted.append(('archive', self.max_archive_jobs))
+        if upload:
+            wanted.append(('upload', self.max_uploads))
+        wanted += [(f"disk-{device}", self.max_jobs_per_disk) for device in sorted(devices)]
+        slots = []
+        for name, limit in wanted:
+            slot = self._lock_slot(name, limit)
+            if slot is None:
+                for held in slots:
+                    held.close()
+                return None
+            slots.append(slot)
+        return slots
+
+    def acquire(self, archive=False, upload=False, paths=()):
+        """Block until the requested resources are free and return an Admission
+
+        paths are the directories the work reads from or writes to; each
+        distinct device among them counts as one I/O slot.
+        """
+        devices = {device_of(path) for path in paths}
+        started = time.monotonic()
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with self._cond:
+            while True:
+                slots = self._try_acquire(archive, upload, devices)
+                if slots is not None:
+                    break
+                self._cond.wait(ADMISSION_POLL)
+            admission = Admission(archive, upload, devices, time.monotonic() - started, slots)
+            if upload and self.upload_budget:
+                admission.bwlimit = f"{max(self.upload_budget // self.max_uploads // 1024, 1)}K"
+        if admission.waited > 1:
+            logger.info(f"Admitted after waiting {admission.waited:.1f}s for "
+                        f"{'archive ' if archive else ''}{'upload ' if upload else ''}capacity")
+        return admission
+
+    def release(self, admission):
+        with self._cond:
+            for slot in admission.slots:
+                slot.close()
+            admission.slots = []
+            self._cond.notify_all()
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def get_admission_controller():
+    """Admission controller of this process; its limits are shared with the host's other processes"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController()
+        return _controller
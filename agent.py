@@ -0,0 +1,240 @@
+"""Backup agent for one Docker host
+
+    BACKUP_AGENT_TOKEN=... python3 agent.py --server http://backup-host:5000 [--name NAME] [--concurrency N]
+
+Registers with the web application using the shared BACKUP_AGENT_TOKEN, then
+polls for the jobs of the projects pinned to it. Each job runs with the local
+backup engine, using this host's Docker socket, BACKUP_TEMP_DIR and rclone.
+Stage changes and the recorded run are reported back to the server. Claimed
+projects are mirrored into a SQLite database under BACKUP_STATE_DIR/agent, so
+incremental manifests and compression history work as they do on the server.
+Several agents can run on one machine (e.g. for testing) as long as each has
+its own BACKUP_STATE_DIR and BACKUP_TEMP_DIR.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from database import db, upgrade_schema
+from models import BackupProject, BackupRun
+from manifest import STATE_DIR
+from backup_service import BackupService
+from batch import run_batch, group_overlapping
+from agents import encode_row, decode_row, AGENT_TOKEN, AGENT_POLL_INTERVAL, AGENT_PROJECT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.environ.get("BACKUP_LOG_LEVEL", "INFO")
+
+AGENT_DIR = os.path.join(STATE_DIR, 'agent')
+# Seconds one request to the server may take
+REQUEST_TIMEOUT = 30
+# Attempts to deliver a job's result before the server is left to time it out
+RESULT_ATTEMPTS = 5
+
+class AgentClient:
+    """JSON over HTTP to the web application's agent API"""
+
+    def __init__(self, server, token=None):
+        self.server = server.rstrip('/')
+        self.token = token
+
+    def request(self, path, body, token=None):
+        request = urllib.request.Request(f"{self.server}{path}", data=json.dumps(body).encode(), method='POST',
+                                         headers={'Content-Type': 'application/json',
+                                                  'Authorization': f"Bearer {token or self.token}"})
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return json.loads(response.read())
+
+class Agent:
+    """Claims, runs and reports the backups of the projects pinned to this agent
+
+    At most concurrency jobs run at once. Jobs claimed together whose projects
+    share containers run as one batch, stopping those containers once.
+    """
+
+    def __init__(self, server, name, concurrency=1, state_dir=AGENT_DIR, poll_interval=AGENT_POLL_INTERVAL):
+        self.client = AgentClient(server)
+        self.name = name
+        self.concurrency = concurrency
+        self.state_dir = state_dir
+        self.poll_interval = poll_interval
+        os.makedirs(state_dir, exist_ok=True)
+        # NullPool: every backup thread opens its own short-lived connection
+        self.engine = create_engine(f"sqlite:///{os.path.join(state_dir, 'agent.db')}", poolclass=NullPool)
+        upgrade_schema(self.engine, db.metadata)
+        self._running = set()  # Claimed job ids not yet reported
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='agent-job')
+        self._stop = threading.Event()
+
+    def _session(self):
+        return Session(self.engine, expire_on_commit=False)
+
+    def register(self, force=False):
+        """Reuse the token saved by an earlier start, or register with the shared token"""
+        path = os.path.join(self.state_dir, 'agent.json')
+        if not force and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('server') == self.client.server and saved.get('name') == self.name:
+                self.client.token = saved['token']
+                return
+        if not AGENT_TOKEN:
+            raise RuntimeError("BACKUP_AGENT_TOKEN is needed to register with the server")
+        reply = self.client.request('/api/agents/register', {'name': self.name, 'hostname': socket.gethostname(),
+                                                             'concurrency': self.concurrency}, token=AGENT_TOKEN)
+        self.client.token = reply['token']
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'server': self.client.server, 'name': self.name, 'token': reply['token']}, f)
+        os.replace(f"{path}.tmp", path)
+        logger.info(f"Registered with {self.client.server} as agent {self.name} ({reply['agent']['id']})")
+
+    def poll(self):
+        """Send a heartbeat for running jobs and start any newly claimed ones"""
+        with self._lock:
+            running = sorted(self._running)
+        reply = self.client.request('/api/agent/claim', {'max_jobs': self.concurrency - len(running),
+                                                         'running': running})
+        jobs = {job['job_id']: job for job in reply['jobs']}
+        if jobs:
+            with self._lock:
+                self._running.update(jobs)
+            containers = {}
+            for job_id, job in jobs.items():
+                tiers = BackupProject.parse_container_tiers(job['project']['container_names'])
+                containers[job_id] = {name for tier in tiers for name in tier}
+            for group in group_overlapping(containers):
+                self._executor.submit(self._run_jobs, [jobs[job_id] for job_id in group])
+        return reply.get('poll_interval') or self.poll_interval
+
+    def _mirror(self, jobs):
+        """Copy the claimed projects into the local database; returns them by job id"""
+        with self._session() as session:
+            projects = {job['job_id']: session.merge(BackupProject(**decode_row(BackupProject, job['project'])))
+                        for job in jobs}
+            session.commit()
+        return projects
+
+    def _run_jobs(self, jobs):
+        try:
+            projects = self._mirror(jobs)
+            job_ids = {project.id: job_id for job_id, project in projects.items()}
+            if len(jobs) == 1:
+                job_id, project = next(iter(projects.items()))
+                self._execute(job_id, project.id)
+                return
+
+            def run_project(project_id, window):
+                return self._execute(job_ids[project_id], project_id, window)
+            run_batch(list(projects.values()), run_project)
+        except Exception as e:
+            logger.error(f"Error running jobs {[job['job_id'] for job in jobs]}: {e}")
+            with self._lock:
+                unreported = [job['job_id'] for job in jobs if job['job_id'] in self._running]
+            for job_id in unreported:
+                self._report(job_id, {'success': False, 'error': str(e)})
+        finally:
+            with self._lock:
+                self._running.difference_update(job['job_id'] for job in jobs)
+
+    def _execute(self, job_id, project_id, window=None):
+        """Run one project's backup and report its run to the server"""
+        def progress(stage, message=None):
+            try:
+                self.client.request(f"/api/agent/jobs/{job_id}/progress", {'stage': stage, 'message': message})
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                logger.warning(f"Could not report stage {stage} of job {job_id}: {e}")
+
+        with self._session() as session:
+            previous = session.query(func.max(BackupRun.id)).filter(BackupRun.project_id == project_id).scalar() or 0
+            success = BackupService.execute_backup_with_session(session, project_id, progress=progress, window=window)
+            run = session.query(BackupRun).filter(BackupRun.project_id == project_id, BackupRun.id > previous) \
+                .order_by(BackupRun.id.desc()).first()
+            project = session.get(BackupProject, project_id)
+            result = {
+                'success': success,
+                'error': run.error if run is not None else None,
+                'run': encode_row(run, exclude=('id', 'project_id', 'job_id')) if run is not None else None,
+                'project': {key: value for key, value in encode_row(project).items() if key in AGENT_PROJECT_FIELDS},
+            }
+        self._report(job_id, result)
+        return success
+
+    def _report(self, job_id, result):
+        for attempt in range(1, RESULT_ATTEMPTS + 1):
+            try:
+                self.client.request(f"/api/agent/jobs/{job_id}/result", result)
+                with self._lock:
+                    self._running.discard(job_id)
+                return
+            except urllib.error.HTTPError as e:
+                # Refused (e.g. the job already timed out): retrying will not help
+                if e.code < 500:
+                    logger.error(f"Server refused the result of job {job_id}: {e.read().decode(errors='replace')}")
+                    return
+                logger.warning(f"Reporting job {job_id} failed (attempt {attempt}): {e}")
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                logger.warning(f"Reporting job {job_id} failed (attempt {attempt}): {e}")
+            time.sleep(min(2 ** attempt, 60))
+        logger.error(f"Gave up reporting job {job_id}; the server will time it out")
+
+    def run_forever(self):
+        self.register()
+        logger.info(f"Agent {self.name} polling {self.client.server} "
+                    f"(concurrency {self.concurrency}, state in {self.state_dir})")
+        while not self._stop.is_set():
+            interval = self.poll_interval
+            try:
+                interval = self.poll()
+            except urllib.error.HTTPError as e:
+                if e.code == 401 and AGENT_TOKEN:
+                    # The token was replaced, e.g. by a re-registration under this name
+                    logger.warning("Agent token rejected, registering again")
+                    self.register(force=True)
+                else:
+                    logger.error(f"Polling {self.client.server} failed: {e}")
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                logger.error(f"Polling {self.client.server} failed: {e}")
+            self._stop.wait(interval)
+        # Let running backups finish and report; nothing new is claimed
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        self._stop.set()
+
+def main(argv):
+    logging.basicConfig(level=LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(prog="agent.py", description="Run the backups pinned to this Docker host")
+    parser.add_argument('--server', required=True, help="URL of the web application")
+    parser.add_argument('--name', default=socket.gethostname(), help="agent name (default: hostname)")
+    parser.add_argument('--concurrency', type=int, default=1, help="backups run at the same time")
+    parser.add_argument('--state-dir', default=AGENT_DIR, help="token and local database")
+    parser.add_argument('--poll-interval', type=float, default=AGENT_POLL_INTERVAL, help="seconds between polls")
+    args = parser.parse_args(argv)
+
+    agent = Agent(args.server, args.name, max(args.concurrency, 1), args.state_dir, args.poll_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+    try:
+        agent.run_forever()
+    except KeyboardInterrupt:
+        agent.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,230 @@
+import os
+import base64
+import hashlib
+import logging
+import secrets
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, or_, LargeBinary, DateTime
+
+from models import BackupProject, BackupJob, BackupRun, BackupAgent
+
+logger = logging.getLogger(__name__)
+
+# Shared secret agents present to register; registration is off without it
+AGENT_TOKEN = os.environ.get("BACKUP_AGENT_TOKEN", "")
+# Seconds between an agent's polls; it counts as offline after three missed polls
+AGENT_POLL_INTERVAL = float(os.environ.get("BACKUP_AGENT_POLL_INTERVAL", "5"))
+# Seconds without a heartbeat after which a claimed job is failed, and without
+# a poll after which an agent's queued jobs are
+AGENT_JOB_TIMEOUT = int(os.environ.get("BACKUP_AGENT_JOB_TIMEOUT", "300"))
+# Seconds a job may wait for its agent to claim it, even if the agent is polling
+AGENT_QUEUE_TIMEOUT = int(os.environ.get("BACKUP_AGENT_QUEUE_TIMEOUT", "3600"))
+
+# Project columns an agent's run changes and reports back
+AGENT_PROJECT_FIELDS = ('last_backup', 'last_duration_seconds', 'last_downtime_seconds', 'last_stage_timings',
+                        'runs_since_full')
+
+class AgentError(Exception):
+    """An agent request was refused"""
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def encode_row(row, exclude=()):
+    """JSON-safe dict of a model instance's columns"""
+    data = {}
+    for column in row.__table__.columns:
+        if column.key in exclude:
+            continue
+        value = getattr(row, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, bytes):
+            value = base64.b64encode(value).decode()
+        data[column.key] = value
+    return data
+
+def decode_row(model, data, exclude=()):
+    """Column values for model from a dict made by encode_row; unknown keys are dropped"""
+    values = {}
+    for column in model.__table__.columns:
+        if column.key in exclude or column.key not in data:
+            continue
+        value = data[column.key]
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and isinstance(column.type, LargeBinary):
+            value = base64.b64decode(value)
+        values[column.key] = value
+    return values
+
+def is_online(agent, now=None):
+    now = now or datetime.utcnow()
+    return agent.last_seen is not None and now - agent.last_seen < timedelta(seconds=3 * AGENT_POLL_INTERVAL)
+
+def register_agent(session, name, hostname=None, concurrency=1):
+    """Create an agent, or issue a new token to an existing one of the same name
+
+    Returns (agent, token); only the token's hash is stored.
+    """
+    token = secrets.token_urlsafe(32)
+    agent = session.query(BackupAgent).filter_by(name=name).first()
+    if agent is None:
+        agent = BackupAgent(name=name)
+        session.add(agent)
+    agent.token_hash = hash_token(token)
+    agent.hostname = hostname
+    agent.concurrency = max(int(concurrency or 1), 1)
+    agent.last_seen = datetime.utcnow()
+    session.commit()
+    logger.info(f"Registered agent {name} ({hostname}) as {agent.id}")
+    return agent, token
+
+def authenticate(session, token):
+    """The agent a bearer token belongs to; raises AgentError for unknown tokens"""
+    agent = session.query(BackupAgent).filter_by(token_hash=hash_token(token)).first() if token else None
+    if agent is None:
+        raise AgentError("Unknown agent token")
+    return agent
+
+def queue_agent_jobs(session, project_ids):
+    """Queue jobs for the projects among project_ids that are pinned to an agent
+
+    Projects with an active job keep it. Returns {project_id: job} for the
+    pinned projects; the rest are left to the caller to run locally. Stale
+    agent jobs are reaped first, so a job no agent will ever claim does not
+    stand in for a new one.
+    """
+    reap_stale_jobs(session)
+    pinned = dict(session.query(BackupProject.id, BackupProject.agent_id)
+                  .filter(BackupProject.id.in_(project_ids), BackupProject.agent_id.isnot(None)).all())
+    jobs = {}
+    for project_id, agent_id in pinned.items():
+        job = session.query(BackupJob).filter(BackupJob.project_id == project_id,
+                                              BackupJob.status.in_(BackupJob.ACTIVE_STATUSES)).first()
+        if not job:
+            job = BackupJob(project_id=project_id, status=BackupJob.QUEUED, agent_id=agent_id)
+            session.add(job)
+        jobs[project_id] = job
+    session.commit()
+    for project_id, job in jobs.items():
+        logger.info(f"Queued backup job {job.id} for project {project_id} on agent {pinned[project_id]}")
+    return jobs
+
+def _fail_jobs(jobs, message, now):
+    for job in jobs:
+        job.status = BackupJob.FAILED
+        job.stage = None
+        job.message = message
+        job.finished_at = now
+        logger.error(f"Backup job {job.id}: {message}")
+
+def reap_stale_jobs(session, now=None):
+    """Fail agent jobs that their agent will not run or finish
+
+    Running jobs expire after AGENT_JOB_TIMEOUT seconds without a heartbeat.
+    Queued jobs expire once their agent has not polled for AGENT_JOB_TIMEOUT
+    seconds, or after waiting AGENT_QUEUE_TIMEOUT seconds in any case.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=AGENT_JOB_TIMEOUT)
+    stale = session.query(BackupJob).filter(BackupJob.status == BackupJob.RUNNING, BackupJob.agent_id.isnot(None),
+                                            BackupJob.heartbeat_at < cutoff).all()
+    _fail_jobs(stale, f"Agent stopped reporting (no heartbeat for {AGENT_JOB_TIMEOUT}s)", now)
+
+    offline = session.query(BackupAgent.id).filter(or_(BackupAgent.last_seen.is_(None),
+                                                       BackupAgent.last_seen < cutoff))
+    unclaimed = session.query(BackupJob).filter(BackupJob.status == BackupJob.QUEUED, BackupJob.agent_id.isnot(None),
+                                                BackupJob.agent_id.in_(offline)).all()
+    _fail_jobs(unclaimed, f"Agent is offline (no poll for {AGENT_JOB_TIMEOUT}s)", now)
+    expired = session.query(BackupJob).filter(
+        BackupJob.status == BackupJob.QUEUED, BackupJob.agent_id.isnot(None),
+        BackupJob.created_at < now - timedelta(seconds=AGENT_QUEUE_TIMEOUT)).all()
+    _fail_jobs(expired, f"Not claimed by its agent within {AGENT_QUEUE_TIMEOUT}s", now)
+
+    stale += unclaimed + expired
+    if stale:
+        session.commit()
+    return stale
+
+def cancel_queued_jobs(session, project_id, message):
+    """Fail a project's unclaimed agent jobs, e.g. because it was pinned elsewhere"""
+    jobs = session.query(BackupJob).filter(BackupJob.project_id == project_id, BackupJob.status == BackupJob.QUEUED,
+                                           BackupJob.agent_id.isnot(None)).all()
+    _fail_jobs(jobs, message, datetime.utcnow())
+    return jobs
+
+def claim_jobs(session, agent, max_jobs, running=()):
+    """Hand queued jobs of an agent's projects to it
+
+    running are the ids of jobs the agent is still working on; their
+    heartbeat is refreshed. Each job is claimed with a conditional update,
+    so two polls never receive the same job. Returns [(job, project)].
+    """
+    now = datetime.utcnow()
+    agent.last_seen = now
+    if running:
+        session.execute(update(BackupJob).where(BackupJob.id.in_(running), BackupJob.agent_id == agent.id,
+                                                BackupJob.status == BackupJob.RUNNING).values(heartbeat_at=now))
+    session.commit()
+    reap_stale_jobs(session, now)
+
+    claimed = []
+    if max_jobs <= 0:
+        return claimed
+    candidates = session.query(BackupJob).filter(BackupJob.agent_id == agent.id,
+                                                 BackupJob.status == BackupJob.QUEUED) \
+        .order_by(BackupJob.id).limit(max_jobs).all()
+    for job in candidates:
+        result = session.execute(update(BackupJob).where(BackupJob.id == job.id, BackupJob.status == BackupJob.QUEUED)
+                                 .values(status=BackupJob.RUNNING, started_at=now, heartbeat_at=now))
+        if result.rowcount == 1:
+            claimed.append(job.id)
+    session.commit()
+    jobs = session.query(BackupJob).filter(BackupJob.id.in_(claimed)).all() if claimed else []
+    return [(job, job.project) for job in jobs]
+
+def _agent_job(session, agent, job_id):
+    job = session.get(BackupJob, job_id)
+    if job is None or job.agent_id != agent.id:
+        raise AgentError(f"Job {job_id} is not assigned to agent {agent.name}")
+    return job
+
+def record_progress(session, agent, job_id, stage, message=None):
+    """Store the stage an agent reports for a running job"""
+    job = _agent_job(session, agent, job_id)
+    now = datetime.utcnow()
+    agent.last_seen = now
+    job.heartbeat_at = now
+    if stage != 'failed':
+        job.stage = stage
+    session.commit()
+    return job
+
+def record_result(session, agent, job_id, success, error=None, run=None, project=None):
+    """Store the outcome of a job an agent ran
+
+    run holds the encoded BackupRun the agent recorded locally and becomes a
+    BackupRun of the project here; project holds the AGENT_PROJECT_FIELDS the
+    run updated.
+    """
+    job = _agent_job(session, agent, job_id)
+    if job.status != BackupJob.RUNNING:
+        raise AgentError(f"Job {job_id} is {job.status}, not running")
+    now = datetime.utcnow()
+    agent.last_seen = now
+    if run:
+        session.add(BackupRun(project_id=job.project_id, job_id=job.id,
+                              **decode_row(BackupRun, run, exclude=('id', 'project_id', 'job_id'))))
+    if project and success:
+        for key, value in decode_row(BackupProject, project).items():
+            if key in AGENT_PROJECT_FIELDS:
+                setattr(job.project, key, value)
+    job.status = BackupJob.SUCCEEDED if success else BackupJob.FAILED
+    job.stage = None
+    job.message = None if success else (error or "Backup failed on the agent. Check its logs for details.")
+    job.finished_at = now
+    session.commit()
+    logger.info(f"Agent {agent.name} finished job {job.id}: {job.status}")
+    return job
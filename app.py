@@ -2,29 +2,30 @@ import os
 import logging
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from database import db, DATABASE_URL, upgrade_schema
+from utils import TTLCache
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Set up SQLAlchemy base class
-class Base(DeclarativeBase):
-    pass
-
 # Initialize extensions
-db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
+# Seconds logged-in users and the user count are served from memory
+# instead of being queried on every request
+USER_CACHE_TTL = int(os.environ.get("BACKUP_USER_CACHE_TTL", "30"))
+user_cache = TTLCache(USER_CACHE_TTL)
+
 # Create app
 app = Flask(__name__)
 
 # Configure app
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
@@ -41,12 +42,20 @@ login_manager.login_view = 'login'
 # Import models here to avoid circular imports
 with app.app_context():
     from models import User, BackupProject
-    db.create_all()
+    # Also adds columns and indexes declared after a deployment's tables were created
+    upgrade_schema(db.engine, db.metadata)
 
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    return User.query.get(int(user_id))
+    
+    def load():
+        user = db.session.get(User, int(user_id))
+        if user is not None:
+            # Detached, so the cached copy outlives this request's session
+            db.session.expunge(user)
+        return user
+    return user_cache.get_or_set(('user', int(user_id)), load)
 
 logger.info("Application initialized")
@@ -0,0 +1,126 @@
+import os
+import logging
+import time
+
+from compression import ParallelZipWriter, DEFAULT_LEVEL
+from integrity import HashingWriter
+from encryption import EncryptingWriter
+from restore import build_index
+
+logger = logging.getLogger(__name__)
+
+# Size of the buffer placed in front of the upload pipe. Together with the
+# blocks in flight in the compression engine this bounds the memory used by a
+# streaming backup, regardless of the size of the source tree.
+BUFFER_SIZE = 1024 * 1024
+
+def _arcname(path, source_path, read_root):
+    # Files read from a snapshot copy keep the names of the original source
+    if read_root:
+        path = os.path.normpath(os.path.join(source_path, os.path.relpath(path, read_root)))
+    return path.lstrip('/')
+
+def iter_source_tree(source_path, read_root=None):
+    """Yield (path, arcname, is_dir) for every directory and file under source_path
+
+    Archive names mirror what `zip -r <source_path>` produces: the full path with
+    the leading slash removed. When read_root is given the tree is read from
+    there (a point-in-time copy of source_path) but named after source_path.
+    """
+    for root, dirs, files in os.walk(read_root or source_path):
+        dirs.sort()
+        yield root, _arcname(root, source_path, read_root), True
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                logger.warning(f"Skipping non-regular file: {path}")
+                continue
+            yield path, _arcname(path, source_path, read_root), False
+
+def iter_file_list(paths, source_path=None, read_root=None):
+    """Yield (path, arcname, is_dir) for an explicit list of files under source_path"""
+    for path in paths:
+        arcname = path.lstrip('/')
+        if read_root:
+            path = os.path.join(read_root, os.path.relpath(path, source_path))
+        if not os.path.isfile(path):
+            logger.warning(f"Skipping missing file: {path}")
+            continue
+        yield path, arcname, False
+
+def write_archive(source_path, fileobj, level=None, workers=None, files=None, extra_entries=None,
+                  read_root=None, streams=None, hash_types=('sha256',), on_progress=None,
+                  encryption_key=None):
+    """Write a zip archive of source_path to a (possibly unseekable) file object
+
+    If files is given only those paths are archived instead of the whole tree.
+    extra_entries maps archive names to in-memory content added at the end.
+    read_root points at a snapshot copy of source_path to read from instead.
+    streams maps archive names to iterables of byte chunks (e.g. a database
+    dump) that are compressed into the archive as they are produced.
+    The output is hashed with hash_types as it is written, and the returned
+    statistics include the digests, a [arcname, size, crc32] manifest of
+    the archived files and a seekable index of every entry (see restore.py).
+    on_progress(files, bytes_read, bytes_written) is called after every
+    block written, so it must return quickly.
+    With an encryption_key the archive is encrypted in chunks on its way out
+    (see encryption.py): hashes and bytes_written are then those of the
+    encrypted file, while offsets in the index stay plaintext offsets.
+    Compression runs on the parallel engine in compression.py. Returns a dict
+    of statistics for the run, which is also logged with the achieved MB/s.
+    """
+    if level is None:
+        level = DEFAULT_LEVEL
+    started = time.monotonic()
+    output = HashingWriter(fileobj, hash_types)
+    encrypter = EncryptingWriter(output, encryption_key) if encryption_key else None
+    try:
+        with ParallelZipWriter(encrypter or output, level=level, workers=workers,
+                               on_progress=on_progress) as writer:
+            if files is None:
+                entries = iter_source_tree(source_path, read_root)
+            else:
+                entries = iter_file_list(files, source_path, read_root)
+            for path, arcname, is_dir in entries:
+                if is_dir:
+                    writer.add_directory(path, arcname)
+                else:
+                    writer.add_file(path, arcname)
+            stream_sizes = {}
+            for arcname, chunks in (streams or {}).items():
+                stream_sizes[arcname] = writer.add_stream(arcname, chunks).file_size
+            for arcname, data in (extra_entries or {}).items():
+                writer.writestr(arcname, data)
+        if encrypter is not None:
+            encrypter.close()
+    except BaseException:
+        if encrypter is not None:
+            encrypter.abort()
+        raise
+    seconds = max(time.monotonic() - started, 1e-6)
+
+    stats = {
+        'files': len(writer.entries),
+        'stored_files': writer.stored_files,
+        'bytes_read': writer.bytes_read,
+        'bytes_written': encrypter.bytes_written if encrypter else writer.bytes_written,
+        'seconds': seconds,
+        'workers': writer.workers,
+        'streams': stream_sizes,
+        'hashes': output.hexdigests(),
+        'manifest': [[entry.arcname, entry.file_size, entry.crc] for entry in writer.entries if not entry.is_dir],
+        'index': build_index(writer.entries, writer.bytes_written),
+    }
+    mb_read = writer.bytes_read / (1024 * 1024)
+    logger.info(f"Archived {stats['files']} entries, {mb_read:.1f} MB in {seconds:.1f}s "
+                f"({mb_read / seconds:.1f} MB/s, {writer.workers} workers, level {level}, "
+                f"{writer.stored_files} stored without recompression) -> "
+                f"{writer.bytes_written / (1024 * 1024):.1f} MB")
+    if encrypter is not None:
+        stats['encryption'] = encrypter.stats()
+        # Worker time spent sealing, as a share of the archive stage
+        stats['encryption']['overhead'] = round(encrypter.seconds / encrypter.workers / seconds, 4)
+        logger.info(f"Encrypted {encrypter.chunks} chunks of {encrypter.chunk_size // 1024} KB in "
+                    f"{encrypter.seconds:.2f}s of worker time ({encrypter.workers} workers, "
+                    f"{stats['encryption']['overhead']:.1%} of the archive stage)")
+    return stats
@@ -1,20 +1,54 @@
 import os
+import json
 import subprocess
 import logging
 import time
+from contextlib import nullcontext
 from datetime import datetime
 import shutil
-from models import BackupProject
-from app import db
+from sqlalchemy.orm import object_session
+from models import BackupProject, BackupRun
+from archiver import write_archive, BUFFER_SIZE
+from snapshot import create_snapshot, remove_snapshot
+from utils import StageTimer
+from rclone_rc import get_rclone, log_progress
+from admission import get_admission_controller
+from docker_client import get_docker_client, DEFAULT_STOP_TIMEOUT
+from dedup import DedupStore, format_dedup_stats
+from manifest import scan_tree, diff_manifests, load_manifest, save_manifest
+from validation import preflight_check
+from integrity import remote_hash_type, encode_file_manifest
+from restore import upload_index
+from fanout import FanoutWriter, upload_to_all, repair_from, split_bwlimit
+from events import ProgressReporter
+from capacity import plan_capacity, STREAMING, RATIO_HISTORY
+from encryption import load_key
 
 logger = logging.getLogger(__name__)
 
+# 'systemd' writes a service/timer pair per project; 'builtin' leaves
+# scheduling to the long-running scheduler daemon (python3 scheduler.py)
+SCHEDULER = os.environ.get("BACKUP_SCHEDULER", "systemd")
+
+# Staging area for zips, snapshots and dedup chunks
+TEMP_DIR = os.environ.get("BACKUP_TEMP_DIR", "/BkUp")
+
+# Archive directory holding the output of hot-backup hooks
+HOT_BACKUP_DIR = '.bkup/hot'
+
+# rclone remote for destination paths that do not name one
+DEFAULT_REMOTE = os.environ.get("BACKUP_DEFAULT_REMOTE", "gdrive:")
+
 class BackupService:
     """Service to manage the backup process for projects"""
     
     @staticmethod
     def create_service_file(project):
         """Create a systemd service file for the backup project"""
+        if SCHEDULER == 'builtin':
+            # The scheduler daemon picks up the project from the database
+            return True
+        
         service_name = f"{project.project_name}_Backup"
         service_content = f"""[Unit]
 Description=Backup Service for {project.project_name}
@@ -23,7 +57,7 @@ After=network.target
 [Service]
 Type=oneshot
 User=root
-ExecStart=/usr/bin/python3 /app/backup_service.py execute {project.id}
+ExecStart=/usr/bin/python3 /app/runner.py execute {project.id}
 
 [Install]
 WantedBy=multi-user.target
@@ -73,6 +107,9 @@ WantedBy=timers.target
     @staticmethod
     def update_service(project):
         """Update an existing service file"""
+        if SCHEDULER == 'builtin':
+            return True
+        
         # First delete the old service
         BackupService.delete_service(project)
         
@@ -82,6 +119,9 @@ WantedBy=timers.target
     @staticmethod
     def delete_service(project):
         """Delete a service file for a backup project"""
+        if SCHEDULER == 'builtin':
+            return True
+        
         service_name = f"{project.project_name}_Backup"
         
         try:
@@ -109,83 +149,568 @@ WantedBy=timers.target
             return False
     
     @staticmethod
-    def execute_backup(project_id):
-        """Execute the backup process for a specific project"""
-        from app import app
+    def _stop_containers(project, timer=None, window=None):
+        """Stop a project's containers concurrently, dependents first
         
-        with app.app_context():
+        Containers with a hot-backup hook keep running. In a batch, the shared window stops the containers of every project
+        in it once.
+        """
+        if window is not None:
+            window.stop(project.id, timer)
+            return
+        if timer is not None:
+            timer.containers_down()
+        stage = timer.stage('stop_containers') if timer is not None else nullcontext()
+        with stage:
+            get_docker_client().stop_containers(project.stop_tiers,
+                                                timeout=project.stop_timeout or DEFAULT_STOP_TIMEOUT)
+    
+    @staticmethod
+    def _start_containers(project, timer=None, window=None):
+        """Start a project's containers tier by tier, unless this run already did
+        
+        Returns once every container is running and passes its health check.
+        In a batch, this only leaves the shared window; the last project to
+        leave it starts the containers.
+        """
+        if timer is not None and timer.containers_restarted:
+            return
+        if window is not None:
+            window.release(project.id, timer)
+            return
+        stage = timer.stage('start_containers') if timer is not None else nullcontext()
+        with stage:
+            get_docker_client().start_containers(project.stop_tiers,
+                                                 health_timeout=project.health_timeout)
+        if timer is not None:
+            timer.containers_up()
+    
+    @staticmethod
+    def destination_dirs(project):
+        """rclone directories a project's archives go to, the primary destination first"""
+        dirs = []
+        for path in [project.destination_path] + project.extra_destination_list:
+            path = path.rstrip('/')
+            # "remote:path" names its remote, a bare path uses the default one
+            if ':' not in path.split('/', 1)[0]:
+                path = f"{DEFAULT_REMOTE}{path}"
+            dirs.append(path)
+        return dirs
+    
+    @staticmethod
+    def stream_archive(source_path, remote_paths, bwlimit=None, buffer_size=BUFFER_SIZE, **archive_args):
+        """Archive source_path directly into `rclone rcat`, once per destination
+        
+        One read of the source feeds every destination: each has its own
+        rclone process behind a bounded buffer that spills to disk, so a slow
+        destination does not hold up the others and nothing else is staged on
+        local disk. Returns the archive statistics with the per-destination
+        results under 'destinations'.
+        """
+        if isinstance(remote_paths, str):
+            remote_paths = [remote_paths]
+        fanout = FanoutWriter(remote_paths, bwlimit=split_bwlimit(bwlimit, len(remote_paths)),
+                              spill_dir=TEMP_DIR)
+        try:
+            stats = write_archive(source_path, fanout, **archive_args)
+        except BaseException:
+            fanout.abort()
+            raise
+        
+        stats['destinations'] = fanout.close()
+        for destination in stats['destinations']:
+            if destination.ok:
+                logger.info(f"Streamed {destination.bytes} bytes from {source_path} to {destination.remote_path}")
+        return stats
+    
+    @staticmethod
+    def upload_file(local_path, remote_dir, bwlimit=None, on_progress=None):
+        """Upload one file, through the shared rclone rcd when it is enabled
+        
+        The daemon applies the global bandwidth budget itself, so bwlimit is
+        only used for standalone rclone processes. on_progress receives the
+        daemon's transfer statistics; standalone uploads report none.
+        """
+        rclone = get_rclone()
+        if rclone is not None:
+            log = log_progress(f"Upload of {local_path}")
+            
+            def on_stats(stats):
+                log(stats)
+                if on_progress is not None:
+                    on_progress(stats)
+            rclone.copy_file(local_path, remote_dir, on_progress=on_stats)
+            return
+        command = ["rclone", "copy", local_path, remote_dir]
+        if bwlimit:
+            command += ["--bwlimit", bwlimit]
+        subprocess.run(command, check=True)
+    
+    @staticmethod
+    def _plan_incremental(project):
+        """Scan the source tree and decide between a full and an incremental archive
+        
+        Returns (archive_args, is_full, records). archive_args restricts the
+        archive to new or changed files plus a tombstone list of deleted paths
+        for incremental runs; records is the manifest to save once the backup
+        has been uploaded.
+        """
+        previous = load_manifest(project.id, project.source_path)
+        interval = max(project.full_backup_interval or 1, 1)
+        is_full = previous is None or (project.runs_since_full or 0) + 1 >= interval
+        records = scan_tree(project.source_path, previous)
+        if is_full:
+            return {}, True, records
+        
+        changed, deleted = diff_manifests(previous, records)
+        logger.info(f"Incremental backup: {len(changed)} changed, {len(deleted)} deleted files")
+        info = {
+            'changed': len(changed),
+            'deleted': len(deleted),
+            'runs_since_full': (project.runs_since_full or 0) + 1,
+        }
+        extra_entries = {
+            '.bkup/deleted.txt': ''.join(f"{path}\n" for path in deleted),
+            '.bkup/incremental.json': json.dumps(info),
+        }
+        return {'files': changed, 'extra_entries': extra_entries}, False, records
+    
+    @staticmethod
+    def _hot_backup_streams(hooks):
+        """Archive name -> lazily started stdout stream for each hot-backup hook"""
+        client = get_docker_client()
+        return {f"{HOT_BACKUP_DIR}/{container}.dump": client.exec_stream(container, command)
+                for container, command in hooks.items()}
+    
+    @staticmethod
+    def _run_backup(project, timer, result, window=None, reporter=None, on_archive_name=None):
+        """Run the stages of a backup for a loaded project
+        
+        Validates the project, checks that the archive fits on the staging
+        volume (switching to streaming if it does not) and waits for admission
+        before any container is stopped, so broken, oversized or queued runs
+        never add downtime. Returns once the
+        backup is uploaded; archive name and byte counts are filled into result
+        as they become known so the caller can record them even for failed
+        runs. With a ContainerWindow, admission and container stops and
+        starts are shared with the other projects of a batch. A
+        ProgressReporter, if given, receives archive and upload progress.
+        on_archive_name, if given, is called with the archive name as soon as
+        it is chosen, before anything is written.
+        """
+        admission = get_admission_controller()
+        held = []
+        
+        def release_slot(slot):
+            if window is not None and slot is archive_slot:
+                # A batch shares one archive admission between its projects
+                window.leave_admission(project.id)
+            else:
+                admission.release(slot)
+        
+        with timer.stage('preflight'):
+            preflight_check(project)
+        with timer.stage('capacity'):
+            plan = plan_capacity(project, BackupService._compression_history(project), TEMP_DIR)
+        result['capacity'] = plan.to_dict()
+        streaming = plan.mode == STREAMING
+        
+        try:
+            # 0. Wait for archive capacity (and upload capacity when streaming)
+            archive_paths = [project.source_path]
+            if not streaming or project.snapshot_method:
+                archive_paths.append(TEMP_DIR)
+            with timer.stage('wait_archive'):
+                if window is not None:
+                    archive_slot = window.admit(project.id, admission, archive_paths, upload=streaming)
+                else:
+                    archive_slot = admission.acquire(archive=True, upload=streaming, paths=archive_paths)
+            held.append(archive_slot)
+            
+            # Look up which hashes the remotes report before anything is stopped
+            dest_dirs = BackupService.destination_dirs(project)
+            hash_types = {}
+            if project.backup_backend != 'dedup':
+                hash_types = {dest_dir: remote_hash_type(dest_dir) for dest_dir in dest_dirs}
+            encryption_key = None
+            if project.encryption_key_ref and project.backup_backend != 'dedup':
+                encryption_key = load_key(project.encryption_key_ref)
+            
+            # 1. Stop containers
+            BackupService._stop_containers(project, timer, window)
+            
+            # 2. Generate backup file name with timestamp
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            backup_filename = f"{project.project_name}_Backup_{timestamp}"
+            dest_path = project.destination_path.rstrip('/')
+            archive_args = {
+                'level': project.compression_level,
+                'workers': project.compression_workers,
+                'hash_types': ['sha256'] + [name for name in hash_types.values() if name],
+                'encryption_key': encryption_key,
+            }
+            if encryption_key is not None:
+                result['encryption_key_ref'] = project.encryption_key_ref
+            
+            # For incremental projects, work out what changed since the last run
+            records = None
+            if project.incremental_enabled and project.backup_backend != 'dedup':
+                with timer.stage('scan'):
+                    incremental_args, is_full, records = BackupService._plan_incremental(project)
+                archive_args.update(incremental_args)
+                if not is_full:
+                    backup_filename = f"{backup_filename}_incremental"
+            result['archive_name'] = backup_filename
+            if on_archive_name is not None:
+                on_archive_name(backup_filename)
+            if reporter is not None:
+                archive_args['on_progress'] = reporter.archive
+            
+            # Containers with a hot-backup hook keep running; the output of
+            # their dump command is streamed into the archive
+            hooks = project.hot_backup_commands
+            if hooks:
+                archive_args['streams'] = BackupService._hot_backup_streams(hooks)
+            
+            # In low-downtime mode, take a point-in-time copy and bring the
+            # containers back up before archiving
+            snapshot_path = None
+            if project.snapshot_method:
+                with timer.stage('snapshot'):
+                    snapshot_path = create_snapshot(project.source_path, backup_filename,
+                                                    project.snapshot_method)
+                archive_args['read_root'] = snapshot_path
+                BackupService._start_containers(project, timer, window)
+            
+            def wait_for_upload():
+                # Hand the archive slot back before queueing for the uplink
+                release_slot(archive_slot)
+                held.remove(archive_slot)
+                with timer.stage('wait_upload'):
+                    upload_slot = admission.acquire(upload=True, paths=[TEMP_DIR])
+                held.append(upload_slot)
+                return upload_slot
+            
             try:
-                project = BackupProject.query.get(project_id)
-                if not project:
-                    logger.error(f"Project with ID {project_id} not found")
-                    return False
-                
-                logger.info(f"Starting backup process for project: {project.project_name}")
-                
-                # 1. Stop containers
-                container_list = project.containers_list
-                for container in container_list:
-                    logger.info(f"Stopping container: {container}")
-                    subprocess.run(["docker", "stop", container], check=True)
-                
-                # 2. Create temporary backup directory if it doesn't exist
-                temp_dir = "/BkUp"
-                os.makedirs(temp_dir, exist_ok=True)
-                
-                # 3. Generate backup file name with timestamp
-                timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                backup_filename = f"{project.project_name}_Backup_{timestamp}"
-                zip_path = f"{temp_dir}/{backup_filename}.zip"
-                
-                # 4. Create zip backup
-                logger.info(f"Creating zip backup at: {zip_path}")
-                subprocess.run(["zip", "-r", zip_path, project.source_path], check=True)
-                
-                # 5. Start containers
-                for container in container_list:
-                    logger.info(f"Starting container: {container}")
-                    subprocess.run(["docker", "start", container], check=True)
-                
-                # 6. Upload to Google Drive using rclone
-                logger.info(f"Uploading backup to Google Drive: {project.destination_path}")
-                dest_path = project.destination_path.rstrip('/')
-                subprocess.run(["rclone", "copy", zip_path, f"gdrive:{dest_path}/"], check=True)
-                
-                # 7. Update the last backup time
-                project.last_backup = datetime.utcnow()
-                db.session.commit()
-                
-                # 8. Cleanup temporary zip file
-                os.remove(zip_path)
-                
-                logger.info(f"Backup completed successfully for project: {project.project_name}")
-                return True
-                
+                if project.backup_backend == 'dedup':
+                    # 3. Chunk the source and stage chunks that are not stored yet
+                    store = DedupStore(workers=project.compression_workers, staging_root=TEMP_DIR)
+                    with timer.stage('archive'):
+                        staging_dir, dedup_stats, new_chunks = store.prepare(
+                            project.source_path, backup_filename, dest_path, read_root=snapshot_path)
+                    
+                    # 4. Start containers
+                    BackupService._start_containers(project, timer, window)
+                    
+                    # 5. Upload new chunks and the snapshot manifest in one batch
+                    wait_for_upload()
+                    logger.info(f"Uploading deduplicated backup to {store.repository}")
+                    with timer.stage('upload'):
+                        store.commit(staging_dir, new_chunks)
+                    logger.info(f"Deduplicated backup: {format_dedup_stats(dedup_stats)}")
+                    result['bytes_read'] = dedup_stats['bytes_read']
+                    result['archive_size'] = dedup_stats['stored_bytes']
+                    result['details'] = {'dedup': dedup_stats}
+                elif streaming:
+                    # 3. Archive straight into the upload, no staging file.
+                    # Without a snapshot, containers stay stopped until the upload has finished.
+                    remote_paths = [f"{dest_dir}/{backup_filename}.zip" for dest_dir in dest_dirs]
+                    logger.info(f"Streaming backup to {', '.join(remote_paths)}")
+                    with timer.stage('archive_upload'):
+                        stats = BackupService.stream_archive(project.source_path, remote_paths,
+                                                             bwlimit=archive_slot.bwlimit, **archive_args)
+                    destinations = stats['destinations']
+                    BackupService._record_archive(result, stats, destinations, hash_types)
+                    
+                    # Destinations whose stream broke get a remote-to-remote copy
+                    source = next((d for d in destinations if d.ok), None)
+                    if source is not None and not all(d.ok for d in destinations):
+                        with timer.stage('upload'):
+                            repair_from(source, destinations, stats['bytes_written'])
+                        BackupService._record_archive(result, stats, destinations, hash_types)
+                    BackupService._check_destinations(destinations)
+                    BackupService._upload_index(result, stats, destinations, encryption_key)
+                    
+                    # 4. Start containers
+                    BackupService._start_containers(project, timer, window)
+                else:
+                    # 3. Create temporary backup directory if it doesn't exist
+                    os.makedirs(TEMP_DIR, exist_ok=True)
+                    zip_path = f"{TEMP_DIR}/{backup_filename}.zip"
+                    
+                    # 4. Create zip backup
+                    logger.info(f"Creating zip backup at: {zip_path}")
+                    try:
+                        with timer.stage('archive'), open(zip_path, 'wb') as zip_file:
+                            stats = write_archive(project.source_path, zip_file, **archive_args)
+                        result['bytes_read'] = stats['bytes_read']
+                        result['archive_size'] = stats['bytes_written']
+                        
+                        # 5. Start containers
+                        BackupService._start_containers(project, timer, window)
+                        
+                        # 6. Upload to every destination using rclone
+                        upload_slot = wait_for_upload()
+                        logger.info(f"Uploading backup to {', '.join(dest_dirs)}")
+                        with timer.stage('upload'):
+                            destinations = upload_to_all(zip_path, dest_dirs, BackupService._progress_upload(reporter),
+                                                         split_bwlimit(upload_slot.bwlimit, len(dest_dirs)))
+                            BackupService._record_archive(result, stats, destinations, hash_types)
+                            BackupService._check_destinations(destinations)
+                            BackupService._upload_index(result, stats, destinations, encryption_key)
+                    finally:
+                        # Cleanup temporary zip file
+                        if os.path.exists(zip_path):
+                            os.remove(zip_path)
+            finally:
+                if snapshot_path:
+                    remove_snapshot(snapshot_path)
+        finally:
+            for slot in held:
+                release_slot(slot)
+            if window is not None:
+                window.leave_admission(project.id)
+                window.release(project.id, timer)
+        
+        # Downtime is only known once the whole batch has restarted its containers
+        if window is not None:
+            window.wait_closed()
+        
+        # Remember what was backed up for the next incremental run
+        if records is not None:
+            save_manifest(project.id, project.source_path, records)
+            project.runs_since_full = 0 if is_full else (project.runs_since_full or 0) + 1
+    
+    @staticmethod
+    def _compression_history(project):
+        """(bytes_read, archive_size) of the project's most recent successful runs"""
+        session = object_session(project)
+        if session is None:
+            return []
+        return session.query(BackupRun.bytes_read, BackupRun.archive_size) \
+            .filter(BackupRun.project_id == project.id, BackupRun.status == BackupRun.SUCCEEDED,
+                    BackupRun.archive_size.isnot(None)) \
+            .order_by(BackupRun.id.desc()).limit(RATIO_HISTORY).all()
+    
+    @staticmethod
+    def _progress_upload(reporter):
+        """upload_file that also reports each destination's progress to reporter"""
+        if reporter is None:
+            return BackupService.upload_file
+        
+        def upload(local_path, remote_dir, bwlimit=None):
+            size = os.path.getsize(local_path)
+            
+            def on_progress(stats):
+                reporter.upload(remote_dir, stats.get('bytes', 0), stats.get('totalBytes') or size, stats.get('speed'))
+            BackupService.upload_file(local_path, remote_dir, bwlimit, on_progress)
+            reporter.upload(remote_dir, size, size)
+        return upload
+    
+    @staticmethod
+    def _record_archive(result, stats, destinations, hash_types):
+        """Fill result with the statistics, checksums and destinations of an uploaded archive
+        
+        The primary destination's path and remote hash go on the run itself;
+        every destination's outcome, throughput and hash go into its details.
+        """
+        result['bytes_read'] = stats['bytes_read']
+        result['archive_size'] = stats['bytes_written']
+        result['remote_path'] = destinations[0].remote_path
+        result['sha256'] = stats['hashes']['sha256']
+        details = {}
+        for destination in destinations:
+            hash_type = hash_types.get(destination.remote_path.rsplit('/', 1)[0])
+            entry = destination.to_dict()
+            if hash_type:
+                entry['hash_type'] = hash_type
+                entry['hash'] = stats['hashes'][hash_type]
+            details.setdefault('destinations', []).append(entry)
+            if destination is destinations[0] and hash_type:
+                result['remote_hash_type'] = hash_type
+                result['remote_hash'] = stats['hashes'][hash_type]
+        result['file_manifest'] = encode_file_manifest(stats['manifest'])
+        if stats['streams']:
+            details['hot_backups'] = stats['streams']
+        if stats.get('encryption'):
+            details['encryption'] = stats['encryption']
+        result['details'] = details
+    
+    @staticmethod
+    def _check_destinations(destinations):
+        """Fail the run unless the archive reached every destination"""
+        failed = [d for d in destinations if not d.ok]
+        if failed:
+            raise RuntimeError("Upload failed for " + "; ".join(f"{d.remote_path}: {d.error}" for d in failed))
+    
+    @staticmethod
+    def _upload_index(result, stats, destinations, encryption_key=None):
+        """Upload the archive's entry index next to every copy for single-file restores
+        
+        Restores fall back to the archive's central directory without it, so
+        a failed index upload does not fail the backup. The index of an
+        encrypted archive is encrypted with the same key.
+        """
+        for destination in destinations:
+            try:
+                index_path = upload_index(stats['index'], destination.remote_path, encryption_key)
             except Exception as e:
-                logger.error(f"Error executing backup: {e}")
-                # Try to start containers in case of failure
-                try:
-                    project = BackupProject.query.get(project_id)
-                    container_list = project.containers_list
-                    for container in container_list:
-                        subprocess.run(["docker", "start", container], check=False)
-                except:
-                    pass
+                logger.error(f"Error uploading archive index for {destination.remote_path}: {e}")
+                continue
+            if destination is destinations[0]:
+                result['index_path'] = index_path
+    
+    @staticmethod
+    def _record_run(run, timer, result, status, error=None):
+        """Fill a BackupRun from the timings and results of a run"""
+        run.status = status
+        run.error = error
+        run.finished_at = datetime.utcnow()
+        run.archive_name = result.get('archive_name')
+        run.bytes_read = result.get('bytes_read')
+        run.archive_size = result.get('archive_size')
+        for column in ('remote_path', 'sha256', 'remote_hash_type', 'remote_hash', 'file_manifest', 'index_path',
+                       'encryption_key_ref'):
+            setattr(run, column, result.get(column))
+        run.duration_seconds = timer.total
+        run.downtime_seconds = timer.downtime
+        run.stage_timings = json.dumps(timer.stages)
+        details = dict(result.get('details') or {})
+        if result.get('capacity'):
+            details['capacity'] = result['capacity']
+        if details:
+            run.details = json.dumps(details)
+        
+        for column, stages in BackupRun.STAGE_COLUMNS.items():
+            times = [timer.stage_times[name] for name in stages if name in timer.stage_times]
+            if times:
+                setattr(run, f"{column}_started_at", min(t[0] for t in times))
+                setattr(run, f"{column}_finished_at", max(t[1] or run.finished_at for t in times))
+        
+        upload_seconds = timer.stages.get('upload', timer.stages.get('archive_upload'))
+        if upload_seconds and run.archive_size:
+            run.upload_mbps = run.archive_size / (1024 * 1024) / upload_seconds
+    
+    @staticmethod
+    def execute_batch(project_ids, progress=None, job_ids=None):
+        """Back up several projects due together, stopping shared containers once
+        
+        Containers of all projects are stopped together, every source is
+        archived in parallel, the containers are started once the last archive
+        is done and uploads continue in the background. progress and job_ids
+        map project ids to the arguments of execute_backup. Returns
+        {project_id: success}.
+        """
+        from app import app
+        from batch import run_batch
+        
+        progress = progress or {}
+        job_ids = job_ids or {}
+        with app.app_context():
+            projects = BackupProject.query.filter(BackupProject.id.in_(project_ids)).all()
+        
+        def run_project(project_id, window):
+            return BackupService.execute_backup(project_id, progress.get(project_id),
+                                                job_ids.get(project_id), window)
+        
+        results = run_batch(projects, run_project)
+        for project_id in set(project_ids) - set(results):
+            logger.error(f"Project with ID {project_id} not found")
+            results[project_id] = False
+        return results
+    
+    @staticmethod
+    def execute_backup(project_id, progress=None, job_id=None, window=None):
+        """Execute the backup process for a specific project
+        
+        progress, if given, is called as progress(stage, message=None) when a
+        stage starts and with stage 'failed' and the error if the run fails.
+        Every attempt is recorded as a BackupRun.
+        """
+        from app import app, db
+        
+        with app.app_context():
+            return BackupService.execute_backup_with_session(db.session, project_id, progress, job_id, window)
+    
+    @staticmethod
+    def execute_backup_with_session(session, project_id, progress=None, job_id=None, window=None):
+        """Like execute_backup, but with any SQLAlchemy session and no Flask app"""
+        run = None
+        reporter = ProgressReporter(project_id, job_id)
+        
+        def on_stage(stage, message=None):
+            reporter.stage(stage, message)
+            if progress is not None:
+                progress(stage, message)
+        timer = StageTimer(on_stage=on_stage)
+        result = {}
+        try:
+            project = session.get(BackupProject, project_id)
+            if not project:
+                logger.error(f"Project with ID {project_id} not found")
+                if window is not None:
+                    window.release(project_id, timer)
                 return False
+            
+            logger.info(f"Starting backup process for project: {project.project_name}")
+            run = BackupRun(project_id=project.id, job_id=job_id, status=BackupRun.RUNNING)
+            session.add(run)
+            session.commit()
+            
+            # The previous run's source size gives the archive stage an ETA
+            reporter.expect(session.query(BackupRun.bytes_read)
+                            .filter(BackupRun.project_id == project.id, BackupRun.status == BackupRun.SUCCEEDED)
+                            .order_by(BackupRun.id.desc()).limit(1).scalar())
+            def record_archive_name(archive_name):
+                # Retention never deletes the archives of running backups, so
+                # it has to know the name before the upload starts
+                run.archive_name = archive_name
+                session.commit()
+            
+            BackupService._run_backup(project, timer, result, window, reporter, record_archive_name)
+            
+            # Update the last backup time and timings
+            project.last_backup = datetime.utcnow()
+            project.last_duration_seconds = timer.total
+            project.last_downtime_seconds = timer.downtime
+            project.last_stage_timings = json.dumps(timer.stages)
+            BackupService._record_run(run, timer, result, BackupRun.SUCCEEDED)
+            session.commit()
+            
+            logger.info(f"Backup timings for {project.project_name}: {timer.summary()}")
+            logger.info(f"Backup completed successfully for project: {project.project_name}")
+            reporter.finish(BackupRun.SUCCEEDED)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error executing backup: {e}")
+            on_stage('failed', str(e))
+            reporter.finish(BackupRun.FAILED, str(e))
+            session.rollback()
+            if run is not None:
+                try:
+                    BackupService._record_run(run, timer, result, BackupRun.FAILED, str(e))
+                    session.commit()
+                except Exception as record_error:
+                    logger.error(f"Error recording failed backup run: {record_error}")
+                    session.rollback()
+            # Try to start containers in case of failure, but only those this run stopped:
+            # a run that failed before stopping anything may share containers that a
+            # batch running next to it is keeping down
+            try:
+                if window is not None:
+                    # The last project of the batch restarts the shared containers
+                    window.release(project_id, timer)
+                elif timer.containers_stopped and not timer.containers_restarted:
+                    project = session.get(BackupProject, project_id)
+                    get_docker_client().start_containers(project.stop_tiers, health_timeout=None)
+            except Exception as start_error:
+                logger.error(f"Error restarting containers after failure: {start_error}")
+            return False
 
 if __name__ == "__main__":
     import sys
+    from runner import main
     
-    if len(sys.argv) < 2:
-        print("Usage: python backup_service.py execute <project_id>")
-        sys.exit(1)
-    
-    command = sys.argv[1]
-    
-    if command == "execute" and len(sys.argv) == 3:
-        project_id = int(sys.argv[2])
-        success = BackupService.execute_backup(project_id)
-        sys.exit(0 if success else 1)
-    else:
-        print("Invalid command. Available commands: execute <project_id>")
-        sys.exit(1)
+    # Kept for service files written before runner.py existed
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,223 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import Admission
+from docker_client import get_docker_client, DEFAULT_STOP_TIMEOUT
+from fanout import split_bwlimit
+from validation import validate_project
+
+logger = logging.getLogger(__name__)
+
+def merge_tiers(tier_lists):
+    """Union of several projects' container tiers
+
+    Each container goes into the latest tier any project puts it in, so a
+    container another project starts after its dependencies still is.
+    """
+    levels = {}
+    for tiers in tier_lists:
+        for level, tier in enumerate(tiers):
+            for name in tier:
+                levels[name] = max(levels.get(name, 0), level)
+    merged = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+    for name, level in levels.items():
+        merged[level].append(name)
+    return [tier for tier in merged if tier]
+
+def group_overlapping(container_sets):
+    """Group keys whose container sets share at least one container
+
+    container_sets maps a key (e.g. a project id) to its container names;
+    returns a list of key lists, one per group of overlapping projects.
+    """
+    groups = []  # [(keys, names)]
+    for key, names in container_sets.items():
+        names = set(names)
+        keys = [key]
+        for other in [g for g in groups if g[1] & names]:
+            groups.remove(other)
+            keys = other[0] + keys
+            names |= other[1]
+        groups.append((keys, names))
+    return [keys for keys, _ in groups]
+
+class ContainerWindow:
+    """One shared stop/start of the containers of several projects
+
+    Every project in a batch calls admit() for its archive capacity, then
+    stop() before reading its source and release() once it no longer needs
+    its containers down. The first stop() stops the union of all containers;
+    the last release() starts them again and ends the downtime on every
+    participating StageTimer.
+
+    The batch is admitted as a whole before anything is stopped, so its
+    archives run in parallel inside the window instead of queueing for
+    slots one after another while the containers are down. It takes one
+    archive slot, one slot on each disk its members use and, if any member
+    streams, one upload slot whose bandwidth is split between the streams.
+    """
+
+    def __init__(self, projects):
+        self.project_ids = {project.id for project in projects}
+        self.tiers = merge_tiers(project.stop_tiers for project in projects)
+        self.stop_timeout = max((project.stop_timeout or DEFAULT_STOP_TIMEOUT for project in projects),
+                                default=DEFAULT_STOP_TIMEOUT)
+        health_timeouts = [project.health_timeout for project in projects if project.health_timeout]
+        self.health_timeout = max(health_timeouts) if health_timeouts else None
+        self._lock = threading.Condition()
+        self._pending = set(self.project_ids)
+        self._requests = {}  # project_id -> (paths, upload) asked for in admit()
+        self._admitting = False
+        self._admission = None
+        self._admit_error = None
+        self._admitted = set()  # Members still using the shared admission
+        self._controller = None
+        self._timers = []
+        self._stopped = False
+        self._stop_error = None
+        self._start_error = None
+        self._closed = threading.Event()
+
+    def admit(self, project_id, controller, paths=(), upload=False):
+        """Wait until the whole batch is admitted and return this project's share
+
+        Blocks until every member still in the window has asked (members that
+        fail earlier leave through release()), then acquires one admission
+        for all of them from controller. The returned Admission holds nothing
+        itself; hand it back with leave_admission() once the project's
+        archive is written.
+        """
+        started = time.monotonic()
+        with self._lock:
+            if project_id not in self._pending:
+                raise RuntimeError(f"Project {project_id} already left the container window")
+            self._requests[project_id] = (list(paths), upload)
+            self._controller = controller
+            self._lock.notify_all()
+            while self._admission is None and self._admit_error is None:
+                if self._admitting or not self._pending <= set(self._requests):
+                    self._lock.wait()
+                    continue
+                self._admitting = True
+                requests = list(self._requests.values())
+                self._lock.release()
+                try:
+                    admission = controller.acquire(archive=True, upload=any(upload for _, upload in requests),
+                                                   paths=[path for paths, _ in requests for path in paths])
+                except BaseException as e:
+                    error = e
+                    admission = None
+                finally:
+                    self._lock.acquire()
+                if admission is None:
+                    self._admit_error = error
+                else:
+                    self._admission = admission
+                    self._admitted = set(self._requests)
+                self._lock.notify_all()
+            if self._admit_error is not None:
+                raise self._admit_error
+            share = Admission(False, False, set(), time.monotonic() - started)
+            if upload:
+                streams = sum(1 for _, member_upload in self._requests.values() if member_upload)
+                share.bwlimit = split_bwlimit(self._admission.bwlimit, streams)
+            return share
+
+    def leave_admission(self, project_id):
+        """Hand back a project's share; the last one releases the batch's admission
+
+        Safe to call more than once and for projects that were never admitted.
+        """
+        with self._lock:
+            if project_id not in self._admitted:
+                return
+            self._admitted.discard(project_id)
+            if self._admitted:
+                return
+            admission, self._admission = self._admission, None
+            self._admit_error = RuntimeError("The batch's admission was already released")
+        self._controller.release(admission)
+
+    def stop(self, project_id, timer):
+        """Make sure the shared containers are stopped, stopping them on first call"""
+        with self._lock:
+            if project_id not in self._pending:
+                raise RuntimeError(f"Project {project_id} already left the container window")
+            timer.containers_down()
+            self._timers.append(timer)
+            if self._stop_error is not None:
+                raise self._stop_error
+            if self._stopped:
+                return
+            try:
+                with timer.stage('stop_containers'):
+                    get_docker_client().stop_containers(self.tiers, timeout=self.stop_timeout)
+            except Exception as e:
+                self._stop_error = e
+                raise
+            finally:
+                self._stopped = True
+            logger.info(f"Stopped {sum(len(tier) for tier in self.tiers)} containers "
+                        f"for {len(self.project_ids)} projects")
+
+    def release(self, project_id, timer):
+        """Leave the window; the last project to leave restarts the containers
+
+        Safe to call more than once and for projects that never stopped.
+        """
+        with self._lock:
+            if project_id not in self._pending:
+                return
+            self._pending.discard(project_id)
+            # Members waiting in admit() may no longer have to wait for this one
+            self._lock.notify_all()
+            if self._pending:
+                return
+        try:
+            if self._stopped:
+                with timer.stage('start_containers'):
+                    get_docker_client().start_containers(self.tiers, health_timeout=self.health_timeout)
+        except Exception as e:
+            logger.error(f"Error restarting batch containers: {e}")
+            self._start_error = e
+            try:
+                get_docker_client().start_containers(self.tiers, health_timeout=None)
+            except Exception as retry_error:
+                logger.error(f"Error restarting batch containers without health checks: {retry_error}")
+            raise
+        finally:
+            for window_timer in self._timers:
+                window_timer.containers_up()
+            self._closed.set()
+
+    def wait_closed(self):
+        """Block until the containers are running again, raising if the restart failed"""
+        self._closed.wait()
+        if self._start_error is not None:
+            raise RuntimeError(f"Batch containers failed to restart: {self._start_error}")
+
+def run_batch(projects, run_project):
+    """Back up several loaded projects with one shared container stop window
+
+    run_project(project_id, window) runs one project's backup and returns
+    True on success; it is called concurrently for every project. Projects
+    that fail validation are left out of the window and run on their own
+    once it has closed, so they are recorded as failed without touching
+    containers the batch holds down. Returns {project_id: bool}.
+    """
+    valid = [project for project in projects
+             if not validate_project(project.containers_list, project.source_path,
+                                     running_containers=project.hot_backup_commands)]
+    window = ContainerWindow(valid) if valid else None
+    logger.info(f"Batch of {len(projects)} projects sharing containers: "
+                f"{', '.join(name for tier in window.tiers for name in tier) if window else 'none'}")
+
+    with ThreadPoolExecutor(max_workers=max(len(valid), 1), thread_name_prefix='backup-batch') as executor:
+        futures = {project.id: executor.submit(run_project, project.id, window) for project in valid}
+    results = {project_id: future.result() for project_id, future in futures.items()}
+    for project in projects:
+        if project not in valid:
+            results[project.id] = run_project(project.id, None)
+    return {project.id: results[project.id] for project in projects}
@@ -0,0 +1,234 @@
+"""Local stand-ins for Docker and rclone used by benchmark.py
+
+FakeDockerDaemon serves the part of the Docker Engine API the backup engine
+uses on a unix socket, with configurable stop and start delays. Run as a
+script, this module is a fake `rclone` that maps every "remote:path" to a
+directory under BENCH_REMOTE_ROOT and can throttle uploads to
+BENCH_BANDWIDTH (rclone --bwlimit syntax) to simulate a slow link.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socketserver
+import threading
+import http.server
+from urllib.parse import urlsplit, parse_qs, unquote
+
+READ_SIZE = 1024 * 1024
+
+class _DockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _container(self, parts):
+        return self.server.daemon.containers.get(unquote(parts[1])) if len(parts) > 1 else None
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/_ping':
+            return self._reply(200, 'OK')
+        if url.path == '/version':
+            return self._reply(200, {'Version': 'bench', 'ApiVersion': '1.43'})
+        if url.path == '/containers/json':
+            names = json.loads(parse_qs(url.query).get('filters', ['{}'])[0]).get('name')
+            return self._reply(200, [daemon.summary(name) for name in daemon.containers
+                                     if not names or any(n in name for n in names)])
+        if parts[0] == 'containers' and parts[-1] == 'json':
+            if self._container(parts) is None:
+                return self._reply(404, {'message': f"No such container: {parts[1]}"})
+            return self._reply(200, daemon.inspect(unquote(parts[1])))
+        self._reply(404, {'message': 'not implemented'})
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        if parts[0] != 'containers' or self._container(parts) is None:
+            return self._reply(404, {'message': 'not implemented'})
+        name = unquote(parts[1])
+        if parts[-1] == 'stop':
+            return self._reply(204 if daemon.set_running(name, False) else 304)
+        if parts[-1] == 'start':
+            return self._reply(204 if daemon.set_running(name, True) else 304)
+        self._reply(404, {'message': 'not implemented'})
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('localhost', 0)
+
+class FakeDockerDaemon:
+    """Docker Engine API stand-in serving a fixed set of containers
+
+    Stopping and starting a container take stop_seconds and start_seconds.
+    Every state change is recorded in events as (monotonic time, name, running).
+    """
+
+    def __init__(self, socket_path, names, stop_seconds=0.0, start_seconds=0.0):
+        self.socket_path = socket_path
+        self.containers = {name: True for name in names}
+        self.stop_seconds = stop_seconds
+        self.start_seconds = start_seconds
+        self.events = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def summary(self, name):
+        return {'Id': name, 'Names': [f"/{name}"], 'State': 'running' if self.containers[name] else 'exited'}
+
+    def inspect(self, name):
+        running = self.containers[name]
+        return {'Id': name, 'Name': f"/{name}", 'State': {'Running': running, 'Restarting': False, 'ExitCode': 0}}
+
+    def set_running(self, name, running):
+        with self._lock:
+            if self.containers[name] == running:
+                return False
+        time.sleep(self.start_seconds if running else self.stop_seconds)
+        with self._lock:
+            self.containers[name] = running
+            self.events.append((time.monotonic(), name, running))
+        return True
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _DockerHandler)
+        self._server.daemon = self
+        threading.Thread(target=self._server.serve_forever, name='fake-docker', daemon=True).start()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.remove(self.socket_path)
+
+# Options of the rclone commands the backup engine runs that take a value
+_VALUE_OPTIONS = {'--bwlimit', '--offset', '--count', '--hash-type', '--files-from-raw', '--max-depth',
+                  '--transfers', '--stats'}
+
+def _parse_args(argv):
+    options = {}
+    positional = []
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('--'):
+            name, _, value = arg.partition('=')
+            options[name] = value if value or name not in _VALUE_OPTIONS else next(args)
+        else:
+            positional.append(arg)
+    return options, positional
+
+def _local(path):
+    """Directory path of an rclone path; remotes live under BENCH_REMOTE_ROOT"""
+    remote, sep, rest = path.partition(':')
+    if not sep or '/' in remote:
+        return path
+    return os.path.join(os.environ.get("BENCH_REMOTE_ROOT", "/tmp/bench-remote"), remote, rest.lstrip('/'))
+
+def _bandwidth(options):
+    # The slower of the simulated link and the job's own --bwlimit
+    from admission import parse_bandwidth
+    limits = [parse_bandwidth(value) for value in (os.environ.get("BENCH_BANDWIDTH"), options.get('--bwlimit'))]
+    limits = [limit for limit in limits if limit]
+    return min(limits) if limits else None
+
+def _copy_stream(source, target, bandwidth):
+    started = time.monotonic()
+    copied = 0
+    while True:
+        data = source.read(READ_SIZE)
+        if not data:
+            return copied
+        target.write(data)
+        copied += len(data)
+        if bandwidth:
+            ahead = copied / bandwidth - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def _copy_file(source_path, target_path, bandwidth):
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(source_path, 'rb') as source, open(f"{target_path}.partial", 'wb') as target:
+        _copy_stream(source, target, bandwidth)
+    os.replace(f"{target_path}.partial", target_path)
+
+def rclone_main(argv):
+    """Subset of the rclone CLI (rcat, copy, copyto, cat, lsjson, backend, delete)"""
+    options, args = _parse_args(argv)
+    command, args = args[0], args[1:]
+    bandwidth = _bandwidth(options)
+    if command == 'rcat':
+        _copy_file('/dev/stdin', _local(args[0]), bandwidth)
+    elif command == 'copy':
+        source, target = _local(args[0]), _local(args[1])
+        if os.path.isdir(source):
+            for root, _, files in os.walk(source):
+                for name in files:
+                    path = os.path.join(root, name)
+                    _copy_file(path, os.path.join(target, os.path.relpath(path, source)), bandwidth)
+        else:
+            _copy_file(source, os.path.join(target, os.path.basename(source)), bandwidth)
+    elif command == 'copyto':
+        _copy_file(_local(args[0]), _local(args[1]), bandwidth)
+    elif command == 'cat':
+        with open(_local(args[0]), 'rb') as f:
+            f.seek(int(options.get('--offset', 0)))
+            count = options.get('--count')
+            sys.stdout.buffer.write(f.read(int(count)) if count else f.read())
+    elif command == 'lsjson':
+        directory = _local(args[0])
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        print(json.dumps([{'Name': name, 'Size': os.path.getsize(os.path.join(directory, name)), 'IsDir': False}
+                          for name in names if os.path.isfile(os.path.join(directory, name))]))
+    elif command == 'backend':
+        # Like Google Drive, so archives are hashed as in production
+        print(json.dumps({'Hashes': ['md5']}))
+    elif command == 'delete':
+        directory = _local(args[0])
+        with open(options['--files-from-raw']) as f:
+            for name in f.read().splitlines():
+                if name and os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+    elif command == 'version':
+        print("rclone v0.0.0-bench")
+    else:
+        print(f"bench rclone: unsupported command {command}", file=sys.stderr)
+        return 1
+    return 0
+
+def install_rclone(bin_dir):
+    """Write an `rclone` executable into bin_dir that runs rclone_main"""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, 'rclone')
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nPYTHONPATH="{here}" exec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+def reset_remote(root):
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root, exist_ok=True)
+
+if __name__ == "__main__":
+    sys.exit(rclone_main(sys.argv[1:]))
@@ -0,0 +1,347 @@
+"""Repeatable benchmark of the backup pipeline with local stand-ins
+
+    python3 benchmark.py run [--profiles tiny millions huge mixed] [--modes staged streaming] [--bandwidth 50M]
+    python3 benchmark.py compare <baseline.json> <results.json> [--threshold 10]
+
+run generates synthetic source trees (many tiny files, millions of tiny
+files, a few huge files, mixed compressible and incompressible content),
+then backs each one up
+with BackupService.execute_backup_with_session against a fake Docker daemon
+and a fake rclone whose remote is a local directory (bench_fakes.py). Trees
+are cached in the work directory between runs. Every scenario runs in a
+fresh process so its peak RSS is its own. Per-stage wall time, MB/s, peak
+RSS and container downtime are written as JSON; compare reports the change
+between two result files and fails on regressions beyond the threshold.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+BLOCK_SIZE = 1024 * 1024
+CONTAINERS = ('bench-db', 'bench-app')
+
+PROFILES = ('tiny', 'millions', 'huge', 'mixed')
+MODES = ('staged', 'streaming')
+
+_WORDS = [b'backup', b'container', b'volume', b'archive', b'restore', b'docker', b'upload', b'stage',
+          b'snapshot', b'remote', b'project', b'schedule', b'manifest', b'chunk', b'index', b'service']
+
+def _text(rng, size):
+    """Compressible content: random words, roughly 4:1 under deflate"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return b' '.join(words)[:size]
+
+def _random(rng, size):
+    return rng.randbytes(size)
+
+def _write_file(path, rng, size, compressible):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = min(size, BLOCK_SIZE)
+            f.write(_text(rng, block) if compressible else _random(rng, block))
+            size -= block
+
+def tree_spec(profile, args):
+    if profile == 'tiny':
+        return {'profile': profile, 'files': args.tiny_files, 'max_size': 1024}
+    if profile == 'millions':
+        return {'profile': profile, 'files': args.millions_files, 'max_size': 256}
+    if profile == 'huge':
+        return {'profile': profile, 'files': args.huge_files, 'size': args.huge_size * 1024 * 1024}
+    return {'profile': profile, 'files': args.mixed_files, 'max_size': args.mixed_size * 1024 * 1024}
+
+def generate_tree(root, spec, seed=0):
+    """Create a deterministic synthetic source tree, reusing it if it already exists
+
+    tiny, millions: many files of up to max_size bytes, 1000 per directory.
+    huge: a few files of size bytes, half compressible, half random.
+    mixed: files of up to max_size bytes alternating compressible and random.
+    Returns the spec with the number of files and bytes written.
+    """
+    marker = f"{root}.json"
+    if os.path.exists(marker):
+        with open(marker) as f:
+            cached = json.load(f)
+        if {key: cached.get(key) for key in spec} == spec:
+            return cached
+    started = time.monotonic()
+    rng = random.Random(seed)
+    shutil.rmtree(root, ignore_errors=True)
+    total = 0
+    for i in range(spec['files']):
+        directory = os.path.join(root, f"d{i // 1000:05d}")
+        if i % 1000 == 0:
+            os.makedirs(directory, exist_ok=True)
+        if spec['profile'] == 'huge':
+            size = spec['size']
+            compressible = i % 2 == 0
+        else:
+            size = rng.randint(0, spec['max_size'])
+            compressible = spec['profile'] in ('tiny', 'millions') or i % 2 == 0
+        _write_file(os.path.join(directory, f"f{i:07d}.{'txt' if compressible else 'bin'}"),
+                    rng, size, compressible)
+        total += size
+    result = dict(spec, bytes=total)
+    with open(marker, 'w') as f:
+        json.dump(result, f)
+    print(f"Generated {spec['profile']} tree: {spec['files']} files, {total / (1024 * 1024):.1f} MB "
+          f"in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return result
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+def run_scenario(scenario):
+    """Back up one tree in this process and return its measurements
+
+    Called in a child process whose environment points the backup engine at
+    the work directory, the fake Docker socket and the fake rclone.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from database import db, DATABASE_URL
+    from models import User, BackupProject, BackupRun
+    from backup_service import BackupService
+    from bench_fakes import FakeDockerDaemon
+
+    docker = FakeDockerDaemon(os.environ["DOCKER_HOST"][len("unix://"):], CONTAINERS,
+                              stop_seconds=scenario['stop_seconds'], start_seconds=scenario['start_seconds']).start()
+    engine = create_engine(DATABASE_URL)
+    db.metadata.create_all(engine)
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            user = User(email='bench@example.com', password_hash='-')
+            session.add(user)
+            session.flush()
+            project = BackupProject(
+                project_name=f"bench_{scenario['name']}",
+                folder_name=scenario['name'],
+                container_names=f"{CONTAINERS[0]};{CONTAINERS[1]}",
+                source_path=scenario['source_path'],
+                destination_path=f"bench/{scenario['name']}",
+                run_time='03:00',
+                backup_mode=scenario['mode'],
+                backup_backend='archive',
+                snapshot_method=scenario['snapshot'],
+                compression_level=scenario['level'],
+                compression_workers=scenario['workers'],
+                encryption_key_ref='env:BENCH_ENCRYPTION_KEY' if scenario['encrypt'] else None,
+                stop_timeout=10,
+                health_timeout=30,
+                user_id=user.id,
+            )
+            session.add(project)
+            session.commit()
+
+            started = time.monotonic()
+            success = BackupService.execute_backup_with_session(session, project.id)
+            seconds = time.monotonic() - started
+            run = session.query(BackupRun).filter_by(project_id=project.id).order_by(BackupRun.id.desc()).first()
+    finally:
+        engine.dispose()
+        docker.close()
+
+    peak_rss, children_peak_rss = _peak_rss()
+    stages = json.loads(run.stage_timings) if run and run.stage_timings else {}
+    bytes_read = run.bytes_read or 0
+    archive_seconds = stages.get('archive_upload') or stages.get('archive')
+    details = json.loads(run.details) if run and run.details else {}
+    return {
+        'success': success,
+        'error': run.error if run else None,
+        'seconds': round(seconds, 3),
+        'stages': stages,
+        'downtime_seconds': run.downtime_seconds if run else None,
+        'bytes_read': bytes_read,
+        'archive_bytes': run.archive_size,
+        'mb_per_s': round(bytes_read / (1024 * 1024) / seconds, 2) if seconds else None,
+        'archive_mb_per_s': round(bytes_read / (1024 * 1024) / archive_seconds, 2) if archive_seconds else None,
+        'peak_rss_mb': round(peak_rss / (1024 * 1024), 1),
+        'children_peak_rss_mb': round(children_peak_rss / (1024 * 1024), 1),
+        'encryption': details.get('encryption'),
+    }
+
+def _scenario_env(work_dir, args):
+    from bench_fakes import install_rclone
+    bin_dir = os.path.join(work_dir, 'bin')
+    install_rclone(bin_dir)
+    env = dict(os.environ)
+    env.update({
+        'PATH': f"{bin_dir}{os.pathsep}{env.get('PATH', '')}",
+        'DOCKER_HOST': f"unix://{os.path.join(work_dir, 'docker.sock')}",
+        'DATABASE_URL': f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+        'BACKUP_TEMP_DIR': os.path.join(work_dir, 'tmp'),
+        'BACKUP_STATE_DIR': os.path.join(work_dir, 'state'),
+        'BACKUP_SNAPSHOT_DIR': os.path.join(work_dir, 'snapshots'),
+        'BACKUP_DEFAULT_REMOTE': 'bench:',
+        'BACKUP_RCLONE_RC': '',
+        'BACKUP_LOG_LEVEL': env.get('BACKUP_LOG_LEVEL', 'WARNING'),
+        'BENCH_REMOTE_ROOT': os.path.join(work_dir, 'remote'),
+        'BENCH_ENCRYPTION_KEY': os.urandom(32).hex(),
+    })
+    if args.bandwidth:
+        env['BENCH_BANDWIDTH'] = args.bandwidth
+    else:
+        env.pop('BENCH_BANDWIDTH', None)
+    return env
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    env = _scenario_env(work_dir, args)
+    results = {
+        'commit': _commit(),
+        'started_at': datetime.utcnow().isoformat(),
+        'host': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'platform': platform.platform()},
+        'settings': {'bandwidth': args.bandwidth, 'level': args.level, 'workers': args.workers,
+                     'snapshot': args.snapshot, 'stop_seconds': args.stop_seconds,
+                     'start_seconds': args.start_seconds, 'encrypt': args.encrypt},
+        'scenarios': [],
+    }
+    for profile in args.profiles:
+        tree = generate_tree(os.path.join(work_dir, 'trees', profile), tree_spec(profile, args))
+        for mode in args.modes:
+            for repeat in range(args.repeat):
+                scenario = {
+                    'name': f"{profile}_{mode}",
+                    'profile': profile,
+                    'mode': mode,
+                    'repeat': repeat,
+                    'source_path': os.path.join(work_dir, 'trees', profile),
+                    'snapshot': args.snapshot,
+                    'level': args.level,
+                    'workers': args.workers,
+                    'stop_seconds': args.stop_seconds,
+                    'start_seconds': args.start_seconds,
+                    'encrypt': args.encrypt,
+                }
+                # Every run starts from an empty remote, staging area and database
+                for path in ('remote', 'tmp', 'state', 'snapshots'):
+                    shutil.rmtree(os.path.join(work_dir, path), ignore_errors=True)
+                if os.path.exists(os.path.join(work_dir, 'bench.db')):
+                    os.remove(os.path.join(work_dir, 'bench.db'))
+                process = subprocess.run([sys.executable, os.path.abspath(__file__), '_scenario', json.dumps(scenario)],
+                                         env=env, capture_output=True, text=True)
+                if process.returncode != 0:
+                    measured = {'success': False, 'error': process.stderr.strip()[-2000:]}
+                else:
+                    measured = json.loads(process.stdout.strip().splitlines()[-1])
+                entry = dict(scenario, tree_files=tree['files'], tree_bytes=tree['bytes'], **measured)
+                del entry['source_path']
+                results['scenarios'].append(entry)
+                print(_format_entry(entry), file=sys.stderr)
+
+    output = args.output or os.path.join(work_dir, 'results',
+                                         f"{datetime.now():%Y%m%d-%H%M%S}-{results['commit'] or 'nocommit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+    return all(entry['success'] for entry in results['scenarios'])
+
+def _format_entry(entry):
+    if not entry['success']:
+        return f"{entry['name']:<20} FAILED: {entry.get('error')}"
+    stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in entry['stages'].items())
+    return (f"{entry['name']:<20} {entry['seconds']:8.2f}s {entry['mb_per_s'] or 0:8.1f} MB/s "
+            f"rss {entry['peak_rss_mb']:7.1f} MB downtime {entry['downtime_seconds'] or 0:6.2f}s ({stages})")
+
+# Metric -> True if higher is better
+COMPARED_METRICS = {'seconds': False, 'mb_per_s': True, 'peak_rss_mb': False, 'downtime_seconds': False}
+
+def _summarize(results):
+    """Mean of every compared metric per scenario name, over repeats"""
+    grouped = {}
+    for entry in results['scenarios']:
+        if entry['success']:
+            grouped.setdefault(entry['name'], []).append(entry)
+    return {name: {metric: sum(e[metric] or 0 for e in entries) / len(entries) for metric in COMPARED_METRICS}
+            for name, entries in grouped.items()}
+
+def compare(args):
+    """Print the change of each metric between two result files; False on a regression"""
+    with open(args.baseline) as f:
+        baseline = _summarize(json.load(f))
+    with open(args.results) as f:
+        current = _summarize(json.load(f))
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        changes = []
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = baseline[name][metric], current[name][metric]
+            change = (new - old) / old * 100 if old else 0.0
+            worse = change < -args.threshold if higher_is_better else change > args.threshold
+            if worse and abs(new - old) > 0.05:
+                regressions.append(f"{name} {metric}")
+            changes.append(f"{metric} {old:.2f} -> {new:.2f} ({change:+.1f}%{' !' if worse else ''})")
+        print(f"{name:<20} " + ', '.join(changes))
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"{name:<20} only in {'baseline' if name in baseline else 'results'}")
+    if regressions:
+        print(f"Regressions beyond {args.threshold}%: {', '.join(regressions)}")
+    return not regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Benchmark the backup pipeline")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="back up synthetic trees and record the measurements")
+    run_parser.add_argument('--work-dir', default='/tmp/bkup-bench', help="trees, fake remote and results")
+    run_parser.add_argument('--output', help="results file (default: <work-dir>/results/<time>-<commit>.json)")
+    run_parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=list(PROFILES))
+    run_parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    run_parser.add_argument('--repeat', type=int, default=1)
+    run_parser.add_argument('--tiny-files', type=int, default=100000, help="files in the tiny tree")
+    run_parser.add_argument('--millions-files', type=int, default=2000000, help="files in the millions tree")
+    run_parser.add_argument('--huge-files', type=int, default=2, help="files in the huge tree")
+    run_parser.add_argument('--huge-size', type=int, default=512, help="MB per huge file")
+    run_parser.add_argument('--mixed-files', type=int, default=400, help="files in the mixed tree")
+    run_parser.add_argument('--mixed-size', type=int, default=8, help="largest mixed file in MB")
+    run_parser.add_argument('--bandwidth', help="simulated upload bandwidth, e.g. 50M (default unlimited)")
+    run_parser.add_argument('--snapshot', choices=('reflink', 'hardlink', 'copy'), help="snapshot method")
+    run_parser.add_argument('--level', type=int, default=6, help="compression level")
+    run_parser.add_argument('--workers', type=int, help="compression workers (default all CPUs)")
+    run_parser.add_argument('--stop-seconds', type=float, default=0.5, help="simulated container stop time")
+    run_parser.add_argument('--start-seconds', type=float, default=0.5, help="simulated container start time")
+    run_parser.add_argument('--encrypt', action='store_true', help="encrypt the archives")
+    compare_parser = commands.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help="allowed change in percent")
+    scenario_parser = commands.add_parser('_scenario', help=argparse.SUPPRESS)
+    scenario_parser.add_argument('scenario')
+    args = parser.parse_args(argv)
+
+    if args.command == '_scenario':
+        import logging
+        logging.basicConfig(level=os.environ.get("BACKUP_LOG_LEVEL", "WARNING"), stream=sys.stderr)
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return 0
+    if args.command == 'compare':
+        return 0 if compare(args) else 1
+    return 0 if run(args) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
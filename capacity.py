@@ -0,0 +1,263 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from manifest import STATE_DIR, DEFAULT_SCAN_WORKERS
+from snapshot import SNAPSHOT_DIR
+from fanout import FANOUT_MAX_SPILL
+
+logger = logging.getLogger(__name__)
+
+SIZE_CACHE_DIR = os.path.join(STATE_DIR, 'sizes')
+
+# Predicted archive size is multiplied by this before it is compared to free space
+CAPACITY_MARGIN = float(os.environ.get("BACKUP_CAPACITY_MARGIN", "1.2"))
+# Space always left free on the staging volume
+MIN_FREE_BYTES = int(os.environ.get("BACKUP_MIN_FREE_MB", "1024")) * 1024 * 1024
+# Stream a staged project's archive instead of refusing the run when /BkUp is too full
+STREAMING_FALLBACK = os.environ.get("BACKUP_CAPACITY_FALLBACK", "1") == "1"
+
+# Files at least this large are re-stat'ed even in unchanged directories,
+# since they are the ones that grow in place (databases, logs)
+LARGE_FILE = 1024 * 1024
+# Small files can grow in place without touching their directory's mtime, so
+# the whole tree is walked again after this many runs or hours of cache reuse
+SIZE_CACHE_RUNS = int(os.environ.get("BACKUP_SIZE_CACHE_RUNS", "10"))
+SIZE_CACHE_HOURS = float(os.environ.get("BACKUP_SIZE_CACHE_HOURS", "24"))
+# Successful runs whose compression ratio predicts the next archive
+RATIO_HISTORY = 5
+
+STAGED = 'staged'
+STREAMING = 'streaming'
+
+class CapacityError(Exception):
+    """The backup would not fit on the staging volume"""
+
+def _cache_path(source_path):
+    return os.path.join(SIZE_CACHE_DIR, f"{hashlib.sha1(source_path.encode()).hexdigest()}.json.gz")
+
+def _load_cache(source_path):
+    """Cached directory listings and how often they were reused since the last full walk
+
+    Returns (dirs, scanned, runs); an expired cache comes back empty so the
+    tree is walked in full.
+    """
+    try:
+        with gzip.open(_cache_path(source_path), 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}, None, 0
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable size cache for {source_path}: {e}")
+        return {}, None, 0
+    scanned = data.get('scanned')
+    runs = data.get('runs', 0)
+    if data.get('source_path') != source_path or scanned is None:
+        return {}, None, 0
+    if runs >= SIZE_CACHE_RUNS or time.time() - scanned > SIZE_CACHE_HOURS * 3600:
+        return {}, None, 0
+    return data.get('dirs', {}), scanned, runs
+
+def _save_cache(source_path, dirs, scanned, runs):
+    path = _cache_path(source_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+        json.dump({'source_path': source_path, 'scanned': scanned, 'runs': runs, 'dirs': dirs}, f,
+                  separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def _size_directory(path, cached):
+    """Size one directory, reusing its cached listing if its mtime is unchanged
+
+    Returns (path, entry, reused) where entry is [mtime_ns, small file bytes,
+    file count, {large file name: size}, subdirectories].
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError as e:
+        logger.warning(f"Cannot size directory {path}: {e}")
+        return path, [0, 0, 0, {}, []], False
+
+    if cached is not None and cached[0] == mtime_ns:
+        # Same entries as last time; only large files may have changed size
+        large = {}
+        for name, size in cached[3].items():
+            try:
+                large[name] = os.stat(os.path.join(path, name)).st_size
+            except OSError:
+                pass
+        return path, [mtime_ns, cached[1], cached[2], large, cached[4]], True
+
+    small_bytes = 0
+    files = 0
+    large = {}
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        size = entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                        if size >= LARGE_FILE:
+                            large[entry.name] = size
+                        else:
+                            small_bytes += size
+                except OSError as e:
+                    logger.warning(f"Skipping {entry.path}: {e}")
+    except OSError as e:
+        logger.warning(f"Cannot size directory {path}: {e}")
+    return path, [mtime_ns, small_bytes, files, large, subdirs], False
+
+def size_tree(source_path, workers=DEFAULT_SCAN_WORKERS, use_cache=True):
+    """Total bytes and files under source_path, walked by a pool of workers
+
+    Directories whose mtime has not changed since the previous sizing are not
+    listed again; their cached small-file total is reused and only their
+    large files are re-stat'ed. Every SIZE_CACHE_RUNS runs or
+    SIZE_CACHE_HOURS hours the cache is dropped and every directory is
+    listed, so small files that grew in place are counted again. Returns
+    {'bytes', 'files', 'directories', 'reused', 'seconds'}.
+    """
+    started = time.monotonic()
+    cache, scanned, runs = _load_cache(source_path) if use_cache else ({}, None, 0)
+    if scanned is None:
+        scanned, runs = time.time(), 0
+    else:
+        runs += 1
+    dirs = {}
+    reused = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='size') as executor:
+        pending = {executor.submit(_size_directory, source_path, cache.get(source_path))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, entry, was_reused = future.result()
+                dirs[path] = entry
+                reused += was_reused
+                for name in entry[4]:
+                    subdir = os.path.join(path, name)
+                    pending.add(executor.submit(_size_directory, subdir, cache.get(subdir)))
+
+    total = sum(entry[1] + sum(entry[3].values()) for entry in dirs.values())
+    files = sum(entry[2] for entry in dirs.values())
+    try:
+        _save_cache(source_path, dirs, scanned, runs)
+    except OSError as e:
+        logger.warning(f"Could not save size cache for {source_path}: {e}")
+    seconds = time.monotonic() - started
+    logger.info(f"Sized {source_path}: {total / (1024 * 1024):.1f} MB in {files} files, "
+                f"{len(dirs)} directories ({reused} unchanged) in {seconds:.2f}s")
+    return {'bytes': total, 'files': files, 'directories': len(dirs), 'reused': reused, 'seconds': seconds}
+
+def predict_ratio(history):
+    """Archive/source size ratio to plan with, from [(bytes_read, archive_size), ...] of past runs
+
+    The least compressible of the recent runs is used; without history the
+    archive is assumed to be as large as the source.
+    """
+    ratios = [archive_size / bytes_read for bytes_read, archive_size in history
+              if bytes_read and archive_size]
+    return min(max(ratios), 1.0) if ratios else 1.0
+
+def _mb(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+def _device(path):
+    # The nearest existing parent decides which volume a path ends up on
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev, path
+
+class CapacityPlan:
+    """Outcome of the capacity check: the mode to run in and the numbers behind it"""
+
+    def __init__(self, mode, source, ratio, predicted_bytes, required_bytes, free_bytes, reason=None):
+        self.mode = mode
+        self.source = source
+        self.ratio = ratio
+        self.predicted_bytes = predicted_bytes
+        self.required_bytes = required_bytes
+        self.free_bytes = free_bytes
+        self.reason = reason
+
+    def to_dict(self):
+        return {'mode': self.mode, 'source_bytes': self.source['bytes'], 'source_files': self.source['files'],
+                'sizing_seconds': round(self.source['seconds'], 3), 'ratio': round(self.ratio, 4),
+                'predicted_bytes': self.predicted_bytes, 'required_bytes': self.required_bytes,
+                'free_bytes': self.free_bytes, 'reason': self.reason}
+
+def plan_capacity(project, history, staging_dir, free_space=None):
+    """Decide how a project's backup can run given the space on the staging volume
+
+    A staged archive needs its predicted size (times CAPACITY_MARGIN) plus
+    MIN_FREE_BYTES free in staging_dir; a 'copy' snapshot needs the source
+    size on the snapshot volume (the same volume by default). Streaming to
+    several destinations needs room in staging_dir for the fan-out to spill
+    to: FANOUT_MAX_SPILL (or the predicted archive, if smaller or unlimited)
+    for each destination but the fastest. If a staged archive does not fit,
+    zip projects fall back to streaming when STREAMING_FALLBACK is on. Raises
+    CapacityError if the run cannot fit at all. history is
+    [(bytes_read, archive_size), ...] of recent runs.
+    """
+    free_space = free_space or (lambda path: shutil.disk_usage(path).free)
+    source = size_tree(project.source_path)
+    ratio = predict_ratio(history)
+    predicted = int(source['bytes'] * ratio)
+    staged_bytes = int(predicted * CAPACITY_MARGIN)
+    spill_bytes = min(staged_bytes, FANOUT_MAX_SPILL) if FANOUT_MAX_SPILL else staged_bytes
+    streaming_bytes = spill_bytes * len(project.extra_destination_list)
+
+    # Space needed per volume, for each mode the run could use
+    staging_device, staging_path = _device(staging_dir)
+    snapshot_needs = {}
+    if project.snapshot_method == 'copy':
+        snapshot_device, snapshot_path = _device(SNAPSHOT_DIR)
+        snapshot_needs[snapshot_device] = (snapshot_path, int(source['bytes'] * CAPACITY_MARGIN))
+
+    def fits(staging_bytes):
+        needs = dict(snapshot_needs)
+        if staging_bytes:
+            path, extra = needs.get(staging_device, (staging_path, 0))
+            needs[staging_device] = (path, extra + staging_bytes)
+        shortfalls = []
+        for path, required in needs.values():
+            free = free_space(path)
+            if required + MIN_FREE_BYTES > free:
+                shortfalls.append((path, required, free))
+        return shortfalls
+
+    staging_free = free_space(staging_path)
+    streamable = project.backup_backend != 'dedup'
+    preferred = STREAMING if project.backup_mode == STREAMING and streamable else STAGED
+    candidates = [preferred]
+    if preferred == STAGED and streamable and STREAMING_FALLBACK:
+        candidates.append(STREAMING)
+
+    shortfalls = []
+    for mode in candidates:
+        required = staged_bytes if mode == STAGED else streaming_bytes
+        shortfalls = fits(required)
+        if not shortfalls:
+            reason = None
+            if mode != preferred:
+                reason = (f"Staging needs {_mb(staged_bytes + MIN_FREE_BYTES)} but {staging_path} has "
+                          f"{_mb(staging_free)} free, streaming instead")
+                logger.warning(f"{project.project_name}: {reason}")
+            return CapacityPlan(mode, source, ratio, predicted, required, staging_free, reason)
+
+    path, required, free = shortfalls[0]
+    raise CapacityError(f"Not enough space for the backup: {path} has {_mb(free)} free, "
+                        f"{_mb(required + MIN_FREE_BYTES)} needed "
+                        f"(source {_mb(source['bytes'])}, predicted ratio {ratio:.2f})")
@@ -0,0 +1,301 @@
+import os
+import time
+import struct
+import zlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Files are split into blocks of this size and each block is deflated on its
+# own in the worker pool (the same approach pigz uses). Blocks are flushed
+# with Z_SYNC_FLUSH so the concatenated output is a single valid deflate stream.
+BLOCK_SIZE = 1024 * 1024
+
+DEFAULT_LEVEL = 6
+
+# Content that is already compressed is stored as-is
+STORED_EXTENSIONS = frozenset({
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar', '.jar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.mp4', '.m4a', '.mkv', '.mov', '.avi', '.webm', '.ogg', '.flac',
+    '.pdf', '.docx', '.xlsx', '.pptx',
+})
+
+# A block is treated as high entropy (encrypted, compressed database pages,
+# ...) when a fast deflate of its first bytes saves less than this fraction.
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+ENTROPY_MIN_SAVING = 0.03
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_ENTRIES = 0xFFFF
+ZIP_MAX_SIZE = 0xFFFFFFFF
+
+# General purpose flags: sizes follow the data in a data descriptor, names are UTF-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+def default_workers():
+    """Number of compression workers used when a project does not set one"""
+    return os.cpu_count() or 1
+
+def looks_compressed(sample):
+    """Return True if a sample of file content does not compress worthwhile"""
+    if len(sample) < 4096:
+        return False
+    sample = sample[:ENTROPY_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) > len(sample) * (1 - ENTROPY_MIN_SAVING)
+
+def _deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def _rechunk(chunks, size):
+    """Regroup an iterable of byte chunks into blocks of exactly size bytes (the last may be shorter)"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+class _Done:
+    """Stand-in for a future whose result is already known"""
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+class ZipEntry:
+    """Bookkeeping for one archive member"""
+
+    def __init__(self, arcname, mode, mtime, method, zip64=False, is_dir=False):
+        self.arcname = arcname
+        self.name = arcname.encode('utf-8')
+        self.mode = mode
+        self.mtime = mtime
+        self.method = method
+        self.zip64 = zip64
+        self.is_dir = is_dir
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.header_offset = 0
+        self.data_offset = 0
+
+class ParallelZipWriter:
+    """Zip writer that compresses file blocks on a thread pool
+
+    The output only needs a write() method, so archives can be written into a
+    pipe as well as a file. Entries use data descriptors, which lets the local
+    header go out before the sizes are known. Memory use is bounded by the
+    number of blocks kept in flight (a few per worker).
+    """
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, workers=None, block_size=BLOCK_SIZE, on_progress=None):
+        self.fileobj = fileobj
+        self.on_progress = on_progress
+        self.level = level
+        self.workers = workers or default_workers()
+        self.block_size = block_size
+        self.entries = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stored_files = 0
+        self._pending = deque()
+        self._max_pending = self.workers * 4
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='zip')
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def _choose_method(self, arcname, first_block):
+        if self.level == 0:
+            return ZIP_STORED
+        if os.path.splitext(arcname)[1].lower() in STORED_EXTENSIONS:
+            return ZIP_STORED
+        if looks_compressed(first_block):
+            return ZIP_STORED
+        return ZIP_DEFLATED
+
+    def _submit(self, entry, data, is_first, is_last):
+        if entry.method == ZIP_DEFLATED:
+            future = self._executor.submit(_deflate_block, data, self.level, is_last)
+        else:
+            future = _Done(data)
+        self._pending.append((entry, future, is_first, is_last))
+        while len(self._pending) > self._max_pending:
+            self._emit(*self._pending.popleft())
+
+    def _emit(self, entry, future, is_first, is_last):
+        data = future.result()
+        if is_first:
+            self._write_local_header(entry)
+        self._write(data)
+        entry.compress_size += len(data)
+        if is_last:
+            self._write_data_descriptor(entry)
+            self.entries.append(entry)
+        if self.on_progress is not None:
+            self.on_progress(len(self.entries), self.bytes_read, self.bytes_written)
+
+    def _write_local_header(self, entry):
+        entry.header_offset = self.bytes_written
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        extra = b''
+        size_field = 0
+        if entry.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            size_field = ZIP_MAX_SIZE
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if entry.zip64 else 20,
+                             FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry.method, dos_time, dos_date,
+                             0, size_field, size_field, len(entry.name), len(extra))
+        self._write(header + entry.name + extra)
+        entry.data_offset = self.bytes_written
+
+    def _write_data_descriptor(self, entry):
+        # A file on a live volume can grow past the limit after its header was
+        # written, so the sizes actually read decide the descriptor's format
+        if entry.file_size >= ZIP64_LIMIT or entry.compress_size >= ZIP64_LIMIT:
+            entry.zip64 = True
+        if entry.zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, entry.crc, entry.compress_size, entry.file_size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, entry.crc, entry.compress_size, entry.file_size)
+        self._write(descriptor)
+
+    def add_directory(self, path, arcname):
+        """Add a directory entry, taking mode and mtime from path"""
+        st = os.stat(path)
+        entry = ZipEntry(arcname.rstrip('/') + '/', st.st_mode, st.st_mtime, ZIP_STORED, is_dir=True)
+        self._submit(entry, b'', True, True)
+
+    def _add_blocks(self, arcname, mode, mtime, blocks, zip64):
+        blocks = iter(blocks)
+        block = next(blocks, b'')
+        method = self._choose_method(arcname, block)
+        entry = ZipEntry(arcname, mode, mtime, method, zip64=zip64)
+        if method == ZIP_STORED:
+            self.stored_files += 1
+        is_first = True
+        while True:
+            next_block = next(blocks, b'') if block else b''
+            entry.crc = zlib.crc32(block, entry.crc)
+            entry.file_size += len(block)
+            self.bytes_read += len(block)
+            is_last = not next_block
+            self._submit(entry, block, is_first, is_last)
+            if is_last:
+                break
+            block = next_block
+            is_first = False
+        return entry
+
+    def add_file(self, path, arcname):
+        """Add a regular file, compressing it block by block in the pool"""
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            blocks = iter(lambda: f.read(self.block_size), b'')
+            return self._add_blocks(arcname, st.st_mode, st.st_mtime, blocks, st.st_size >= ZIP64_LIMIT)
+
+    def add_stream(self, arcname, chunks, mode=0o100644, mtime=None):
+        """Add an entry whose content comes from an iterable of byte chunks
+
+        The chunks are regrouped into blocks and compressed like a file. The
+        size is not known up front, so the entry always uses zip64 sizes.
+        """
+        return self._add_blocks(arcname, mode, mtime if mtime is not None else time.time(),
+                                _rechunk(chunks, self.block_size), True)
+
+    def writestr(self, arcname, data, mode=0o100644, mtime=None):
+        """Add an in-memory entry"""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        method = ZIP_DEFLATED if self.level else ZIP_STORED
+        entry = ZipEntry(arcname, mode, mtime if mtime is not None else time.time(), method,
+                         zip64=len(data) >= ZIP64_LIMIT)
+        entry.crc = zlib.crc32(data)
+        entry.file_size = len(data)
+        self._submit(entry, data, True, True)
+        return entry
+
+    def _central_directory_record(self, entry):
+        zip64_fields = []
+        file_size = entry.file_size
+        compress_size = entry.compress_size
+        header_offset = entry.header_offset
+        if file_size >= ZIP_MAX_SIZE:
+            zip64_fields.append(file_size)
+            file_size = ZIP_MAX_SIZE
+        if compress_size >= ZIP_MAX_SIZE:
+            zip64_fields.append(compress_size)
+            compress_size = ZIP_MAX_SIZE
+        if header_offset >= ZIP_MAX_SIZE:
+            zip64_fields.append(header_offset)
+            header_offset = ZIP_MAX_SIZE
+        extra = b''
+        if zip64_fields:
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+        version = 45 if (entry.zip64 or zip64_fields) else 20
+        external_attr = (entry.mode & 0xFFFF) << 16
+        if entry.is_dir:
+            external_attr |= 0x10
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version,
+                             FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry.method, dos_time, dos_date,
+                             entry.crc, compress_size, file_size, len(entry.name), len(extra),
+                             0, 0, 0, external_attr, header_offset)
+        return record + entry.name + extra
+
+    def close(self):
+        """Flush pending blocks and write the central directory"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            while self._pending:
+                self._emit(*self._pending.popleft())
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+        cd_offset = self.bytes_written
+        for entry in self.entries:
+            self._write(self._central_directory_record(entry))
+        cd_size = self.bytes_written - cd_offset
+        count = len(self.entries)
+
+        if count >= ZIP_MAX_ENTRIES or cd_offset >= ZIP_MAX_SIZE or cd_size >= ZIP_MAX_SIZE:
+            zip64_end_offset = self.bytes_written
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                    count, count, cd_size, cd_offset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1))
+            count = min(count, ZIP_MAX_ENTRIES)
+            cd_size = min(cd_size, ZIP_MAX_SIZE)
+            cd_offset = min(cd_offset, ZIP_MAX_SIZE)
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
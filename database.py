@@ -0,0 +1,60 @@
+import os
+import logging
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, literal, text
+from sqlalchemy.orm import DeclarativeBase
+
+logger = logging.getLogger(__name__)
+
+# Shared by the web app and the lean backup runner
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# Set up SQLAlchemy base class
+class Base(DeclarativeBase):
+    pass
+
+# Models are declared on db.Model without creating the Flask app, so they can
+# also be used from a plain SQLAlchemy Session (see runner.py)
+db = SQLAlchemy(model_class=Base)
+
+def _column_ddl(column, dialect):
+    preparer = dialect.identifier_preparer
+    ddl = f"{preparer.format_column(column)} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        # Existing rows get the model's default; without one the column has to allow NULL
+        value = literal(default, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    for foreign_key in column.foreign_keys:
+        ddl += (f" REFERENCES {preparer.format_table(foreign_key.column.table)} "
+                f"({preparer.format_column(foreign_key.column)})")
+        if foreign_key.ondelete:
+            ddl += f" ON DELETE {foreign_key.ondelete}"
+    return ddl
+
+def upgrade_schema(engine, metadata):
+    """Create missing tables and add the columns and indexes existing ones lack
+
+    create_all leaves existing tables alone, so columns and indexes declared
+    after a table was created are added here with ALTER TABLE ... ADD COLUMN
+    and CREATE INDEX. Safe to run on every start. Nothing is dropped or
+    changed, and added columns only get a NOT NULL constraint if the model
+    gives them a default.
+    """
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                conn.execute(text(f"ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} "
+                                  f"ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+                logger.info(f"Added column {table.name}.{column.name}")
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
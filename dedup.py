@@ -0,0 +1,308 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import subprocess
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from manifest import STATE_DIR, walk_tree
+from rclone_rc import get_rclone, log_progress
+
+logger = logging.getLogger(__name__)
+
+# Where chunks and snapshot manifests are stored. Either an rclone remote path
+# ("gdrive:bkup-chunks", or a local path handled by rclone's local backend) or,
+# when it starts with "/", a plain directory written to directly.
+DEDUP_REPOSITORY = os.environ.get("BACKUP_DEDUP_REPOSITORY", "gdrive:bkup-chunks")
+
+# Content-defined chunking parameters (gear hash, as in FastCDC)
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# A cut is made where the low 19 bits of the hash are zero, which on average
+# happens 512 KiB after the minimum size, so chunks average about 768 KiB
+# (AVG_CHUNK_SIZE is only recorded in snapshots; changing the mask would move
+# every cut point and defeat deduplication against existing repositories)
+_CUT_MASK = (1 << ((AVG_CHUNK_SIZE - MIN_CHUNK_SIZE).bit_length() - 1)) - 1
+_CUT_BITS = _CUT_MASK.bit_length()
+_HASH_MASK = (1 << 64) - 1
+# Bytes hashed per numpy pass while looking for a cut
+_CUT_BLOCK = 256 * 1024
+
+def _gear_table():
+    table = []
+    for i in range(256):
+        digest = hashlib.sha256(f"bkup-gear-{i}".encode()).digest()
+        table.append(int.from_bytes(digest[:8], 'little'))
+    return table
+
+GEAR = _gear_table()
+# Only the bits under _CUT_MASK decide a cut, so 32-bit arithmetic is enough
+_GEAR_ARRAY = np.array([g & 0xFFFFFFFF for g in GEAR], dtype=np.uint32) if np is not None else None
+
+def _shifted(values, count):
+    # values[i - count], with zeros before the start
+    out = np.zeros_like(values)
+    out[count:] = values[:len(values) - count]
+    return out
+
+def _window_hashes(gear):
+    """Low bits of the gear hash after each byte, from that byte's gear values
+
+    The hash shifts left once per byte, so the bits under _CUT_MASK only
+    depend on the last _CUT_BITS bytes: h[i] = sum(gear[i - k] << k). The sum
+    is built by doubling the number of terms covered at each step.
+    """
+    total = np.zeros_like(gear)
+    covered = 0
+    span, sums = 1, gear
+    while True:
+        if _CUT_BITS & span:
+            total += _shifted(sums, covered) << np.uint32(covered)
+            covered += span
+        if span * 2 > _CUT_BITS:
+            return total
+        sums = sums + (_shifted(sums, span) << np.uint32(span))
+        span *= 2
+
+def _find_cut_numpy(data, pos, end):
+    window = np.frombuffer(data, dtype=np.uint8, count=end - pos, offset=pos)
+    mask = np.uint32(_CUT_MASK)
+    for block in range(0, len(window), _CUT_BLOCK):
+        # Earlier bytes still in the hash; the first block starts from zero
+        lead = min(block, _CUT_BITS - 1)
+        hashes = _window_hashes(_GEAR_ARRAY[window[block - lead:block + _CUT_BLOCK]])[lead:]
+        hits = np.flatnonzero((hashes & mask) == 0)
+        if len(hits):
+            return pos + block + int(hits[0]) + 1
+    return end
+
+def find_cut_point(data, start, end):
+    """Return the end offset of the chunk starting at start in data[:end]
+
+    Uses numpy when it is installed; the pure Python loop finds the same cut
+    points but is an order of magnitude slower.
+    """
+    if end - start <= MIN_CHUNK_SIZE:
+        return end
+    end = min(end, start + MAX_CHUNK_SIZE)
+    if np is not None:
+        return _find_cut_numpy(data, start + MIN_CHUNK_SIZE, end)
+    gear = GEAR
+    mask = _CUT_MASK
+    h = 0
+    pos = start + MIN_CHUNK_SIZE
+    for byte in data[pos:end]:
+        h = ((h << 1) + gear[byte]) & _HASH_MASK
+        pos += 1
+        if not h & mask:
+            return pos
+    return end
+
+def chunk_file(path):
+    """Split a file into content-defined chunks
+
+    Returns a list of (offset, length, sha256 hex digest). Runs in a worker
+    process, since the rolling hash is CPU bound.
+    """
+    chunks = []
+    offset = 0
+    buffer = b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(MAX_CHUNK_SIZE * 2)
+            buffer += data
+            eof = not data
+            start = 0
+            # Only cut where a full max-size window is available, unless at EOF
+            while buffer and (eof or len(buffer) - start >= MAX_CHUNK_SIZE):
+                cut = find_cut_point(buffer, start, len(buffer))
+                piece = buffer[start:cut]
+                chunks.append((offset, len(piece), hashlib.sha256(piece).hexdigest()))
+                offset += len(piece)
+                start = cut
+                if start >= len(buffer):
+                    break
+            buffer = buffer[start:]
+            if eof:
+                break
+    return chunks
+
+class ChunkIndex:
+    """Local SQLite index of the chunks known to exist in a repository"""
+
+    def __init__(self, repository):
+        key = hashlib.sha256(repository.encode()).hexdigest()[:16]
+        path = os.path.join(STATE_DIR, 'dedup', f"index_{key}.sqlite")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER, stored_size INTEGER)")
+
+    def __contains__(self, digest):
+        row = self.conn.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone()
+        return row is not None
+
+    def add_many(self, rows):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO chunks (digest, size, stored_size) VALUES (?, ?, ?)", rows)
+
+    def close(self):
+        self.conn.close()
+
+def _chunk_path(digest):
+    return f"chunks/{digest[:2]}/{digest}"
+
+class DirectoryTarget:
+    """Repository stored in a plain local directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload_tree(self, staging_dir):
+        shutil.copytree(staging_dir, self.root, dirs_exist_ok=True)
+
+class RcloneTarget:
+    """Repository stored on an rclone remote"""
+
+    def __init__(self, remote):
+        self.remote = remote.rstrip('/')
+
+    def upload_tree(self, staging_dir):
+        # Avoid listing the (large) chunk store on every run
+        rclone = get_rclone()
+        if rclone is not None:
+            rclone.copy_dir(staging_dir, self.remote, on_progress=log_progress(f"Upload to {self.remote}"))
+            return
+        subprocess.run(["rclone", "copy", "--no-traverse", staging_dir, self.remote], check=True)
+
+def open_target(repository):
+    if repository.startswith('/'):
+        return DirectoryTarget(repository)
+    return RcloneTarget(repository)
+
+class DedupStore:
+    """Content-defined chunk deduplication backend
+
+    Source files are split into chunks with a gear rolling hash. Chunks not in
+    the local index are compressed into a staging directory and uploaded in a
+    single batch together with a snapshot manifest listing each file's chunks.
+    """
+
+    def __init__(self, repository=None, workers=None, staging_root="/BkUp"):
+        self.repository = repository or DEDUP_REPOSITORY
+        self.workers = workers or os.cpu_count() or 1
+        self.staging_root = staging_root
+        self.target = open_target(self.repository)
+
+    def prepare(self, source_path, snapshot_name, snapshot_dir, read_root=None):
+        """Chunk source_path and stage new chunks plus the snapshot manifest
+
+        This is the only step that reads the source, so containers can be
+        restarted as soon as it returns. read_root points at a point-in-time
+        copy of source_path to read from instead. Returns (staging_dir, stats,
+        new_rows).
+        """
+        started = time.monotonic()
+        staging_dir = os.path.join(self.staging_root, f"{snapshot_name}.dedup")
+        os.makedirs(staging_dir, exist_ok=True)
+        index = ChunkIndex(self.repository)
+        paths = sorted(walk_tree(read_root or source_path))
+        stats = {'files': len(paths), 'bytes_read': 0, 'chunks': 0, 'new_chunks': 0,
+                 'new_bytes': 0, 'stored_bytes': 0}
+        files = []
+        new_rows = []
+        seen = set()
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for path, chunks in zip(paths, executor.map(chunk_file, paths, chunksize=16)):
+                    st = os.stat(path)
+                    name = os.path.join(source_path, os.path.relpath(path, read_root)) if read_root else path
+                    files.append({'path': name, 'size': st.st_size, 'mode': st.st_mode,
+                                  'mtime': st.st_mtime, 'chunks': [digest for _, _, digest in chunks]})
+                    new_chunks = []
+                    for chunk in chunks:
+                        digest = chunk[2]
+                        stats['chunks'] += 1
+                        stats['bytes_read'] += chunk[1]
+                        if digest not in seen:
+                            seen.add(digest)
+                            if digest not in index:
+                                new_chunks.append(chunk)
+                    if new_chunks:
+                        new_rows.extend(self._stage_chunks(path, new_chunks, staging_dir))
+        finally:
+            index.close()
+
+        stats['new_chunks'] = len(new_rows)
+        stats['new_bytes'] = sum(size for _, size, _ in new_rows)
+        stats['stored_bytes'] = sum(stored for _, _, stored in new_rows)
+        stats['bytes_avoided'] = stats['bytes_read'] - stats['new_bytes']
+        # None when every chunk was already stored
+        stats['dedup_ratio'] = stats['bytes_read'] / stats['new_bytes'] if stats['new_bytes'] else None
+
+        snapshot = {
+            'name': snapshot_name,
+            'source_path': source_path,
+            'created': time.time(),
+            'chunk_size': {'min': MIN_CHUNK_SIZE, 'avg': AVG_CHUNK_SIZE, 'max': MAX_CHUNK_SIZE},
+            'files': files,
+        }
+        snapshot_path = os.path.join(staging_dir, 'snapshots', snapshot_dir, f"{snapshot_name}.json.gz")
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        with gzip.open(snapshot_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        stats['chunking_seconds'] = time.monotonic() - started
+        return staging_dir, stats, new_rows
+
+    def _stage_chunks(self, path, chunks, staging_dir):
+        rows = []
+        with open(path, 'rb') as f:
+            for offset, length, digest in chunks:
+                f.seek(offset)
+                data = zlib.compress(f.read(length), 3)
+                chunk_path = os.path.join(staging_dir, _chunk_path(digest))
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                with open(chunk_path, 'wb') as out:
+                    out.write(data)
+                rows.append((digest, length, len(data)))
+        return rows
+
+    def commit(self, staging_dir, new_rows):
+        """Upload staged chunks and the snapshot, then record the chunks in the index"""
+        try:
+            self.target.upload_tree(staging_dir)
+            index = ChunkIndex(self.repository)
+            try:
+                index.add_many(new_rows)
+            finally:
+                index.close()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def read_chunk(self, digest):
+        """Fetch and decompress one chunk from the repository"""
+        if isinstance(self.target, DirectoryTarget):
+            with open(os.path.join(self.target.root, _chunk_path(digest)), 'rb') as f:
+                data = f.read()
+        else:
+            data = subprocess.run(["rclone", "cat", f"{self.target.remote}/{_chunk_path(digest)}"],
+                                  capture_output=True, check=True).stdout
+        return zlib.decompress(data)
+
+def format_dedup_stats(stats):
+    """One-line summary of a dedup run for the logs"""
+    ratio = stats['dedup_ratio']
+    ratio_text = 'all chunks already stored' if ratio is None else f"dedup ratio {ratio:.2f}x"
+    return (f"{stats['files']} files, {stats['chunks']} chunks, {stats['new_chunks']} new "
+            f"({stats['new_bytes'] / (1024 * 1024):.1f} MB new, "
+            f"{stats['bytes_avoided'] / (1024 * 1024):.1f} MB avoided, {ratio_text})")
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import logging
+import threading
+import http.client
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+def _default_socket():
+    host = os.environ.get("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host[len("unix://"):]
+    return "/var/run/docker.sock"
+
+DOCKER_SOCKET = _default_socket()
+
+DEFAULT_STOP_TIMEOUT = 10
+DEFAULT_HEALTH_TIMEOUT = 120
+HEALTH_POLL_INTERVAL = 0.5
+
+class DockerAPIError(Exception):
+    """Error response from the Docker Engine API"""
+
+    def __init__(self, status, message):
+        super().__init__(f"Docker API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix domain socket"""
+
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+# Stream types of the multiplexed exec/attach output
+STDOUT = 1
+STDERR = 2
+
+def _read_exact(response, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = response.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+def _demultiplex(response, chunk_size):
+    """Yield (stream, data) from a multiplexed stream of framed stdout/stderr output
+
+    Each frame is an 8 byte header (stream type, 3 padding bytes, big-endian
+    payload length) followed by the payload. Large payloads are yielded in
+    pieces of at most chunk_size bytes.
+    """
+    while True:
+        header = _read_exact(response, 8)
+        if len(header) < 8:
+            return
+        stream, length = header[0], struct.unpack('>I', header[4:])[0]
+        while length:
+            data = _read_exact(response, min(length, chunk_size))
+            if not data:
+                return
+            length -= len(data)
+            yield stream, data
+
+class DockerClient:
+    """Small Docker Engine API client with a pool of keep-alive connections
+
+    Containers are stopped and started concurrently. Dependency ordering is
+    expressed as tiers: a list of lists of container names that are started
+    tier by tier (waiting for each tier to be running and healthy) and stopped
+    in the reverse order.
+    """
+
+    def __init__(self, socket_path=None, pool_size=8, timeout=60):
+        self.socket_path = socket_path or DOCKER_SOCKET
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, self.timeout), False
+
+    def _release_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, params=None, timeout=None):
+        """Send a request and return (status, decoded JSON or raw bytes)"""
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(2):
+            conn, reused = self._get_connection()
+            conn.timeout = timeout or self.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                # A pooled keep-alive connection may have been closed by the daemon
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(conn)
+            break
+
+        if response.getheader('Content-Type', '').startswith('application/json') and data:
+            data = json.loads(data)
+        if response.status >= 400:
+            message = data.get('message', data) if isinstance(data, dict) else data
+            raise DockerAPIError(response.status, message)
+        return response.status, data
+
+    @staticmethod
+    def _container_path(name, action=''):
+        path = f"/containers/{quote(name, safe='')}"
+        return f"{path}/{action}" if action else path
+
+    def ping(self):
+        status, _ = self.request('GET', '/_ping')
+        return status == 200
+
+    def version(self):
+        return self.request('GET', '/version')[1]
+
+    def inspect(self, name):
+        return self.request('GET', self._container_path(name, 'json'))[1]
+
+    def list_containers(self, names=None, all=True):
+        """List containers in one call, optionally filtered to the given names
+
+        The API's name filter matches substrings, so callers should still
+        compare the returned Names exactly.
+        """
+        params = {'all': 1 if all else 0}
+        if names:
+            params['filters'] = json.dumps({'name': list(names)})
+        return self.request('GET', '/containers/json', params=params)[1]
+
+    def exec_stream(self, name, command, chunk_size=64 * 1024):
+        """Run a command inside a running container and yield its stdout
+
+        The output is read from the exec API's multiplexed stream as it is
+        produced, so it can be piped elsewhere without being buffered. Raises
+        DockerAPIError with the tail of stderr if the command exits non-zero.
+        """
+        if isinstance(command, str):
+            command = ["sh", "-c", command]
+        _, created = self.request('POST', self._container_path(name, 'exec'),
+                                  body={'Cmd': command, 'AttachStdout': True, 'AttachStderr': True,
+                                        'Tty': False})
+        exec_id = created['Id']
+
+        # The attached stream takes over the connection, so it gets its own
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        stderr = bytearray()
+        try:
+            conn.request('POST', f"/exec/{exec_id}/start", body=json.dumps({'Detach': False, 'Tty': False}),
+                         headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerAPIError(response.status, response.read().decode(errors='replace'))
+            for stream, data in _demultiplex(response, chunk_size):
+                if stream == STDERR:
+                    stderr += data
+                    del stderr[:-4096]
+                else:
+                    yield data
+        finally:
+            conn.close()
+
+        exit_code = self.request('GET', f"/exec/{exec_id}/json")[1].get('ExitCode')
+        if exit_code != 0:
+            message = stderr.decode(errors='replace').strip()
+            raise DockerAPIError(500, f"command in {name} exited with code {exit_code}: {message}")
+
+    def stop(self, name, timeout=DEFAULT_STOP_TIMEOUT):
+        """Stop a container, giving it timeout seconds before it is killed"""
+        logger.info(f"Stopping container: {name}")
+        # 304 means the container was already stopped
+        self.request('POST', self._container_path(name, 'stop'), params={'t': timeout},
+                     timeout=timeout + self.timeout)
+
+    def start(self, name):
+        logger.info(f"Starting container: {name}")
+        self.request('POST', self._container_path(name, 'start'))
+
+    def wait_healthy(self, name, timeout=DEFAULT_HEALTH_TIMEOUT):
+        """Wait until a container is running and, if it has a health check, healthy"""
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.inspect(name).get('State', {})
+            health = (state.get('Health') or {}).get('Status')
+            if state.get('Running') and health in (None, 'healthy'):
+                return
+            if not state.get('Running') and not state.get('Restarting'):
+                raise DockerAPIError(409, f"container {name} exited with code {state.get('ExitCode')}")
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Container {name} not healthy after {timeout}s (status: {health})")
+            time.sleep(HEALTH_POLL_INTERVAL)
+
+    def _run_parallel(self, func, names):
+        if not names:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(names), self.pool_size),
+                                thread_name_prefix='docker') as executor:
+            errors = []
+            for name, future in [(name, executor.submit(func, name)) for name in names]:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+        if errors:
+            raise DockerAPIError(500, "; ".join(errors))
+
+    def stop_containers(self, tiers, timeout=DEFAULT_STOP_TIMEOUT):
+        """Stop containers tier by tier in reverse order, each tier concurrently"""
+        for tier in reversed(tiers):
+            self._run_parallel(lambda name: self.stop(name, timeout), tier)
+
+    def start_containers(self, tiers, health_timeout=DEFAULT_HEALTH_TIMEOUT):
+        """Start containers tier by tier, each tier concurrently
+
+        With a health_timeout, every tier must be running and healthy before
+        the next one is started. Pass None to return as soon as the start
+        requests have been accepted.
+        """
+        def start(name):
+            self.start(name)
+            if health_timeout:
+                self.wait_healthy(name, health_timeout)
+
+        for tier in tiers:
+            self._run_parallel(start, tier)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_docker_client():
+    """Process-wide client, so connections are reused across backup runs"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DockerClient()
+        return _client
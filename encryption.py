@@ -0,0 +1,286 @@
+"""Client-side encryption of archives in fixed-size authenticated chunks
+
+An encrypted archive is a header followed by the archive's plaintext cut
+into CHUNK_SIZE chunks, each sealed with AES-256-GCM under a key derived
+from the project key and a random per-file salt. Chunk i starts at
+HEADER_SIZE + i * (chunk size + TAG_SIZE), so any byte range of the
+plaintext can be read and decrypted without touching the rest of the file.
+The chunk index and a final-chunk flag are authenticated with every chunk,
+so chunks cannot be reordered, dropped or the file truncated unnoticed.
+"""
+import os
+import io
+import time
+import base64
+import struct
+import hashlib
+import binascii
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+logger = logging.getLogger(__name__)
+
+# Directory holding <name>.key files for key references without a scheme
+KEY_DIR = os.environ.get("BACKUP_KEY_DIR", "/etc/bkup/keys")
+# Plaintext bytes per encrypted chunk
+CHUNK_SIZE = int(os.environ.get("BACKUP_ENCRYPTION_CHUNK_KB", "1024")) * 1024
+# Threads sealing chunks while the archive is written
+ENCRYPTION_WORKERS = int(os.environ.get("BACKUP_ENCRYPTION_WORKERS", "0")) or min(os.cpu_count() or 1, 4)
+
+MAGIC = b'BKUPAEAD'
+VERSION = 1
+KEY_SIZE = 32
+TAG_SIZE = 16
+# magic, version, chunk size, key id, salt
+_HEADER = struct.Struct('>8sB3xI8s16s')
+HEADER_SIZE = _HEADER.size
+
+class EncryptionError(Exception):
+    """An archive could not be encrypted or decrypted"""
+
+def _require_backend():
+    if AESGCM is None:
+        raise EncryptionError("Encrypted backups need the 'cryptography' package")
+
+def _decode_key(data, source):
+    """32 key bytes from raw bytes, hex or base64 text"""
+    if len(data) == KEY_SIZE:
+        return bytes(data)
+    text = data.strip()
+    for decode in (binascii.unhexlify, base64.b64decode):
+        try:
+            key = decode(text)
+        except (binascii.Error, ValueError):
+            continue
+        if len(key) == KEY_SIZE:
+            return key
+    raise EncryptionError(f"{source} does not hold a {KEY_SIZE * 8}-bit key (raw, hex or base64)")
+
+def parse_key_ref(key_ref):
+    """Split a key reference into (scheme, value)
+
+    'env:NAME' reads the key from an environment variable, 'file:/path' from
+    a file and a bare name from <KEY_DIR>/<name>.key. Raises ValueError for
+    a reference that cannot name a key.
+    """
+    key_ref = (key_ref or '').strip()
+    scheme, sep, value = key_ref.partition(':')
+    if not sep:
+        scheme, value = 'name', key_ref
+    if scheme not in ('env', 'file', 'name') or not value:
+        raise ValueError(f"Expected 'env:NAME', 'file:/path' or a key name, got {key_ref!r}")
+    if scheme == 'name' and ('/' in value or value.startswith('.')):
+        raise ValueError(f"Key name {value!r} must not contain a path")
+    return scheme, value
+
+def load_key(key_ref):
+    """The 32-byte key a project's key reference points at
+
+    Keys never go into the database, only the reference to where the backup
+    host keeps them.
+    """
+    _require_backend()
+    try:
+        scheme, value = parse_key_ref(key_ref)
+    except ValueError as e:
+        raise EncryptionError(str(e))
+    if scheme == 'env':
+        data = os.environ.get(value)
+        if not data:
+            raise EncryptionError(f"Environment variable {value} is not set")
+        return _decode_key(data.encode(), f"Environment variable {value}")
+    path = value if scheme == 'file' else os.path.join(KEY_DIR, f"{value}.key")
+    try:
+        with open(path, 'rb') as f:
+            return _decode_key(f.read(), path)
+    except OSError as e:
+        raise EncryptionError(f"Cannot read key {path}: {e}")
+
+def key_id(key):
+    """Short fingerprint stored in the header to tell a wrong key from a damaged file"""
+    return hashlib.sha256(b'bkup key id' + key).digest()[:8]
+
+def _file_cipher(key, salt):
+    _require_backend()
+    derived = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=salt, info=b'bkup archive v1').derive(key)
+    return AESGCM(derived)
+
+def _nonce(index):
+    # Unique per file key, and every file has its own key
+    return struct.pack('>4xQ', index)
+
+def _associated_data(header, index, last):
+    return header + struct.pack('>Q?', index, last)
+
+def encrypted_size(plain_size, chunk_size=CHUNK_SIZE):
+    """Size of the encrypted file for plain_size bytes of plaintext"""
+    chunks = max(-(-plain_size // chunk_size), 1)
+    return HEADER_SIZE + plain_size + chunks * TAG_SIZE
+
+def plain_size(encrypted_size, chunk_size):
+    """Size of the plaintext of an encrypted file of encrypted_size bytes"""
+    body = encrypted_size - HEADER_SIZE
+    chunks = max(-(-body // (chunk_size + TAG_SIZE)), 1)
+    return body - chunks * TAG_SIZE
+
+class EncryptingWriter:
+    """File object wrapper that encrypts everything written through it
+
+    Placed between the archive writer and its output. Full chunks are sealed
+    on a thread pool and written in order; the number of chunks in flight is
+    bounded, so memory use does not depend on the archive size. The last
+    chunk is held back until close(), which marks it as final.
+    """
+
+    def __init__(self, fileobj, key, chunk_size=CHUNK_SIZE, workers=ENCRYPTION_WORKERS):
+        salt = os.urandom(16)
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.header = _HEADER.pack(MAGIC, VERSION, chunk_size, key_id(key), salt)
+        self.cipher = _file_cipher(key, salt)
+        self.workers = workers
+        self.chunks = 0
+        self.plain_bytes = 0
+        self.bytes_written = 0
+        self.seconds = 0.0  # Time spent sealing chunks, summed over the workers
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._max_pending = workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encrypt')
+        self._closed = False
+        self._write(self.header)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def _seal(self, index, data, last):
+        started = time.perf_counter()
+        sealed = self.cipher.encrypt(_nonce(index), data, _associated_data(self.header, index, last))
+        return sealed, time.perf_counter() - started
+
+    def _emit(self, future):
+        sealed, seconds = future.result()
+        self._write(sealed)
+        self.seconds += seconds
+
+    def _submit(self, data, last):
+        self._pending.append(self._executor.submit(self._seal, self.chunks, data, last))
+        self.chunks += 1
+        while len(self._pending) > self._max_pending:
+            self._emit(self._pending.popleft())
+
+    def write(self, data):
+        self._buffer += data
+        self.plain_bytes += len(data)
+        # Keep at least one byte back: only close() knows which chunk is last
+        while len(self._buffer) > self.chunk_size:
+            chunk = bytes(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+            self._submit(chunk, False)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        """Seal the final chunk and write out every pending one; the wrapped file stays open"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit(bytes(self._buffer), True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._emit(self._pending.popleft())
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def abort(self):
+        self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        return {'chunk_size': self.chunk_size, 'chunks': self.chunks, 'plain_bytes': self.plain_bytes,
+                'bytes': self.bytes_written, 'seconds': round(self.seconds, 3), 'workers': self.workers}
+
+class Decryptor:
+    """Opens the chunks of one encrypted file given its header"""
+
+    def __init__(self, key, header):
+        if len(header) < HEADER_SIZE:
+            raise EncryptionError("Encrypted file is shorter than its header")
+        header = bytes(header[:HEADER_SIZE])
+        magic, version, chunk_size, stored_id, salt = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise EncryptionError("Not an encrypted archive")
+        if version != VERSION:
+            raise EncryptionError(f"Unsupported encryption format version {version}")
+        if stored_id != key_id(key):
+            raise EncryptionError("Archive was encrypted with a different key")
+        self.header = header
+        self.chunk_size = chunk_size
+        self.cipher = _file_cipher(key, salt)
+
+    def chunk_offset(self, index):
+        return HEADER_SIZE + index * (self.chunk_size + TAG_SIZE)
+
+    def open(self, index, sealed, last):
+        try:
+            return self.cipher.decrypt(_nonce(index), sealed, _associated_data(self.header, index, last))
+        except Exception:
+            raise EncryptionError(f"Chunk {index} failed authentication (damaged or truncated archive)")
+
+class DecryptingReader:
+    """Random access to the plaintext of an encrypted file
+
+    read_encrypted(offset, count) reads bytes of the encrypted file, e.g. a
+    remote range read; encrypted_size is its total size. Each read fetches
+    the covering chunks in one call and decrypts only those.
+    """
+
+    def __init__(self, read_encrypted, encrypted_size, key):
+        self.read_encrypted = read_encrypted
+        self.decryptor = Decryptor(key, read_encrypted(0, HEADER_SIZE))
+        self.size = plain_size(encrypted_size, self.decryptor.chunk_size)
+        self.last_chunk = max(self.size - 1, 0) // self.decryptor.chunk_size
+
+    def _sealed_length(self, index):
+        return min(self.decryptor.chunk_size, self.size - index * self.decryptor.chunk_size) + TAG_SIZE
+
+    def read(self, offset, count):
+        end = min(offset + count, self.size)
+        if end <= offset:
+            return b''
+        chunk_size = self.decryptor.chunk_size
+        first, last = offset // chunk_size, (end - 1) // chunk_size
+        start = self.decryptor.chunk_offset(first)
+        data = memoryview(self.read_encrypted(start, self.decryptor.chunk_offset(last) + self._sealed_length(last)
+                                              - start))
+        plain = bytearray()
+        for index in range(first, last + 1):
+            position = self.decryptor.chunk_offset(index) - start
+            sealed = data[position:position + self._sealed_length(index)]
+            plain += self.decryptor.open(index, sealed, index == self.last_chunk)
+        skip = offset - first * chunk_size
+        return bytes(plain[skip:skip + end - offset])
+
+def encrypt_bytes(key, data, chunk_size=CHUNK_SIZE):
+    """Encrypt a small in-memory file (e.g. an archive index) in the same format"""
+    output = io.BytesIO()
+    writer = EncryptingWriter(output, key, chunk_size=chunk_size, workers=1)
+    writer.write(data)
+    writer.close()
+    return output.getvalue()
+
+def decrypt_bytes(key, data):
+    reader = DecryptingReader(lambda offset, count: data[offset:offset + count], len(data), key)
+    return reader.read(0, reader.size)
@@ -0,0 +1,199 @@
+import os
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two progress events of one backup
+PROGRESS_INTERVAL = float(os.environ.get("BACKUP_PROGRESS_INTERVAL", "1"))
+# Events a subscriber may lag behind before the oldest are dropped
+SUBSCRIBER_QUEUE = 100
+# Topics whose latest event is kept for new subscribers
+LATEST_TOPICS = 1000
+
+def project_topic(project_id):
+    return f"project:{project_id}"
+
+def job_topic(job_id):
+    return f"job:{job_id}"
+
+class Subscription:
+    """Queue of the events published to a set of topics
+
+    Bounded: a subscriber that falls behind (e.g. a slow client) loses the
+    oldest events instead of holding up the publisher.
+    """
+
+    def __init__(self, bus, topics, maxlen=SUBSCRIBER_QUEUE):
+        self.bus = bus
+        self.topics = topics
+        self._events = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Next event, or None if there was none within timeout seconds"""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class EventBus:
+    """In-process publish/subscribe for backup progress
+
+    The latest event of every topic is kept, so a new subscriber starts with
+    the current state of a running backup.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # topic -> set of Subscriptions
+        self._latest = OrderedDict()  # topic -> last event, least recently published first
+        self._lock = threading.Lock()
+
+    def subscribe(self, *topics):
+        subscription = Subscription(self, topics)
+        with self._lock:
+            for topic in topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+            latest = [self._latest[topic] for topic in topics if topic in self._latest]
+        for event in latest:
+            subscription.put(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def publish(self, topics, event):
+        with self._lock:
+            subscribers = set()
+            for topic in topics:
+                self._latest[topic] = event
+                self._latest.move_to_end(topic)
+                subscribers |= self._subscribers.get(topic, set())
+            while len(self._latest) > LATEST_TOPICS:
+                self._latest.popitem(last=False)
+        for subscription in subscribers:
+            subscription.put(event)
+
+_bus = None
+_bus_lock = threading.Lock()
+
+def get_event_bus():
+    """Process-wide event bus, created on first use"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = EventBus()
+        return _bus
+
+class ProgressReporter:
+    """Publishes the progress of one backup run to its project and job topics
+
+    Stage changes are published immediately. archive() and upload() are
+    called from the archive loop and upload threads and publish at most once
+    per interval; between two events they cost one clock read. The ETA is
+    based on expected_bytes, the source size read by the previous run.
+    """
+
+    def __init__(self, project_id, job_id=None, expected_bytes=None, bus=None, interval=PROGRESS_INTERVAL):
+        self.topics = [project_topic(project_id)] + ([job_topic(job_id)] if job_id else [])
+        self.bus = bus or get_event_bus()
+        self.interval = interval
+        self.started = time.monotonic()
+        self.state = {
+            'project_id': project_id,
+            'job_id': job_id,
+            'stage': None,
+            'files': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'archive_rate': None,
+            'upload_bytes': 0,
+            'upload_total': None,
+            'upload_rate': None,
+            'expected_bytes': expected_bytes,
+            'eta': None,
+        }
+        self._stage_started = self.started
+        self._uploads = {}  # destination -> (bytes, total)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def _publish(self, event_type, now, **extra):
+        self._next = now + self.interval
+        event = dict(self.state, type=event_type, elapsed=round(now - self.started, 3), **extra)
+        self.bus.publish(self.topics, event)
+
+    def expect(self, expected_bytes):
+        """Set the source size the archive ETA is computed against"""
+        with self._lock:
+            self.state['expected_bytes'] = expected_bytes
+
+    def stage(self, name, message=None):
+        now = time.monotonic()
+        with self._lock:
+            if name != 'failed':
+                self.state['stage'] = name
+                self._stage_started = now
+            self._publish('failed' if name == 'failed' else 'stage', now, message=message)
+
+    def archive(self, files, bytes_read, bytes_written):
+        now = time.monotonic()
+        if now < self._next:
+            return
+        with self._lock:
+            seconds = max(now - self._stage_started, 1e-6)
+            rate = bytes_read / seconds
+            self.state.update(files=files, bytes_read=bytes_read, bytes_written=bytes_written,
+                              archive_rate=rate)
+            if self.state['stage'] == 'archive_upload':
+                # Streaming: everything written has been handed to the upload
+                self.state.update(upload_bytes=bytes_written, upload_rate=bytes_written / seconds)
+            expected = self.state['expected_bytes']
+            if expected and rate and bytes_read < expected:
+                self.state['eta'] = round((expected - bytes_read) / rate, 1)
+            else:
+                self.state['eta'] = None
+            self._publish('progress', now)
+
+    def upload(self, destination, bytes_done, total=None, rate=None):
+        now = time.monotonic()
+        with self._lock:
+            self._uploads[destination] = (bytes_done, total)
+            if now < self._next:
+                return
+            done = sum(b for b, _ in self._uploads.values())
+            totals = [t for _, t in self._uploads.values()]
+            total = sum(totals) if all(totals) else None
+            if rate is None or len(self._uploads) > 1:
+                rate = done / max(now - self._stage_started, 1e-6)
+            self.state.update(upload_bytes=done, upload_total=total, upload_rate=rate)
+            self.state['eta'] = round((total - done) / rate, 1) if total and rate and done < total else None
+            self._publish('progress', now)
+
+    def finish(self, status, message=None):
+        now = time.monotonic()
+        with self._lock:
+            self.state.update(stage=None, eta=None)
+            self._publish('finished', now, status=status, message=message)
@@ -0,0 +1,314 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import parse_bandwidth
+
+logger = logging.getLogger(__name__)
+
+# Memory each destination may buffer before it spills to disk
+FANOUT_MEMORY_BUFFER = int(os.environ.get("BACKUP_FANOUT_MEMORY_MB", "16")) * 1024 * 1024
+# Disk each destination may spill to before it is given up on (0 for no limit)
+FANOUT_MAX_SPILL = int(os.environ.get("BACKUP_FANOUT_MAX_SPILL_MB", "1024")) * 1024 * 1024
+# Attempts per destination for uploads that can be repeated
+UPLOAD_ATTEMPTS = int(os.environ.get("BACKUP_UPLOAD_ATTEMPTS", "3"))
+RETRY_DELAY = 5
+
+READ_SIZE = 1024 * 1024
+
+def split_bwlimit(bwlimit, destinations):
+    """Share an rclone --bwlimit between concurrent uploads to several destinations"""
+    budget = parse_bandwidth(bwlimit)
+    if not budget or destinations <= 1:
+        return bwlimit
+    return f"{max(budget // destinations // 1024, 1)}K"
+
+class DestinationFailed(Exception):
+    """A destination can no longer accept data"""
+
+class SpillBuffer:
+    """Single-producer, single-consumer byte buffer that spills to disk
+
+    Data stays in memory up to memory_limit bytes. Beyond that a blocking
+    write waits for the reader, while a non-blocking one appends to a
+    temporary file of at most max_spill bytes. Everything in memory is older
+    than everything in the spill file, which keeps the stream in order.
+    Buffers given the same cond share one lock, so a writer can wait for
+    whichever of them has room first.
+    """
+
+    def __init__(self, memory_limit=FANOUT_MEMORY_BUFFER, max_spill=FANOUT_MAX_SPILL, spill_dir=None, cond=None):
+        self.memory_limit = memory_limit
+        self.max_spill = max_spill
+        self.spill_dir = spill_dir
+        self.spilled_bytes = 0
+        self._memory = deque()
+        self._memory_bytes = 0
+        self._spill = None
+        self._spill_read = 0
+        self._spill_write = 0
+        self._closed = False
+        self._error = None
+        self._cond = cond or threading.Condition()
+
+    def ready(self, size):
+        """True if a write of size bytes would not wait (or would fail at once)"""
+        with self._cond:
+            return self._error is not None or not self._full(size)
+
+    def _full(self, size):
+        # A non-empty memory queue always accepts one piece, however large
+        return self._spill_write > self._spill_read or \
+            (self._memory and self._memory_bytes + size > self.memory_limit)
+
+    def write(self, data, block=True):
+        """Queue data; without block, data that does not fit in memory spills to disk"""
+        if not data:
+            return  # b'' is what read() returns at the end of the stream
+        with self._cond:
+            if block:
+                while self._error is None and self._full(len(data)):
+                    self._cond.wait()
+            if self._error is not None:
+                raise DestinationFailed(self._error)
+            if self._full(len(data)):
+                self._write_spill(data)
+            else:
+                self._memory.append(data)
+                self._memory_bytes += len(data)
+            self._cond.notify_all()
+
+    def _write_spill(self, data):
+        if self.max_spill and self._spill_write - self._spill_read + len(data) > self.max_spill:
+            raise DestinationFailed(f"spill limit of {self.max_spill} bytes reached")
+        try:
+            if self._spill is None:
+                if self.spill_dir:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                self._spill = tempfile.TemporaryFile(dir=self.spill_dir, prefix='bkup-fanout-')
+            self._spill.seek(self._spill_write)
+            self._spill.write(data)
+        except OSError as e:
+            raise DestinationFailed(f"spilling to {self.spill_dir or 'the temporary directory'} failed: {e}")
+        self._spill_write += len(data)
+        self.spilled_bytes += len(data)
+
+    def read(self):
+        """Next piece of data, or b'' once the buffer is closed and drained
+
+        Raises DestinationFailed once the buffer has failed, so a reader
+        waiting for data is woken by fail() as well as by close().
+        """
+        with self._cond:
+            while True:
+                if self._error is not None:
+                    raise DestinationFailed(self._error)
+                if self._memory:
+                    data = self._memory.popleft()
+                    self._memory_bytes -= len(data)
+                    self._cond.notify_all()
+                    return data
+                if self._spill_write > self._spill_read:
+                    self._spill.seek(self._spill_read)
+                    data = self._spill.read(min(READ_SIZE, self._spill_write - self._spill_read))
+                    self._spill_read += len(data)
+                    if self._spill_read == self._spill_write:
+                        # Drained: start over so the file does not keep growing
+                        self._spill.truncate(0)
+                        self._spill_read = self._spill_write = 0
+                        self._cond.notify_all()
+                    return data
+                if self._closed:
+                    return b''
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        """Stop accepting data and end the stream, e.g. because the reader died or the writer aborted"""
+        with self._cond:
+            self._error = str(error)
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._cond.notify_all()
+
+    def discard(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+class Destination:
+    """Per-destination state and throughput accounting of one upload"""
+
+    def __init__(self, remote_path):
+        self.remote_path = remote_path
+        self.bytes = 0
+        self.seconds = 0.0
+        self.attempts = 0
+        self.error = None
+        self.spilled_bytes = 0
+        self.method = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        mbps = self.bytes / (1024 * 1024) / self.seconds if self.seconds else None
+        return {'remote_path': self.remote_path, 'ok': self.ok, 'bytes': self.bytes,
+                'seconds': round(self.seconds, 3), 'mbps': mbps, 'attempts': self.attempts,
+                'spilled_bytes': self.spilled_bytes, 'method': self.method, 'error': self.error}
+
+class FanoutWriter:
+    """File object that streams one archive to several remotes at once
+
+    Each destination gets its own `rclone rcat` process fed from its own
+    SpillBuffer by a pump thread. The writer keeps pace with the fastest
+    destination still receiving: one that falls behind spills to disk
+    instead of stalling the others, and is detached once its spill reaches
+    the limit. A single destination never spills.
+    The writer only fails once every destination has failed.
+    """
+
+    def __init__(self, remote_paths, bwlimit=None, spill_dir=None):
+        self.destinations = [Destination(path) for path in remote_paths]
+        self._cond = threading.Condition()
+        self._buffers = [SpillBuffer(spill_dir=spill_dir, cond=self._cond) for _ in remote_paths]
+        self._threads = []
+        for destination, buffer in zip(self.destinations, self._buffers):
+            command = ["rclone", "rcat", destination.remote_path]
+            if bwlimit:
+                command += ["--bwlimit", bwlimit]
+            thread = threading.Thread(target=self._pump, args=(destination, buffer, command),
+                                      name=f"fanout-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def _pump(destination, buffer, command):
+        destination.attempts = 1
+        destination.method = 'stream'
+        started = time.monotonic()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        try:
+            while True:
+                data = buffer.read()
+                if not data:
+                    break
+                process.stdin.write(data)
+                destination.bytes += len(data)
+            process.stdin.close()
+            returncode = process.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
+        except Exception as e:
+            destination.error = str(e) or e.__class__.__name__
+            buffer.fail(destination.error)
+            process.kill()
+            process.wait()
+            logger.error(f"Streaming to {destination.remote_path} failed: {destination.error}")
+        finally:
+            destination.seconds = time.monotonic() - started
+            destination.spilled_bytes = buffer.spilled_bytes
+            # Nothing reads the buffer any more, so a blocked write must not wait for it
+            buffer.fail(destination.error or "stream already finished")
+            buffer.discard()
+
+    def _live(self):
+        return [(destination, buffer) for destination, buffer in zip(self.destinations, self._buffers)
+                if destination.error is None]
+
+    def write(self, data):
+        data = bytes(data)
+        if not data:
+            return 0
+        with self._cond:
+            live = self._live()
+            while live and not any(buffer.ready(len(data)) for _, buffer in live):
+                self._cond.wait()
+                live = self._live()
+        for destination, buffer in live:
+            try:
+                buffer.write(data, block=False)
+            except DestinationFailed as e:
+                logger.warning(f"Detaching {destination.remote_path} from the stream: {e}")
+                destination.error = destination.error or str(e)
+                buffer.fail(destination.error)
+        if all(destination.error is not None for destination in self.destinations):
+            raise DestinationFailed("; ".join(f"{d.remote_path}: {d.error}" for d in self.destinations))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Finish every upload and return the destinations"""
+        for buffer in self._buffers:
+            buffer.close()
+        for thread in self._threads:
+            thread.join()
+        return self.destinations
+
+    def abort(self):
+        for buffer in self._buffers:
+            buffer.fail("aborted")
+        for thread in self._threads:
+            thread.join()
+
+def copy_with_retry(destination, copy, attempts=UPLOAD_ATTEMPTS, retry_delay=RETRY_DELAY):
+    """Run copy() for a destination until it succeeds or attempts run out"""
+    started = time.monotonic()
+    destination.error = None
+    for attempt in range(1, attempts + 1):
+        destination.attempts += 1
+        try:
+            copy()
+            destination.error = None
+            break
+        except Exception as e:
+            destination.error = str(e) or e.__class__.__name__
+            logger.warning(f"Upload to {destination.remote_path} failed "
+                           f"(attempt {attempt}/{attempts}): {destination.error}")
+            if attempt < attempts:
+                time.sleep(retry_delay * attempt)
+    destination.seconds += time.monotonic() - started
+    return destination.ok
+
+def upload_to_all(local_path, remote_dirs, upload_file, bwlimit=None):
+    """Upload one local file to several remote directories concurrently
+
+    upload_file(local_path, remote_dir, bwlimit) performs a single upload.
+    Each destination is retried on its own. Returns the Destinations.
+    """
+    name = os.path.basename(local_path)
+    size = os.path.getsize(local_path)
+    destinations = [Destination(f"{remote_dir.rstrip('/')}/{name}") for remote_dir in remote_dirs]
+
+    def upload(destination, remote_dir):
+        destination.method = 'copy'
+        if copy_with_retry(destination, lambda: upload_file(local_path, f"{remote_dir.rstrip('/')}/", bwlimit)):
+            destination.bytes = size
+
+    with ThreadPoolExecutor(max_workers=max(len(destinations), 1), thread_name_prefix='upload') as executor:
+        for future in [executor.submit(upload, d, r) for d, r in zip(destinations, remote_dirs)]:
+            future.result()
+    return destinations
+
+def repair_from(source, destinations, size=None):
+    """Copy an uploaded archive remote-to-remote to the destinations whose stream failed"""
+    for destination in destinations:
+        if destination.ok or not source.ok:
+            continue
+        destination.method = 'copyto'
+        if copy_with_retry(destination, lambda: subprocess.run(
+                ["rclone", "copyto", source.remote_path, destination.remote_path], check=True)):
+            destination.bytes = size if size is not None else source.bytes
+            logger.info(f"Copied {source.remote_path} to {destination.remote_path} after its stream failed")
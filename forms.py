@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField, TimeField, BooleanField
-from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length
-from models import User
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, TimeField, BooleanField, SelectField, IntegerField
+from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length, NumberRange, Optional, InputRequired
+from models import User, BackupProject
+from validation import validate_project
+from encryption import parse_key_ref
 
 class LoginForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()], render_kw={"placeholder": "Email"})
@@ -26,13 +28,91 @@ class BackupProjectForm(FlaskForm):
                              render_kw={"placeholder": "Project Name"})
     folder_name = StringField('Folder Name', validators=[DataRequired(), Length(max=255)],
                             render_kw={"placeholder": "Folder Name"})
-    container_names = TextAreaField('Container Names (comma separated)', validators=[DataRequired()],
-                                  render_kw={"placeholder": "container1, container2, container3"})
+    container_names = TextAreaField('Container Names (comma separated, ";" starts a later tier)',
+                                  validators=[DataRequired()],
+                                  render_kw={"placeholder": "database; container1, container2"})
     source_path = StringField('Source Path', validators=[DataRequired(), Length(max=255)],
                             render_kw={"placeholder": "/path/to/source"})
     destination_path = StringField('Destination Path (in Google Drive)', validators=[DataRequired(), Length(max=255)],
                                  render_kw={"placeholder": "backup/path"})
     run_time = StringField('Run Time (HH:MM)', validators=[DataRequired()],
                          render_kw={"placeholder": "23:00"})
+    backup_mode = SelectField('Backup Mode', default='staged',
+                              choices=[('staged', 'Staged (zip to /BkUp, then upload)'),
+                                       ('streaming', 'Streaming (upload while archiving, no temporary zip)')])
+    backup_backend = SelectField('Backup Storage', default='archive',
+                                 choices=[('archive', 'Zip archive per run'),
+                                          ('dedup', 'Deduplicated chunk store (uploads only new data)')])
+    snapshot_method = SelectField('Container Downtime', default='',
+                                  choices=[('', 'Keep containers stopped for the whole backup'),
+                                           ('reflink', 'Snapshot (reflink copy), then restart containers'),
+                                           ('hardlink', 'Snapshot (hardlink tree), then restart containers'),
+                                           ('copy', 'Snapshot (parallel copy), then restart containers')])
+    stop_timeout = IntegerField('Container Stop Timeout (seconds)', default=10,
+                                validators=[InputRequired(), NumberRange(min=0, max=3600)])
+    health_timeout = IntegerField('Health Check Timeout (seconds)', default=120,
+                                  validators=[Optional(), NumberRange(min=1, max=3600)],
+                                  render_kw={"placeholder": "Don't wait"})
+    agent_id = SelectField('Run On', coerce=int, default=0, choices=[(0, 'This server')])
+    extra_destinations = TextAreaField('Additional Destinations (one rclone "remote:path" per line)',
+                                       validators=[Optional()],
+                                       render_kw={"placeholder": "s3:backups/app"})
+    encryption_key_ref = StringField('Encryption Key ("env:NAME", "file:/path" or key name)',
+                                     validators=[Optional(), Length(max=255)],
+                                     render_kw={"placeholder": "Don't encrypt"})
+    hot_backup_hooks = TextAreaField('Hot-Backup Hooks (one "container: command" per line)',
+                                     validators=[Optional()],
+                                     render_kw={"placeholder": "database: pg_dump -U postgres app"})
+    compression_level = IntegerField('Compression Level (0-9)', default=6,
+                                     validators=[InputRequired(), NumberRange(min=0, max=9)])
+    compression_workers = IntegerField('Compression Workers', validators=[Optional(), NumberRange(min=1, max=256)],
+                                       render_kw={"placeholder": "All CPUs"})
+    incremental_enabled = BooleanField('Incremental Backups')
+    full_backup_interval = IntegerField('Full Backup Every N Runs', default=7,
+                                        validators=[InputRequired(), NumberRange(min=1, max=365)])
+    retention_keep_last = IntegerField('Keep Last N Archives', validators=[Optional(), NumberRange(min=1, max=10000)],
+                                       render_kw={"placeholder": "Keep all"})
+    retention_daily = IntegerField('Keep Daily Archives (days)', validators=[Optional(), NumberRange(min=1, max=10000)])
+    retention_weekly = IntegerField('Keep Weekly Archives (weeks)', validators=[Optional(), NumberRange(min=1, max=10000)])
+    retention_monthly = IntegerField('Keep Monthly Archives (months)',
+                                     validators=[Optional(), NumberRange(min=1, max=10000)])
     service_enabled = BooleanField('Enable Service')
     submit = SubmitField('Save Project')
+    
+    def validate_extra_destinations(self, extra_destinations):
+        for line in (extra_destinations.data or '').splitlines():
+            if line.strip() and ':' not in line.split('/', 1)[0]:
+                raise ValidationError(f'"{line.strip()}" does not name an rclone remote (remote:path).')
+    
+    def validate_encryption_key_ref(self, encryption_key_ref):
+        if not encryption_key_ref.data:
+            return
+        try:
+            parse_key_ref(encryption_key_ref.data)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        if self.backup_backend.data == 'dedup':
+            raise ValidationError('Encryption needs the zip archive storage.')
+    
+    def validate_hot_backup_hooks(self, hot_backup_hooks):
+        try:
+            hooks = BackupProject.parse_hot_backup_hooks(hot_backup_hooks.data)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        if hooks and self.backup_backend.data == 'dedup':
+            raise ValidationError('Hot-backup hooks need the zip archive storage.')
+    
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators):
+            return False
+        if self.agent_id.data:
+            # The containers and source are on the agent's host; it checks them before every run
+            return True
+        # Check every container and the source path in one batched pass
+        names = BackupProject.parse_container_tiers(self.container_names.data)
+        hooks = BackupProject.parse_hot_backup_hooks(self.hot_backup_hooks.data)
+        problems = validate_project([c for tier in names for c in tier], self.source_path.data,
+                                    running_containers=hooks)
+        for field, message in problems.items():
+            getattr(self, field).errors.append(message)
+        return not problems
@@ -0,0 +1,146 @@
+import gzip
+import json
+import hashlib
+import logging
+import threading
+import subprocess
+from datetime import datetime
+
+from rclone_rc import get_rclone
+
+logger = logging.getLogger(__name__)
+
+# Remote hash types that can be computed locally, in order of preference
+LOCAL_HASH_TYPES = ('sha256', 'sha1', 'md5')
+
+# Verification outcomes stored on BackupRun.verify_status
+VERIFY_OK = 'ok'
+VERIFY_MISMATCH = 'mismatch'
+VERIFY_MISSING = 'missing'
+VERIFY_SIZE_ONLY = 'size_only'
+
+class HashingWriter:
+    """File object wrapper that hashes everything written through it
+
+    Used between the archive writer and its output so checksums cost no
+    second read of the archive.
+    """
+
+    def __init__(self, fileobj, hash_types=('sha256',)):
+        self.fileobj = fileobj
+        self.hashes = {name: hashlib.new(name) for name in dict.fromkeys(hash_types)}
+
+    def write(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigests(self):
+        return {name: digest.hexdigest() for name, digest in self.hashes.items()}
+
+_remote_hash_types = {}
+_remote_hash_types_lock = threading.Lock()
+
+def _remote_root(remote_path):
+    return remote_path.split(':', 1)[0] + ':'
+
+def remote_hash_type(remote_path):
+    """Preferred locally computable hash type the remote of remote_path supports, or None
+
+    The supported hashes are asked from rclone once per remote and process.
+    """
+    remote = _remote_root(remote_path)
+    with _remote_hash_types_lock:
+        if remote in _remote_hash_types:
+            return _remote_hash_types[remote]
+    try:
+        rclone = get_rclone()
+        if rclone is not None:
+            supported = rclone.call('operations/fsinfo', fs=remote).get('Hashes') or []
+        else:
+            output = subprocess.run(["rclone", "backend", "features", remote],
+                                    capture_output=True, text=True, check=True).stdout
+            supported = json.loads(output).get('Hashes') or []
+    except Exception as e:
+        logger.warning(f"Could not get the hash types supported by {remote}: {e}")
+        return None
+    hash_type = next((name for name in LOCAL_HASH_TYPES if name in supported), None)
+    with _remote_hash_types_lock:
+        _remote_hash_types[remote] = hash_type
+    return hash_type
+
+def encode_file_manifest(manifest):
+    """Compress a [[arcname, size, crc32], ...] list for storage on a BackupRun"""
+    return gzip.compress(json.dumps(manifest, separators=(',', ':')).encode(), 6)
+
+def decode_file_manifest(data):
+    return json.loads(gzip.decompress(data)) if data else []
+
+def list_remote_hashes(remote_dir, hash_type=None):
+    """{file name: (size, hash or None)} for the files directly in remote_dir
+
+    Uses rclone's listing with hashes, which the remote answers from its
+    metadata, so nothing is downloaded.
+    """
+    remote_dir = remote_dir.rstrip('/')
+    rclone = get_rclone()
+    if rclone is not None:
+        opt = {'filesOnly': True, 'noModTime': True, 'noMimeType': True, 'showHash': bool(hash_type)}
+        if hash_type:
+            opt['hashTypes'] = [hash_type]
+        items = rclone.call('operations/list', fs=remote_dir, remote='', opt=opt).get('list', [])
+    else:
+        command = ["rclone", "lsjson", "--files-only", "--no-modtime", "--no-mimetype", remote_dir]
+        if hash_type:
+            command[2:2] = ["--hash", "--hash-type", hash_type]
+        items = json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+    return {item['Name']: (item.get('Size'), (item.get('Hashes') or {}).get(hash_type))
+            for item in items}
+
+def verify_runs(runs):
+    """Check uploaded archives against the remote's own size and hash listing
+
+    Every distinct remote directory is listed once. Sets verified_at,
+    verify_status and verify_error on each run and returns the runs that
+    failed verification.
+    """
+    by_dir = {}
+    for run in runs:
+        remote_dir, _, name = run.remote_path.rpartition('/')
+        by_dir.setdefault((remote_dir, run.remote_hash_type), []).append((run, name))
+
+    failed = []
+    for (remote_dir, hash_type), entries in by_dir.items():
+        try:
+            listing = list_remote_hashes(remote_dir, hash_type)
+        except Exception as e:
+            logger.error(f"Error listing {remote_dir}: {e}")
+            listing = None
+        for run, name in entries:
+            run.verified_at = datetime.utcnow()
+            run.verify_error = None
+            if listing is None:
+                run.verify_status, run.verify_error = VERIFY_MISSING, f"Could not list {remote_dir}"
+            elif name not in listing:
+                run.verify_status, run.verify_error = VERIFY_MISSING, f"{run.remote_path} not found"
+            else:
+                size, remote_hash = listing[name]
+                if size is not None and run.archive_size is not None and size != run.archive_size:
+                    run.verify_status = VERIFY_MISMATCH
+                    run.verify_error = f"size {size} != {run.archive_size}"
+                elif run.remote_hash and remote_hash and remote_hash.lower() != run.remote_hash.lower():
+                    run.verify_status = VERIFY_MISMATCH
+                    run.verify_error = f"{hash_type} {remote_hash} != {run.remote_hash}"
+                elif run.remote_hash and remote_hash:
+                    run.verify_status = VERIFY_OK
+                else:
+                    run.verify_status = VERIFY_SIZE_ONLY
+            if run.verify_status in (VERIFY_MISMATCH, VERIFY_MISSING):
+                logger.error(f"Verification of {run.remote_path} failed: {run.verify_error}")
+                failed.append(run)
+            else:
+                logger.info(f"Verified {run.remote_path}: {run.verify_status}")
+    return failed
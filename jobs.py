@@ -0,0 +1,213 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import update, or_
+
+from app import app, db
+from models import BackupJob
+from backup_service import BackupService
+from agents import queue_agent_jobs
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of backups run at the same time by one process
+JOB_CONCURRENCY = int(os.environ.get("BACKUP_JOB_CONCURRENCY", "2"))
+# Seconds between the heartbeats an executor writes for its queued and running jobs
+JOB_HEARTBEAT_INTERVAL = int(os.environ.get("BACKUP_JOB_HEARTBEAT_INTERVAL", "15"))
+# Seconds without a heartbeat after which a local job counts as lost with its process
+JOB_HEARTBEAT_TIMEOUT = int(os.environ.get("BACKUP_JOB_HEARTBEAT_TIMEOUT", "120"))
+
+class JobExecutor:
+    """Runs backups in a thread pool and tracks them as BackupJob rows
+    
+    Every job records the executor that owns it, and a background thread
+    refreshes the heartbeat of the jobs it still holds. Jobs of a process that
+    went away (a restart, --reload or a crash) stop getting heartbeats and are
+    failed instead of blocking their project.
+    """
+    
+    def __init__(self, concurrency=JOB_CONCURRENCY):
+        self.concurrency = concurrency
+        # The random part tells a restarted worker apart from an old one with the same pid
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='backup-job')
+        self._jobs = set()  # Ids of the queued and running jobs this executor owns
+        self._lock = threading.Lock()
+        threading.Thread(target=self._send_heartbeats, name='backup-job-heartbeat', daemon=True).start()
+        with app.app_context():
+            self.reap_orphans()
+    
+    def reap_orphans(self):
+        """Fail local jobs left queued or running by an executor that is gone
+        
+        Jobs without an owner predate owners being recorded and are reaped
+        too. Agent jobs are reaped by agents.reap_stale_jobs.
+        """
+        now = datetime.utcnow()
+        table = BackupJob.__table__
+        with db.engine.begin() as conn:
+            result = conn.execute(update(table).where(
+                table.c.status.in_(BackupJob.ACTIVE_STATUSES),
+                table.c.agent_id.is_(None),
+                or_(table.c.owner.is_(None), table.c.owner != self.owner),
+                or_(table.c.heartbeat_at.is_(None),
+                    table.c.heartbeat_at < now - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT)))
+                .values(status=BackupJob.FAILED, stage=None, finished_at=now,
+                        message="The process running this job stopped before it finished"))
+        if result.rowcount:
+            logger.warning(f"Failed {result.rowcount} backup jobs left behind by stopped processes")
+        return result.rowcount
+    
+    def _send_heartbeats(self):
+        table = BackupJob.__table__
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            with self._lock:
+                job_ids = list(self._jobs)
+            if not job_ids:
+                continue
+            try:
+                with app.app_context(), db.engine.begin() as conn:
+                    conn.execute(update(table).where(table.c.id.in_(job_ids)).values(heartbeat_at=datetime.utcnow()))
+            except Exception as e:
+                logger.error(f"Error sending heartbeat for backup jobs {sorted(job_ids)}: {e}")
+    
+    def _new_job(self, project_id):
+        return BackupJob(project_id=project_id, status=BackupJob.QUEUED, owner=self.owner,
+                         heartbeat_at=datetime.utcnow())
+    
+    def _hold(self, job_ids):
+        with self._lock:
+            self._jobs.update(job_ids)
+    
+    def _release(self, job_ids):
+        with self._lock:
+            self._jobs.difference_update(job_ids)
+    
+    def submit(self, project_id):
+        """Queue a backup for a project and return its BackupJob
+        
+        If the project already has a queued or running job, that job is
+        returned instead of starting a second backup of the same data.
+        Projects pinned to an agent are only queued; their agent claims them.
+        """
+        self.reap_orphans()
+        pinned = queue_agent_jobs(db.session, [project_id])
+        if pinned:
+            return pinned[project_id]
+        
+        job = BackupJob.query.filter(BackupJob.project_id == project_id,
+                                     BackupJob.status.in_(BackupJob.ACTIVE_STATUSES)).first()
+        if job:
+            return job
+        
+        job = self._new_job(project_id)
+        db.session.add(job)
+        db.session.commit()
+        self._hold([job.id])
+        self._executor.submit(self._run, job.id, project_id)
+        logger.info(f"Queued backup job {job.id} for project {project_id}")
+        return job
+    
+    @staticmethod
+    def _update(job_id, **values):
+        # Written through the engine rather than a session, so progress updates
+        # made from inside execute_backup never flush the backup's own session
+        with db.engine.begin() as conn:
+            conn.execute(update(BackupJob.__table__).where(BackupJob.__table__.c.id == job_id).values(**values))
+    
+    def submit_batch(self, project_ids):
+        """Queue one batch run for several projects due at the same time
+        
+        Projects that share containers are stopped and started once for the
+        whole batch. Each project still gets its own BackupJob; projects that
+        already have an active job keep it and are left out of the batch.
+        Projects pinned to an agent are queued for it instead. Returns the jobs
+        by project id.
+        """
+        self.reap_orphans()
+        jobs = queue_agent_jobs(db.session, project_ids)
+        new_jobs = {}
+        for project_id in project_ids:
+            if project_id in jobs:
+                continue
+            job = BackupJob.query.filter(BackupJob.project_id == project_id,
+                                         BackupJob.status.in_(BackupJob.ACTIVE_STATUSES)).first()
+            if not job:
+                job = self._new_job(project_id)
+                db.session.add(job)
+                new_jobs[project_id] = job
+            jobs[project_id] = job
+        db.session.commit()
+        
+        if new_jobs:
+            job_ids = {project_id: job.id for project_id, job in new_jobs.items()}
+            self._hold(job_ids.values())
+            self._executor.submit(self._run_batch, job_ids)
+            logger.info(f"Queued batch backup jobs {sorted(job_ids.values())} "
+                        f"for projects {sorted(job_ids)}")
+        return jobs
+    
+    def _progress(self, job_id, errors):
+        def progress(stage, message=None):
+            if stage == 'failed':
+                errors.append(message)
+            else:
+                self._update(job_id, stage=stage)
+        return progress
+    
+    def _finish(self, job_id, success, errors):
+        self._update(job_id,
+                     status=BackupJob.SUCCEEDED if success else BackupJob.FAILED,
+                     stage=None,
+                     message=None if success else (errors[-1] if errors else "Backup failed. Check logs for details."),
+                     finished_at=datetime.utcnow())
+    
+    def _run(self, job_id, project_id):
+        with app.app_context():
+            try:
+                self._update(job_id, status=BackupJob.RUNNING, started_at=datetime.utcnow())
+                errors = []
+                success = BackupService.execute_backup(project_id, progress=self._progress(job_id, errors),
+                                                       job_id=job_id)
+                self._finish(job_id, success, errors)
+            except Exception as e:
+                logger.error(f"Error running backup job {job_id}: {e}")
+                self._update(job_id, status=BackupJob.FAILED, message=str(e), finished_at=datetime.utcnow())
+            finally:
+                self._release([job_id])
+    
+    def _run_batch(self, job_ids):
+        with app.app_context():
+            try:
+                errors = {project_id: [] for project_id in job_ids}
+                for job_id in job_ids.values():
+                    self._update(job_id, status=BackupJob.RUNNING, started_at=datetime.utcnow())
+                progress = {project_id: self._progress(job_id, errors[project_id])
+                            for project_id, job_id in job_ids.items()}
+                results = BackupService.execute_batch(list(job_ids), progress=progress, job_ids=job_ids)
+                for project_id, job_id in job_ids.items():
+                    self._finish(job_id, results.get(project_id, False), errors[project_id])
+            except Exception as e:
+                logger.error(f"Error running batch backup jobs {sorted(job_ids.values())}: {e}")
+                for job_id in job_ids.values():
+                    self._update(job_id, status=BackupJob.FAILED, message=str(e), finished_at=datetime.utcnow())
+            finally:
+                self._release(job_ids.values())
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_job_executor():
+    """Process-wide job executor, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = JobExecutor()
+        return _executor
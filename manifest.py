@@ -0,0 +1,145 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+# Sidecar state (manifests, indexes, ...) lives next to the staging area
+STATE_DIR = os.environ.get("BACKUP_STATE_DIR", "/BkUp/.state")
+
+DEFAULT_SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+class FileRecord:
+    """Stat data and content hash of one file in a manifest"""
+
+    __slots__ = ('size', 'mtime_ns', 'inode', 'sha256')
+
+    def __init__(self, size, mtime_ns, inode, sha256=None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.sha256 = sha256
+
+    def same_stat(self, other):
+        return (self.size == other.size and self.mtime_ns == other.mtime_ns
+                and self.inode == other.inode)
+
+    def to_list(self):
+        return [self.size, self.mtime_ns, self.inode, self.sha256]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+def _scan_directory(path):
+    """List one directory, returning its files with stat data and its subdirectories"""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append((entry.path, FileRecord(st.st_size, st.st_mtime_ns, st.st_ino)))
+                except OSError as e:
+                    logger.warning(f"Skipping {entry.path}: {e}")
+    except OSError as e:
+        logger.warning(f"Cannot scan directory {path}: {e}")
+    return files, subdirs
+
+def walk_tree(source_path, workers=DEFAULT_SCAN_WORKERS):
+    """Walk source_path with a pool of os.scandir workers
+
+    Every directory is listed by its own task, so deep and wide trees are
+    scanned concurrently. Returns a dict of path -> FileRecord (without hashes).
+    """
+    records = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan') as executor:
+        pending = {executor.submit(_scan_directory, source_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                records.update(files)
+                for subdir in subdirs:
+                    pending.add(executor.submit(_scan_directory, subdir))
+    return records
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def scan_tree(source_path, previous=None, workers=DEFAULT_SCAN_WORKERS):
+    """Build a manifest of source_path, reusing hashes from the previous manifest
+
+    Only files whose size, mtime or inode changed since the previous manifest
+    are read and hashed.
+    """
+    started = time.monotonic()
+    records = walk_tree(source_path, workers)
+    previous = previous or {}
+
+    to_hash = []
+    for path, record in records.items():
+        old = previous.get(path)
+        if old is not None and old.sha256 and old.same_stat(record):
+            record.sha256 = old.sha256
+        else:
+            to_hash.append(path)
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash') as executor:
+            for path, digest in zip(to_hash, executor.map(_hash_file, to_hash)):
+                records[path].sha256 = digest
+
+    logger.info(f"Scanned {len(records)} files under {source_path} in "
+                f"{time.monotonic() - started:.2f}s ({len(to_hash)} hashed)")
+    return records
+
+def diff_manifests(previous, current):
+    """Return (changed, deleted) paths between two manifests"""
+    changed = [path for path, record in current.items()
+               if path not in previous or previous[path].sha256 != record.sha256]
+    deleted = [path for path in previous if path not in current]
+    return sorted(changed), sorted(deleted)
+
+def manifest_path(project_id):
+    return os.path.join(STATE_DIR, 'manifests', f"project_{project_id}.json.gz")
+
+def load_manifest(project_id, source_path):
+    """Load the stored manifest for a project, or None if there is no usable one"""
+    path = manifest_path(project_id)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable manifest {path}: {e}")
+        return None
+
+    if data.get('source_path') != source_path:
+        logger.info(f"Source path changed since the last manifest for project {project_id}")
+        return None
+    return {p: FileRecord.from_list(values) for p, values in data['files'].items()}
+
+def save_manifest(project_id, source_path, records):
+    """Atomically replace the stored manifest for a project"""
+    path = manifest_path(project_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        'source_path': source_path,
+        'created': time.time(),
+        'files': {p: record.to_list() for p, record in records.items()},
+    }
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
@@ -0,0 +1,103 @@
+import os
+import json
+import logging
+from datetime import timezone
+
+from sqlalchemy import func
+
+from app import db
+from models import BackupProject, BackupRun
+
+logger = logging.getLogger(__name__)
+
+# Bearer token Prometheus uses to scrape /metrics without a login session
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# name -> (type, help) for every exported family
+METRIC_FAMILIES = {
+    'bkup_runs_total': ('counter', 'Backup runs by final status'),
+    'bkup_last_run_timestamp_seconds': ('gauge', 'Start time of the latest backup run'),
+    'bkup_last_success_timestamp_seconds': ('gauge', 'Finish time of the latest successful backup run'),
+    'bkup_last_run_success': ('gauge', '1 if the latest finished run succeeded, 0 if it failed'),
+    'bkup_last_duration_seconds': ('gauge', 'Total duration of the latest finished run'),
+    'bkup_last_downtime_seconds': ('gauge', 'Container stop-to-start time of the latest finished run'),
+    'bkup_last_bytes_read': ('gauge', 'Source bytes read by the latest finished run'),
+    'bkup_last_archive_bytes': ('gauge', 'Archive bytes produced by the latest finished run'),
+    'bkup_last_compression_ratio': ('gauge', 'Source to archive size ratio of the latest finished run'),
+    'bkup_last_upload_mbps': ('gauge', 'Upload throughput of the latest finished run in MB/s'),
+    'bkup_last_stage_seconds': ('gauge', 'Duration of each stage of the latest finished run'),
+    'bkup_avg_upload_mbps': ('gauge', 'Average upload throughput of successful runs in MB/s'),
+    'bkup_avg_downtime_seconds': ('gauge', 'Average container downtime of successful runs'),
+}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+def _timestamp(value):
+    # Stored as naive UTC
+    return value.replace(tzinfo=timezone.utc).timestamp() if value else None
+
+def collect_samples():
+    """Return {family: [(labels, value), ...]} aggregated per project"""
+    samples = {name: [] for name in METRIC_FAMILIES}
+    projects = {p.id: p.project_name for p in db.session.query(BackupProject.id, BackupProject.project_name)}
+
+    def add(name, project_id, value, **extra):
+        if value is None or project_id not in projects:
+            return
+        labels = {'project': projects[project_id], 'project_id': project_id, **extra}
+        samples[name].append((labels, value))
+
+    # Run counts per status
+    counts = db.session.query(BackupRun.project_id, BackupRun.status, func.count(BackupRun.id)) \
+        .group_by(BackupRun.project_id, BackupRun.status)
+    for project_id, status, count in counts:
+        if status != BackupRun.RUNNING:
+            add('bkup_runs_total', project_id, count, status=status)
+
+    # Averages over successful runs
+    averages = db.session.query(BackupRun.project_id, func.avg(BackupRun.upload_mbps),
+                                func.avg(BackupRun.downtime_seconds)) \
+        .filter(BackupRun.status == BackupRun.SUCCEEDED).group_by(BackupRun.project_id)
+    for project_id, upload_mbps, downtime in averages:
+        add('bkup_avg_upload_mbps', project_id, upload_mbps)
+        add('bkup_avg_downtime_seconds', project_id, downtime)
+
+    # Latest started run, latest success and latest finished run per project
+    latest_started = db.session.query(BackupRun.project_id, func.max(BackupRun.started_at)) \
+        .group_by(BackupRun.project_id)
+    for project_id, started_at in latest_started:
+        add('bkup_last_run_timestamp_seconds', project_id, _timestamp(started_at))
+
+    latest_success = db.session.query(BackupRun.project_id, func.max(BackupRun.finished_at)) \
+        .filter(BackupRun.status == BackupRun.SUCCEEDED).group_by(BackupRun.project_id)
+    for project_id, finished_at in latest_success:
+        add('bkup_last_success_timestamp_seconds', project_id, _timestamp(finished_at))
+
+    latest_ids = db.session.query(func.max(BackupRun.id)) \
+        .filter(BackupRun.status != BackupRun.RUNNING).group_by(BackupRun.project_id)
+    for run in BackupRun.query.filter(BackupRun.id.in_(latest_ids)):
+        add('bkup_last_run_success', run.project_id, 1 if run.status == BackupRun.SUCCEEDED else 0)
+        add('bkup_last_duration_seconds', run.project_id, run.duration_seconds)
+        add('bkup_last_downtime_seconds', run.project_id, run.downtime_seconds)
+        add('bkup_last_bytes_read', run.project_id, run.bytes_read)
+        add('bkup_last_archive_bytes', run.project_id, run.archive_size)
+        add('bkup_last_compression_ratio', run.project_id, run.compression_ratio)
+        add('bkup_last_upload_mbps', run.project_id, run.upload_mbps)
+        for stage, seconds in json.loads(run.stage_timings or '{}').items():
+            add('bkup_last_stage_seconds', run.project_id, seconds, stage=stage)
+    return samples
+
+def render_metrics():
+    """Render all backup metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, samples in collect_samples().items():
+        metric_type, help_text = METRIC_FAMILIES[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{_labels(labels)}}} {float(value)!r}")
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,7 @@
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from app import db
+from database import db
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -25,23 +25,250 @@ class BackupProject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     project_name = db.Column(db.String(100), nullable=False)
     folder_name = db.Column(db.String(255), nullable=False)
-    container_names = db.Column(db.Text, nullable=False)  # Comma-separated container names
+    container_names = db.Column(db.Text, nullable=False)  # Comma-separated, ';' separates start-order tiers
     source_path = db.Column(db.String(255), nullable=False)
     destination_path = db.Column(db.String(255), nullable=False)
     run_time = db.Column(db.String(50), nullable=False)  # Time in HH:MM format
-    service_enabled = db.Column(db.Boolean, default=False)
+    service_enabled = db.Column(db.Boolean, default=False, index=True)
+    backup_mode = db.Column(db.String(20), nullable=False, default='staged')  # 'staged' or 'streaming'
+    backup_backend = db.Column(db.String(20), nullable=False, default='archive')  # 'archive' or 'dedup'
+    compression_level = db.Column(db.Integer, nullable=False, default=6)  # 0 (store) to 9
+    compression_workers = db.Column(db.Integer, nullable=True)  # None uses every CPU
+    incremental_enabled = db.Column(db.Boolean, default=False)
+    full_backup_interval = db.Column(db.Integer, nullable=False, default=7)  # Full backup every N runs
+    runs_since_full = db.Column(db.Integer, nullable=False, default=0)
+    stop_timeout = db.Column(db.Integer, nullable=False, default=10)  # Seconds before docker kills a container
+    health_timeout = db.Column(db.Integer, nullable=True, default=120)  # Seconds to wait for healthy, None to skip
+    snapshot_method = db.Column(db.String(20), nullable=True)  # None, 'reflink', 'hardlink' or 'copy'
+    hot_backup_hooks = db.Column(db.Text, nullable=True)  # One "container: command" per line
+    extra_destinations = db.Column(db.Text, nullable=True)  # One rclone "remote:path" per line
+    encryption_key_ref = db.Column(db.String(255), nullable=True)  # 'env:NAME', 'file:/path' or key name, None for plain
+    retention_keep_last = db.Column(db.Integer, nullable=True)  # Archives kept by retention, None for no rule
+    retention_daily = db.Column(db.Integer, nullable=True)
+    retention_weekly = db.Column(db.Integer, nullable=True)
+    retention_monthly = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_backup = db.Column(db.DateTime, nullable=True)
+    schedule_changed_at = db.Column(db.DateTime, nullable=True)  # Last run_time or service_enabled edit
+    last_backup = db.Column(db.DateTime, nullable=True, index=True)
+    last_duration_seconds = db.Column(db.Float, nullable=True)
+    last_downtime_seconds = db.Column(db.Float, nullable=True)  # Container stop-to-start time
+    last_stage_timings = db.Column(db.Text, nullable=True)  # JSON: stage name -> seconds
     
     # Foreign key to User
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Agent on the Docker host that owns the containers, None to run on this server
+    agent_id = db.Column(db.Integer, db.ForeignKey('backup_agent.id', ondelete='SET NULL'), nullable=True,
+                         index=True)
+    
+    # Relationships with background backup jobs and run history
+    jobs = db.relationship('BackupJob', backref='project', lazy=True, cascade="all, delete-orphan")
+    runs = db.relationship('BackupRun', backref='project', lazy=True, cascade="all, delete-orphan")
     
     # Get container names as a list
     @property
     def containers_list(self):
-        if not self.container_names:
+        return [c for tier in self.container_tiers for c in tier]
+    
+    # Get container names grouped in start-order tiers, e.g. "db; app, worker"
+    @property
+    def container_tiers(self):
+        return self.parse_container_tiers(self.container_names)
+    
+    @staticmethod
+    def parse_container_tiers(container_names):
+        if not container_names:
             return []
-        return [c.strip() for c in self.container_names.split(',') if c.strip()]
+        tiers = []
+        for tier in container_names.split(';'):
+            names = [c.strip() for c in tier.split(',') if c.strip()]
+            if names:
+                tiers.append(names)
+        return tiers
+    
+    # Get the additional rclone destinations every archive is also uploaded to
+    @property
+    def extra_destination_list(self):
+        return [line.strip() for line in (self.extra_destinations or '').splitlines() if line.strip()]
+    
+    # Get container name -> command whose stdout is backed up while the container keeps running
+    @property
+    def hot_backup_commands(self):
+        return self.parse_hot_backup_hooks(self.hot_backup_hooks)
+    
+    @staticmethod
+    def parse_hot_backup_hooks(hot_backup_hooks):
+        hooks = {}
+        for line in (hot_backup_hooks or '').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            container, sep, command = line.partition(':')
+            if not sep or not container.strip() or not command.strip():
+                raise ValueError(f"Expected 'container: command', got {line!r}")
+            hooks[container.strip()] = command.strip()
+        return hooks
+    
+    # Get the tiers of containers that are stopped for a backup (those without a hot-backup hook)
+    @property
+    def stop_tiers(self):
+        hooked = set(self.hot_backup_commands)
+        tiers = [[c for c in tier if c not in hooked] for tier in self.container_tiers]
+        return [tier for tier in tiers if tier]
+    
+    def to_dict(self, latest_run=None):
+        return {
+            'id': self.id,
+            'project_name': self.project_name,
+            'source_path': self.source_path,
+            'destination_path': self.destination_path,
+            'run_time': self.run_time,
+            'service_enabled': self.service_enabled,
+            'backup_mode': self.backup_mode,
+            'backup_backend': self.backup_backend,
+            'agent_id': self.agent_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_backup': self.last_backup.isoformat() if self.last_backup else None,
+            'last_duration_seconds': self.last_duration_seconds,
+            'last_downtime_seconds': self.last_downtime_seconds,
+            'latest_run': latest_run.to_dict() if latest_run is not None else None,
+        }
     
     def __repr__(self):
         return f'<BackupProject {self.project_name}>'
+
+class BackupAgent(db.Model):
+    """A process on another Docker host that runs the backups of the projects pinned to it"""
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)  # sha256 of the agent's bearer token
+    hostname = db.Column(db.String(255), nullable=True)
+    concurrency = db.Column(db.Integer, nullable=False, default=1)  # Backups the agent runs at once
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, nullable=True)
+    
+    projects = db.relationship('BackupProject', backref='agent', lazy=True)
+    
+    def to_dict(self, online=None):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'hostname': self.hostname,
+            'concurrency': self.concurrency,
+            'online': online,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_seen': self.last_seen.isoformat() if self.last_seen else None,
+        }
+    
+    def __repr__(self):
+        return f'<BackupAgent {self.name}>'
+
+class BackupJob(db.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('backup_project.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    stage = db.Column(db.String(50), nullable=True)  # Current step of a running backup
+    message = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    agent_id = db.Column(db.Integer, db.ForeignKey('backup_agent.id', ondelete='SET NULL'), nullable=True,
+                         index=True)  # Agent running the job, None on this server
+    owner = db.Column(db.String(100), nullable=True)  # Process running a local job, see jobs.JobExecutor
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # Last sign of life from the process or agent running the job
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'project_id': self.project_id,
+            'agent_id': self.agent_id,
+            'status': self.status,
+            'stage': self.stage,
+            'message': self.message,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+    
+    def __repr__(self):
+        return f'<BackupJob {self.id} {self.status}>'
+
+class BackupRun(db.Model):
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    
+    # Timed stages recorded in their own columns -> StageTimer stage names
+    STAGE_COLUMNS = {
+        'stop': ('stop_containers',),
+        'archive': ('archive', 'archive_upload'),
+        'upload': ('upload', 'archive_upload'),
+        'start': ('start_containers',),
+    }
+    
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('backup_project.id'), nullable=False, index=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('backup_job.id', ondelete='SET NULL'), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default=RUNNING)
+    error = db.Column(db.Text, nullable=True)
+    archive_name = db.Column(db.String(255), nullable=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Start and end of each stage
+    stop_started_at = db.Column(db.DateTime, nullable=True)
+    stop_finished_at = db.Column(db.DateTime, nullable=True)
+    archive_started_at = db.Column(db.DateTime, nullable=True)
+    archive_finished_at = db.Column(db.DateTime, nullable=True)
+    upload_started_at = db.Column(db.DateTime, nullable=True)
+    upload_finished_at = db.Column(db.DateTime, nullable=True)
+    start_started_at = db.Column(db.DateTime, nullable=True)
+    start_finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Throughput and downtime
+    bytes_read = db.Column(db.BigInteger, nullable=True)
+    archive_size = db.Column(db.BigInteger, nullable=True)
+    upload_mbps = db.Column(db.Float, nullable=True)
+    duration_seconds = db.Column(db.Float, nullable=True)
+    downtime_seconds = db.Column(db.Float, nullable=True)  # Container stop-to-start time
+    stage_timings = db.Column(db.Text, nullable=True)  # JSON: stage name -> seconds, including waits
+    details = db.Column(db.Text, nullable=True)  # JSON: backend specific statistics
+    
+    # Integrity, computed while the archive was written
+    remote_path = db.Column(db.String(1024), nullable=True)  # e.g. gdrive:dest/name.zip
+    sha256 = db.Column(db.String(64), nullable=True)
+    remote_hash_type = db.Column(db.String(20), nullable=True)  # Hash the remote reports, e.g. 'md5'
+    remote_hash = db.Column(db.String(128), nullable=True)
+    file_manifest = db.Column(db.LargeBinary, nullable=True)  # gzip JSON: [[arcname, size, crc32], ...]
+    index_path = db.Column(db.String(1024), nullable=True)  # Entry offsets for range-read restores
+    encryption_key_ref = db.Column(db.String(255), nullable=True)  # Key the archive was encrypted with
+    verified_at = db.Column(db.DateTime, nullable=True)
+    verify_status = db.Column(db.String(20), nullable=True)  # 'ok', 'size_only', 'mismatch' or 'missing'
+    verify_error = db.Column(db.Text, nullable=True)
+    pruned_at = db.Column(db.DateTime, nullable=True)  # Archive deleted by the retention policy
+    
+    @property
+    def compression_ratio(self):
+        if not self.bytes_read or not self.archive_size:
+            return None
+        return self.bytes_read / self.archive_size
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_seconds': self.duration_seconds,
+            'archive_size': self.archive_size,
+        }
+    
+    def __repr__(self):
+        return f'<BackupRun {self.id} {self.status}>'
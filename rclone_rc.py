@@ -0,0 +1,188 @@
+import os
+import time
+import json
+import atexit
+import base64
+import socket
+import logging
+import secrets
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# "" runs one rclone process per upload, "managed" starts and reuses a local
+# `rclone rcd`, anything else is the URL of an already running rcd
+RCLONE_RC = os.environ.get("BACKUP_RCLONE_RC", "")
+RCLONE_RC_USER = os.environ.get("BACKUP_RCLONE_RC_USER", "")
+RCLONE_RC_PASS = os.environ.get("BACKUP_RCLONE_RC_PASS", "")
+
+# Tunables for uploads run through the daemon
+RCLONE_TRANSFERS = int(os.environ.get("BACKUP_RCLONE_TRANSFERS", "4"))
+RCLONE_CHUNK_SIZE = os.environ.get("BACKUP_RCLONE_CHUNK_SIZE", "64M")
+
+POLL_INTERVAL = 1.0
+
+class RcloneRCError(Exception):
+    """Error returned by the rclone remote-control API"""
+
+class RcloneRC:
+    """Client for rclone's remote-control HTTP API"""
+
+    def __init__(self, url, user=None, password=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._auth = None
+        if user:
+            token = base64.b64encode(f"{user}:{password or ''}".encode()).decode()
+            self._auth = f"Basic {token}"
+
+    def call(self, method, **params):
+        """Call an rc method and return its JSON response"""
+        request = urllib.request.Request(f"{self.url}/{method}", data=json.dumps(params).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        if self._auth:
+            request.add_header('Authorization', self._auth)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise RcloneRCError(f"{method}: {message}") from e
+
+    def start_job(self, method, **params):
+        """Start an rc method asynchronously and return its job id"""
+        return self.call(method, _async=True, **params)['jobid']
+
+    def job_progress(self, jobid):
+        """Transfer statistics (bytes, speed, eta, ...) of a running job"""
+        return self.call('core/stats', group=f"job/{jobid}")
+
+    def wait_job(self, jobid, on_progress=None, poll_interval=POLL_INTERVAL):
+        """Poll a job until it finishes, raising RcloneRCError if it failed"""
+        while True:
+            status = self.call('job/status', jobid=jobid)
+            if on_progress is not None:
+                on_progress(self.job_progress(jobid))
+            if status.get('finished'):
+                if not status.get('success'):
+                    raise RcloneRCError(status.get('error') or f"job {jobid} failed")
+                return status
+            time.sleep(poll_interval)
+
+    def copy_file(self, local_path, remote_dir, on_progress=None, transfers=None):
+        """Upload one local file into remote_dir and wait for it"""
+        jobid = self.start_job('operations/copyfile',
+                               srcFs=os.path.dirname(os.path.abspath(local_path)),
+                               srcRemote=os.path.basename(local_path),
+                               dstFs=remote_dir.rstrip('/'),
+                               dstRemote=os.path.basename(local_path),
+                               _config={'Transfers': transfers or RCLONE_TRANSFERS})
+        return self.wait_job(jobid, on_progress)
+
+    def copy_dir(self, local_dir, remote_dir, on_progress=None, transfers=None):
+        """Copy a directory tree to a remote without listing the destination first"""
+        jobid = self.start_job('sync/copy', srcFs=local_dir, dstFs=remote_dir.rstrip('/'),
+                               _config={'Transfers': transfers or RCLONE_TRANSFERS, 'NoTraverse': True})
+        return self.wait_job(jobid, on_progress)
+
+    def list_remotes(self):
+        """Configured remote names, with the trailing colon like `rclone listremotes`"""
+        return [f"{name}:" for name in self.call('config/listremotes').get('remotes', [])]
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class RcloneDaemon:
+    """One long-lived `rclone rcd` shared by every upload in this process
+
+    Start-up, config parsing and OAuth token refresh happen once instead of
+    for every backup. The global upload bandwidth budget is applied to the
+    daemon, so rclone divides it between whatever transfers are active.
+    """
+
+    def __init__(self, bwlimit=None):
+        self.bwlimit = bwlimit
+        self.process = None
+        self.client = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the daemon if it is not running and return a client for it"""
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                return self.client
+
+            port = _free_port()
+            user = 'bkup'
+            password = secrets.token_urlsafe(24)
+            command = ["rclone", "rcd", f"--rc-addr=127.0.0.1:{port}"]
+            if self.bwlimit:
+                command.append(f"--bwlimit={self.bwlimit}")
+            # Credentials go through the environment: unlike the command line,
+            # /proc/<pid>/environ is only readable by the daemon's own user
+            env = dict(os.environ, RCLONE_DRIVE_CHUNK_SIZE=RCLONE_CHUNK_SIZE,
+                       RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+            self.process = subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL)
+            self.client = RcloneRC(f"http://127.0.0.1:{port}", user, password)
+
+            deadline = time.monotonic() + 15
+            while True:
+                try:
+                    self.client.call('rc/noop')
+                    break
+                except (OSError, RcloneRCError):
+                    if self.process.poll() is not None or time.monotonic() > deadline:
+                        self.stop()
+                        raise RcloneRCError("rclone rcd failed to start")
+                    time.sleep(0.1)
+            logger.info(f"Started rclone rcd on port {port} (pid {self.process.pid})")
+            return self.client
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+_daemon = None
+_daemon_lock = threading.Lock()
+
+def get_rclone():
+    """rc client configured by BACKUP_RCLONE_RC, or None to use plain rclone processes"""
+    global _daemon
+    if not RCLONE_RC:
+        return None
+    if RCLONE_RC != 'managed':
+        return RcloneRC(RCLONE_RC, RCLONE_RC_USER, RCLONE_RC_PASS)
+    with _daemon_lock:
+        if _daemon is None:
+            from admission import UPLOAD_BWLIMIT
+            _daemon = RcloneDaemon(bwlimit=UPLOAD_BWLIMIT or None)
+            # Short-lived processes (runner.py, agent.py) must not leave the daemon behind
+            atexit.register(_daemon.stop)
+    return _daemon.ensure_started()
+
+def log_progress(label, interval=10):
+    """on_progress callback that logs transfer statistics every interval seconds"""
+    last = [0.0]
+
+    def on_progress(stats):
+        now = time.monotonic()
+        if now - last[0] < interval:
+            return
+        last[0] = now
+        speed = stats.get('speed', 0) / (1024 * 1024)
+        logger.info(f"{label}: {stats.get('bytes', 0) / (1024 * 1024):.1f} MB uploaded "
+                    f"({speed:.1f} MB/s, eta {stats.get('eta')}s)")
+    return on_progress
@@ -0,0 +1,343 @@
+import os
+import io
+import gzip
+import json
+import zlib
+import logging
+import zipfile
+import subprocess
+
+from manifest import STATE_DIR
+from compression import ZIP_STORED, ZIP_DEFLATED
+from encryption import load_key, encrypt_bytes, decrypt_bytes, DecryptingReader, EncryptionError
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+INDEX_CACHE_DIR = os.path.join(STATE_DIR, 'indexes')
+
+# Entries closer together than this are fetched in one range read
+COALESCE_GAP = 1024 * 1024
+# Largest single range read; bigger entries are streamed in pieces of this size
+MAX_RANGE_SIZE = 16 * 1024 * 1024
+# Read-ahead of the remote file used when an archive has no index
+REMOTE_READ_SIZE = 1024 * 1024
+
+class RestoreError(Exception):
+    """A file could not be restored from an archive"""
+
+def index_path_for(remote_path):
+    """Remote path of the index uploaded next to an archive"""
+    return f"{remote_path}.index.json.gz"
+
+def build_index(entries, archive_size):
+    """Serializable index of every member of an archive written by ParallelZipWriter"""
+    return {
+        'version': INDEX_VERSION,
+        'archive_size': archive_size,
+        'entries': [{
+            'name': entry.arcname,
+            'is_dir': entry.is_dir,
+            'method': entry.method,
+            'data_offset': entry.data_offset,
+            'compress_size': entry.compress_size,
+            'size': entry.file_size,
+            'crc': entry.crc,
+            'mode': entry.mode,
+            'mtime': entry.mtime,
+        } for entry in entries],
+    }
+
+def encode_index(index):
+    return gzip.compress(json.dumps(index, separators=(',', ':')).encode(), 6)
+
+def upload_index(index, remote_path, encryption_key=None):
+    """Upload an archive's index next to it and return the index's remote path
+
+    The index names every file, so it is encrypted like the archive when an
+    encryption_key is given.
+    """
+    path = index_path_for(remote_path)
+    data = encode_index(index)
+    if encryption_key:
+        data = encrypt_bytes(encryption_key, data)
+    subprocess.run(["rclone", "rcat", path], input=data, check=True)
+    return path
+
+def read_range(remote_path, offset, count):
+    """Read count bytes at offset from a remote file without downloading the rest"""
+    if count <= 0:
+        return b''
+    data = subprocess.run(["rclone", "cat", "--offset", str(offset), "--count", str(count), remote_path],
+                          capture_output=True, check=True).stdout
+    if len(data) != count:
+        raise RestoreError(f"Short read of {remote_path}: {len(data)} of {count} bytes at {offset}")
+    return data
+
+def archive_reader(run):
+    """(read(offset, count), size) of the plaintext of a run's archive
+
+    Plain archives are read with rclone range reads. Encrypted archives are
+    decrypted with the run's key, fetching and opening only the chunks that
+    cover each read.
+    """
+    if not run.remote_path:
+        raise RestoreError(f"Run {run.id} has no uploaded archive")
+
+    def read_remote(offset, count):
+        return read_range(run.remote_path, offset, count)
+    if not run.encryption_key_ref:
+        return read_remote, run.archive_size
+    if not run.archive_size:
+        raise RestoreError(f"Run {run.id} is encrypted but has no recorded archive size")
+    try:
+        reader = DecryptingReader(read_remote, run.archive_size, load_key(run.encryption_key_ref))
+    except EncryptionError as e:
+        raise RestoreError(f"Cannot decrypt {run.remote_path}: {e}")
+
+    def read_decrypted(offset, count):
+        try:
+            return reader.read(offset, count)
+        except EncryptionError as e:
+            raise RestoreError(f"Cannot decrypt {run.remote_path}: {e}")
+    return read_decrypted, reader.size
+
+class RemoteFile(io.RawIOBase):
+    """Read-only seekable view of a remote file through range reads
+
+    read(offset, count) fetches a byte range, e.g. from archive_reader().
+    """
+
+    def __init__(self, read, size, read_size=REMOTE_READ_SIZE):
+        self.read_range = read
+        self.size = size
+        self.read_size = read_size
+        self._position = 0
+        self._buffer = b''
+        self._buffer_offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self._position + size, self.size)
+        if end <= self._position:
+            return b''
+        start = self._position
+        buffered_end = self._buffer_offset + len(self._buffer)
+        if not (self._buffer_offset <= start and end <= buffered_end):
+            count = min(max(end - start, self.read_size), self.size - start)
+            self._buffer = self.read_range(start, count)
+            self._buffer_offset = start
+        data = self._buffer[start - self._buffer_offset:end - self._buffer_offset]
+        self._position = end
+        return data
+
+def index_from_central_directory(read, size):
+    """Build an index for an archive that has none by reading its central directory
+
+    read and size are those of archive_reader(). Only the end of the archive
+    and one local header per entry are read.
+    """
+    entries = []
+    with zipfile.ZipFile(RemoteFile(read, size)) as archive:
+        for info in archive.infolist():
+            # Locate the data by reading the entry's local header
+            archive.fp.seek(info.header_offset)
+            header = archive.fp.read(zipfile.sizeFileHeader)
+            name_length = int.from_bytes(header[26:28], 'little')
+            extra_length = int.from_bytes(header[28:30], 'little')
+            entries.append({
+                'name': info.filename,
+                'is_dir': info.is_dir(),
+                'method': info.compress_type,
+                'data_offset': info.header_offset + zipfile.sizeFileHeader + name_length + extra_length,
+                'compress_size': info.compress_size,
+                'size': info.file_size,
+                'crc': info.CRC,
+                'mode': info.external_attr >> 16,
+                'mtime': None,
+            })
+    return {'version': INDEX_VERSION, 'archive_size': size, 'entries': entries}
+
+def load_index(run):
+    """Index of a run's archive, from the local cache, the remote sidecar or the archive itself"""
+    if not run.remote_path:
+        raise RestoreError(f"Run {run.id} has no uploaded archive")
+    cache_path = os.path.join(INDEX_CACHE_DIR, f"run_{run.id}.json.gz")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    try:
+        data = subprocess.run(["rclone", "cat", run.index_path or index_path_for(run.remote_path)],
+                              capture_output=True, check=True).stdout
+        if run.encryption_key_ref:
+            data = decrypt_bytes(load_key(run.encryption_key_ref), data)
+        index = json.loads(gzip.decompress(data))
+    except (subprocess.CalledProcessError, OSError, ValueError, EncryptionError) as e:
+        logger.warning(f"No usable index for {run.remote_path} ({e}), reading its central directory")
+        if not run.archive_size:
+            raise RestoreError(f"Run {run.id} has no index and no recorded archive size")
+        index = index_from_central_directory(*archive_reader(run))
+
+    # Archives never change once uploaded, so the index can be cached for good
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_index(index))
+    os.replace(tmp_path, cache_path)
+    return index
+
+def list_directory(index, prefix=''):
+    """Immediate children of prefix in an archive index, like `ls`
+
+    Returns a sorted list of {'name', 'path', 'is_dir', 'size'}.
+    """
+    prefix = prefix.strip('/')
+    base = f"{prefix}/" if prefix else ''
+    children = {}
+    for entry in index['entries']:
+        name = entry['name'].rstrip('/')
+        if not name.startswith(base) or name == prefix:
+            continue
+        child, _, rest = name[len(base):].partition('/')
+        is_dir = bool(rest) or entry['is_dir']
+        if child not in children or is_dir:
+            children[child] = {'name': child, 'path': base + child, 'is_dir': is_dir,
+                               'size': None if is_dir else entry['size']}
+    return sorted(children.values(), key=lambda item: (not item['is_dir'], item['name']))
+
+def select_entries(index, paths):
+    """File entries that are one of paths or lie under one of them"""
+    prefixes = [path.strip('/') for path in paths]
+    selected = []
+    for entry in index['entries']:
+        if entry['is_dir']:
+            continue
+        name = entry['name']
+        if any(name == prefix or name.startswith(f"{prefix}/") or not prefix for prefix in prefixes):
+            selected.append(entry)
+    return selected
+
+def _coalesce(entries):
+    """Group entries (sorted by offset) whose data can be fetched in one range read
+
+    Returns [(start, end, entries)]. Entries larger than MAX_RANGE_SIZE get a
+    group of their own and are streamed in pieces.
+    """
+    groups = []
+    for entry in sorted(entries, key=lambda e: e['data_offset']):
+        start, end = entry['data_offset'], entry['data_offset'] + entry['compress_size']
+        if groups and entry['compress_size'] <= MAX_RANGE_SIZE:
+            group_start, group_end, members = groups[-1]
+            if start - group_end <= COALESCE_GAP and end - group_start <= MAX_RANGE_SIZE:
+                members.append(entry)
+                groups[-1] = (group_start, max(group_end, end), members)
+                continue
+        groups.append((start, end, [entry]))
+    return groups
+
+def _decode(entry, pieces):
+    """Decompress an entry's raw data pieces, checking size and CRC at the end"""
+    if entry['method'] == ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif entry['method'] != ZIP_STORED:
+        raise RestoreError(f"Unsupported compression method {entry['method']} for {entry['name']}")
+    crc = 0
+    size = 0
+    for piece in pieces:
+        content = decompressor.decompress(piece) if entry['method'] == ZIP_DEFLATED else piece
+        crc = zlib.crc32(content, crc)
+        size += len(content)
+        yield content
+    if entry['method'] == ZIP_DEFLATED:
+        content = decompressor.flush()
+        crc = zlib.crc32(content, crc)
+        size += len(content)
+        yield content
+    if crc != entry['crc'] or size != entry['size']:
+        raise RestoreError(f"Checksum mismatch restoring {entry['name']}")
+
+def _ranges(read, start, end):
+    for offset in range(start, end, MAX_RANGE_SIZE):
+        yield read(offset, min(MAX_RANGE_SIZE, end - offset))
+
+def iter_entry_contents(read, entries):
+    """Yield (entry, chunks) for entries, fetching only their byte ranges
+
+    read is the range reader of the archive, see archive_reader().
+
+    chunks is an iterable of decompressed content that must be consumed
+    before the next entry is taken.
+    """
+    for start, end, members in _coalesce(entries):
+        if len(members) == 1 and members[0]['compress_size'] > MAX_RANGE_SIZE:
+            yield members[0], _decode(members[0], _ranges(read, start, end))
+            continue
+        data = read(start, end - start)
+        for entry in members:
+            offset = entry['data_offset'] - start
+            yield entry, _decode(entry, [data[offset:offset + entry['compress_size']]])
+
+def find_file(index, path):
+    """The index entry of one file"""
+    path = path.strip('/')
+    for entry in index['entries']:
+        if entry['name'] == path and not entry['is_dir']:
+            return entry
+    raise RestoreError(f"{path} is not in the archive")
+
+def iter_file(run, path):
+    """Stream the content of one file of a run's archive"""
+    entry = find_file(load_index(run), path)
+    read, _ = archive_reader(run)
+    _, chunks = next(iter_entry_contents(read, [entry]))
+    yield from chunks
+
+def restore_paths(run, paths, target_dir):
+    """Restore files and subtrees of a run's archive below target_dir
+
+    Archive names are kept relative to target_dir (so /srv/app/conf.yml is
+    restored to <target_dir>/srv/app/conf.yml). Returns {files, bytes,
+    range_reads}.
+    """
+    index = load_index(run)
+    entries = select_entries(index, paths)
+    if not entries:
+        raise RestoreError(f"Nothing matching {', '.join(paths)} in the archive of run {run.id}")
+
+    read, _ = archive_reader(run)
+    target_dir = os.path.abspath(target_dir)
+    stats = {'files': 0, 'bytes': 0, 'range_reads': len(_coalesce(entries))}
+    for entry, chunks in iter_entry_contents(read, entries):
+        destination = os.path.abspath(os.path.join(target_dir, entry['name']))
+        if os.path.commonpath([destination, target_dir]) != target_dir:
+            raise RestoreError(f"Refusing to restore {entry['name']} outside {target_dir}")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as f:
+            for content in chunks:
+                f.write(content)
+        if entry['mode'] & 0o7777:
+            os.chmod(destination, entry['mode'] & 0o7777)
+        if entry['mtime']:
+            os.utime(destination, (entry['mtime'], entry['mtime']))
+        stats['files'] += 1
+        stats['bytes'] += entry['size']
+    logger.info(f"Restored {stats['files']} files ({stats['bytes']} bytes) from {run.remote_path} "
+                f"to {target_dir} with {stats['range_reads']} range reads")
+    return stats
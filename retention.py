@@ -0,0 +1,192 @@
+import os
+import re
+import logging
+import tempfile
+import subprocess
+from datetime import datetime
+
+from integrity import list_remote_hashes
+from restore import index_path_for
+
+logger = logging.getLogger(__name__)
+
+# Niceness the prune job lowers itself to, so it never competes with backups
+PRUNE_NICE = int(os.environ.get("BACKUP_PRUNE_NICE", "10"))
+
+ARCHIVE_TIMESTAMP = "%Y-%m-%d_%H-%M-%S"
+
+class Archive:
+    """One archive of a project found in a remote listing"""
+
+    def __init__(self, name, size, timestamp, incremental):
+        self.name = name
+        self.size = size
+        self.timestamp = timestamp
+        self.incremental = incremental
+
+    def to_dict(self):
+        return {'name': self.name, 'size': self.size, 'timestamp': self.timestamp.isoformat(),
+                'incremental': self.incremental}
+
+class RetentionPolicy:
+    """Keep-last-N and daily/weekly/monthly (grandfather-father-son) rotation
+
+    An archive is kept if any rule keeps it. A rule keeping N periods keeps
+    the newest archive of each of the N most recent periods that have one.
+    """
+
+    def __init__(self, keep_last=None, daily=None, weekly=None, monthly=None):
+        self.keep_last = keep_last or 0
+        self.daily = daily or 0
+        self.weekly = weekly or 0
+        self.monthly = monthly or 0
+
+    @classmethod
+    def from_project(cls, project):
+        return cls(project.retention_keep_last, project.retention_daily,
+                   project.retention_weekly, project.retention_monthly)
+
+    @property
+    def enabled(self):
+        return any((self.keep_last, self.daily, self.weekly, self.monthly))
+
+    def to_dict(self):
+        return {'keep_last': self.keep_last, 'daily': self.daily, 'weekly': self.weekly,
+                'monthly': self.monthly}
+
+    def select(self, archives):
+        """Names of the archives the rules keep, with the reasons for each"""
+        rules = [('last', self.keep_last, lambda ts: None),
+                 ('daily', self.daily, lambda ts: ts.date()),
+                 ('weekly', self.weekly, lambda ts: ts.isocalendar()[:2]),
+                 ('monthly', self.monthly, lambda ts: (ts.year, ts.month))]
+        kept = {}
+        for reason, count, period in rules:
+            seen = set()
+            for archive in sorted(archives, key=lambda a: a.timestamp, reverse=True):
+                if len(seen) >= count:
+                    break
+                key = archive.name if reason == 'last' else period(archive.timestamp)
+                if key not in seen:
+                    seen.add(key)
+                    kept.setdefault(archive.name, []).append(reason)
+        return kept
+
+def parse_archives(project_name, names):
+    """Archives of project_name among the file names of a listing, oldest first
+
+    names maps file names to sizes. Files not named like the project's
+    archives (indexes, other projects, anything else) are ignored.
+    """
+    pattern = re.compile(rf"^{re.escape(project_name)}_Backup_(\d{{4}}-\d{{2}}-\d{{2}}_\d{{2}}-\d{{2}}-\d{{2}})"
+                         r"(_incremental)?\.zip$")
+    archives = []
+    for name, size in names.items():
+        match = pattern.match(name)
+        if match:
+            timestamp = datetime.strptime(match.group(1), ARCHIVE_TIMESTAMP)
+            archives.append(Archive(name, size, timestamp, bool(match.group(2))))
+    return sorted(archives, key=lambda a: a.timestamp)
+
+def _chain_dependencies(archives, kept):
+    """Extend kept with everything the kept incrementals need for a restore
+
+    An incremental archive only holds the changes since the previous run, so
+    restoring it needs its full archive and every incremental in between.
+    """
+    chain = []
+    for archive in archives:
+        if not archive.incremental:
+            chain = []
+        chain.append(archive)
+        if archive.incremental and archive.name in kept:
+            for dependency in chain[:-1]:
+                reasons = kept.setdefault(dependency.name, [])
+                if 'chain' not in reasons:
+                    reasons.append('chain')
+
+def plan_directory(project_name, policy, listing, protected=()):
+    """Decide which archives in one remote directory to keep and delete
+
+    listing is {file name: (size, hash)} as returned by list_remote_hashes;
+    protected names (archives of runs still in progress) are always kept.
+    Returns {'keep': [...], 'delete': [...], 'delete_files': [...],
+    'delete_bytes'}; delete_files adds the archives' index sidecars.
+    """
+    archives = parse_archives(project_name, {name: size for name, (size, _) in listing.items()})
+    kept = policy.select(archives)
+    for name in protected:
+        kept.setdefault(name, []).append('running')
+    _chain_dependencies(archives, kept)
+
+    keep = [dict(archive.to_dict(), reasons=kept[archive.name]) for archive in archives if archive.name in kept]
+    delete = [archive for archive in archives if archive.name not in kept]
+    delete_files = []
+    for archive in delete:
+        delete_files.append(archive.name)
+        index_name = index_path_for(archive.name)
+        if index_name in listing:
+            delete_files.append(index_name)
+    return {
+        'keep': keep,
+        'delete': [archive.to_dict() for archive in delete],
+        'delete_files': delete_files,
+        'delete_bytes': sum(archive.size or 0 for archive in delete),
+    }
+
+def delete_files(remote_dir, names):
+    """Delete files directly in remote_dir with one rclone call"""
+    if not names:
+        return
+    with tempfile.NamedTemporaryFile('w', prefix='bkup-prune-', suffix='.txt') as f:
+        f.write(''.join(f"{name}\n" for name in names))
+        f.flush()
+        subprocess.run(["rclone", "delete", "--files-from-raw", f.name, "--max-depth", "1", remote_dir],
+                       check=True)
+
+def prune_project(project, runs, remote_dirs, dry_run=False):
+    """Apply a project's retention policy to every directory it uploads to
+
+    Each directory is listed once and its expired archives are deleted in one
+    batched call. runs are the project's BackupRun records: archives of
+    running backups are never deleted, and runs whose primary archive was
+    deleted get pruned_at set. Returns a report with the plan per directory.
+    """
+    policy = RetentionPolicy.from_project(project)
+    report = {'project_id': project.id, 'project_name': project.project_name,
+              'policy': policy.to_dict(), 'dry_run': dry_run, 'destinations': []}
+    if not policy.enabled:
+        return report
+    if project.backup_backend == 'dedup':
+        report['skipped'] = 'deduplicated storage shares chunks between snapshots'
+        return report
+
+    protected = {f"{run.archive_name}.zip" for run in runs if run.status == run.RUNNING and run.archive_name}
+    deleted_paths = set()
+    for remote_dir in remote_dirs:
+        plan = {'remote_dir': remote_dir}
+        try:
+            plan.update(plan_directory(project.project_name, policy, list_remote_hashes(remote_dir), protected))
+            if not dry_run and plan['delete_files']:
+                delete_files(remote_dir, plan['delete_files'])
+                deleted_paths.update(f"{remote_dir}/{archive['name']}" for archive in plan['delete'])
+            logger.info(f"{'Would prune' if dry_run else 'Pruned'} {len(plan['delete'])} archives "
+                        f"({plan['delete_bytes'] / (1024 * 1024):.1f} MB) from {remote_dir}, "
+                        f"keeping {len(plan['keep'])}")
+        except Exception as e:
+            logger.error(f"Error pruning {remote_dir}: {e}")
+            plan['error'] = str(e)
+        report['destinations'].append(plan)
+
+    now = datetime.utcnow()
+    for run in runs:
+        if run.remote_path in deleted_paths:
+            run.pruned_at = now
+    return report
+
+def lower_priority(niceness=PRUNE_NICE):
+    """Lower this process's (and its rclone children's) CPU priority"""
+    try:
+        os.nice(niceness)
+    except OSError as e:
+        logger.warning(f"Could not lower process priority: {e}")
@@ -1,16 +1,102 @@
 import os
+import hmac
+import json
+import time
+import threading
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, jsonify
+from flask import render_template, flash, redirect, url_for, request, jsonify, Response
 from flask_login import login_user, logout_user, login_required, current_user
 from urllib.parse import urlparse
-from app import app, db
-from models import User, BackupProject
+from sqlalchemy import func, select
+from app import app, db, user_cache
+from models import User, BackupProject, BackupJob, BackupRun, BackupAgent
 from forms import LoginForm, RegistrationForm, BackupProjectForm
 from backup_service import BackupService
+from jobs import get_job_executor
+from metrics import render_metrics, METRICS_TOKEN
+from validation import invalidate_project
+from restore import load_index, list_directory, find_file, iter_file, RestoreError
+from retention import prune_project
+from events import get_event_bus, project_topic, job_topic
+from utils import TTLCache
+from agents import (AGENT_TOKEN, AGENT_POLL_INTERVAL, AgentError, register_agent, authenticate, claim_jobs,
+                    record_progress, record_result, cancel_queued_jobs, encode_row, is_online)
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Seconds between keep-alive comments on an idle event stream
+EVENT_STREAM_HEARTBEAT = 15
+# Seconds an event stream stays open before the browser is made to reconnect,
+# so a forgotten tab does not hold a gunicorn thread forever
+EVENT_STREAM_LIFETIME = int(os.environ.get("BACKUP_EVENT_STREAM_SECONDS", "300"))
+# Event streams open at once in this process; each holds one of gunicorn's threads
+EVENT_STREAM_LIMIT = int(os.environ.get("BACKUP_EVENT_STREAMS", "4"))
+# Milliseconds EventSource waits before reconnecting, and when every stream is taken
+EVENT_STREAM_RETRY = 3000
+EVENT_STREAM_BUSY_RETRY = 15000
+event_stream_slots = threading.BoundedSemaphore(EVENT_STREAM_LIMIT)
+
+# Project list paging; sort keys map to indexed or per-user columns
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+PROJECT_SORTS = {
+    'name': BackupProject.project_name,
+    'last_backup': BackupProject.last_backup,
+    'created': BackupProject.created_at,
+    'run_time': BackupProject.run_time,
+}
+
+# Seconds a user's project count is reused between page loads
+project_counts = TTLCache(int(os.environ.get("BACKUP_COUNT_CACHE_TTL", "10")))
+
+def _agent_choices():
+    agents = BackupAgent.query.order_by(BackupAgent.name).all()
+    return [(0, 'This server')] + [(agent.id, f"Agent {agent.name} ({agent.hostname or 'unknown host'})")
+                                   for agent in agents]
+
+def _user_count():
+    return user_cache.get_or_set('user_count', lambda: User.query.count())
+
+def _invalidate_project_counts(user_id):
+    project_counts.invalidate((user_id, None), (user_id, True), (user_id, False))
+
+def _project_page(user_id, args):
+    """One page of a user's projects, each with its latest run
+    
+    args holds page, per_page, sort (see PROJECT_SORTS), order ('asc' or
+    'desc') and enabled ('true' or 'false' to filter on service_enabled).
+    Projects and their latest runs come from one query; the total is cached
+    for a few seconds per user. Returns ([(project, run or None)], paging).
+    """
+    page = max(args.get('page', 1, type=int), 1)
+    per_page = min(max(args.get('per_page', DEFAULT_PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    sort = args.get('sort', 'name')
+    if sort not in PROJECT_SORTS:
+        sort = 'name'
+    order = 'desc' if args.get('order') == 'desc' else 'asc'
+    enabled = args.get('enabled')
+    if enabled is not None:
+        enabled = enabled.lower() in ('1', 'true', 'yes', 'on')
+    
+    filters = [BackupProject.user_id == user_id]
+    if enabled is not None:
+        filters.append(BackupProject.service_enabled == enabled)
+    
+    # Newest run of each listed project, looked up per row of the page only
+    latest_run_id = select(func.max(BackupRun.id)).where(BackupRun.project_id == BackupProject.id) \
+        .correlate(BackupProject).scalar_subquery()
+    column = PROJECT_SORTS[sort]
+    rows = db.session.query(BackupProject, BackupRun) \
+        .outerjoin(BackupRun, BackupRun.id == latest_run_id) \
+        .filter(*filters) \
+        .order_by((column.desc() if order == 'desc' else column.asc()).nulls_last(), BackupProject.id) \
+        .limit(per_page).offset((page - 1) * per_page).all()
+    total = project_counts.get_or_set((user_id, enabled), lambda: BackupProject.query.filter(*filters).count())
+    paging = {'page': page, 'per_page': per_page, 'total': total, 'pages': -(-total // per_page),
+              'sort': sort, 'order': order, 'enabled': enabled}
+    return [(project, run) for project, run in rows], paging
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -41,7 +127,7 @@ def login():
         return redirect(next_page)
     
     # Check if we need to show registration form for first user
-    user_count = User.query.count()
+    user_count = _user_count()
     if user_count == 0:
         return redirect(url_for('register'))
     
@@ -50,7 +136,7 @@ def login():
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     # Only allow registration if no users exist (first time)
-    user_count = User.query.count()
+    user_count = _user_count()
     if user_count > 0 and not current_user.is_authenticated:
         flash('Registration is disabled. Please contact an administrator.', 'danger')
         return redirect(url_for('login'))
@@ -61,6 +147,7 @@ def register():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate('user_count')
         flash('Account created successfully!', 'success')
         return redirect(url_for('login'))
     
@@ -75,13 +162,23 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    projects = BackupProject.query.filter_by(user_id=current_user.id).all()
-    return render_template('dashboard.html', title='Dashboard', projects=projects)
+    rows, paging = _project_page(current_user.id, request.args)
+    projects = [project for project, _ in rows]
+    latest_runs = {project.id: run for project, run in rows if run is not None}
+    return render_template('dashboard.html', title='Dashboard', projects=projects, latest_runs=latest_runs,
+                           pagination=paging)
+
+@app.route('/api/projects')
+@login_required
+def api_projects():
+    rows, paging = _project_page(current_user.id, request.args)
+    return jsonify(dict(paging, projects=[project.to_dict(run) for project, run in rows]))
 
 @app.route('/project/create', methods=['GET', 'POST'])
 @login_required
 def create_project():
     form = BackupProjectForm()
+    form.agent_id.choices = _agent_choices()
     if form.validate_on_submit():
         project = BackupProject(
             project_name=form.project_name.data,
@@ -90,12 +187,30 @@ def create_project():
             source_path=form.source_path.data,
             destination_path=form.destination_path.data,
             run_time=form.run_time.data,
+            backup_mode=form.backup_mode.data,
+            backup_backend=form.backup_backend.data,
+            snapshot_method=form.snapshot_method.data or None,
+            hot_backup_hooks=form.hot_backup_hooks.data or None,
+            extra_destinations=form.extra_destinations.data or None,
+            encryption_key_ref=form.encryption_key_ref.data or None,
+            agent_id=form.agent_id.data or None,
+            retention_keep_last=form.retention_keep_last.data,
+            retention_daily=form.retention_daily.data,
+            retention_weekly=form.retention_weekly.data,
+            retention_monthly=form.retention_monthly.data,
+            stop_timeout=form.stop_timeout.data,
+            health_timeout=form.health_timeout.data,
+            compression_level=form.compression_level.data,
+            compression_workers=form.compression_workers.data,
+            incremental_enabled=form.incremental_enabled.data,
+            full_backup_interval=form.full_backup_interval.data,
             service_enabled=form.service_enabled.data,
             user_id=current_user.id
         )
         
         db.session.add(project)
         db.session.commit()
+        _invalidate_project_counts(current_user.id)
         
         # Create system service if enabled
         if form.service_enabled.data:
@@ -133,19 +248,48 @@ def edit_project(project_id):
         return redirect(url_for('dashboard'))
     
     form = BackupProjectForm(obj=project)
+    form.agent_id.choices = _agent_choices()
+    if request.method == 'POST':
+        # Re-check containers and path that may have changed since they were cached
+        invalidate_project(project.containers_list + list(project.hot_backup_commands), project.source_path)
     if form.validate_on_submit():
         project.project_name = form.project_name.data
         project.folder_name = form.folder_name.data
         project.container_names = form.container_names.data
         project.source_path = form.source_path.data
         project.destination_path = form.destination_path.data
+        if project.run_time != form.run_time.data or project.service_enabled != form.service_enabled.data:
+            # The scheduler only catches up on runs missed after this
+            project.schedule_changed_at = datetime.utcnow()
         project.run_time = form.run_time.data
+        project.backup_mode = form.backup_mode.data
+        project.backup_backend = form.backup_backend.data
+        project.snapshot_method = form.snapshot_method.data or None
+        project.hot_backup_hooks = form.hot_backup_hooks.data or None
+        project.extra_destinations = form.extra_destinations.data or None
+        project.encryption_key_ref = form.encryption_key_ref.data or None
+        if (form.agent_id.data or None) != project.agent_id:
+            # Jobs queued for the old agent would never run and block new ones
+            cancel_queued_jobs(db.session, project.id, "Cancelled: the project was moved to another host")
+        project.agent_id = form.agent_id.data or None
+        project.retention_keep_last = form.retention_keep_last.data
+        project.retention_daily = form.retention_daily.data
+        project.retention_weekly = form.retention_weekly.data
+        project.retention_monthly = form.retention_monthly.data
+        project.stop_timeout = form.stop_timeout.data
+        project.health_timeout = form.health_timeout.data
+        project.compression_level = form.compression_level.data
+        project.compression_workers = form.compression_workers.data
+        project.incremental_enabled = form.incremental_enabled.data
+        project.full_backup_interval = form.full_backup_interval.data
         
         # Check if service status changed
         service_changed = project.service_enabled != form.service_enabled.data
         project.service_enabled = form.service_enabled.data
         
         db.session.commit()
+        if service_changed:
+            _invalidate_project_counts(current_user.id)
         
         # Update or create service if needed
         if service_changed:
@@ -190,6 +334,7 @@ def delete_project(project_id):
     # Delete the project
     db.session.delete(project)
     db.session.commit()
+    _invalidate_project_counts(current_user.id)
     
     flash('Project deleted successfully!', 'success')
     return redirect(url_for('dashboard'))
@@ -204,18 +349,222 @@ def run_project(project_id):
         flash('You do not have permission to run this project', 'danger')
         return redirect(url_for('dashboard'))
     
-    try:
-        # Execute backup
-        if BackupService.execute_backup(project.id):
-            flash('Backup executed successfully!', 'success')
-        else:
-            flash('Backup failed. Check logs for details.', 'danger')
-    except Exception as e:
-        logger.error(f"Error running backup: {e}")
-        flash(f'Error running backup: {str(e)}', 'danger')
+    # Run the backup in the background so the request returns immediately
+    job = get_job_executor().submit(project.id)
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify(job.to_dict()), 202
     
+    flash(f'Backup job #{job.id} queued. Status: {url_for("job_status", job_id=job.id)}', 'info')
     return redirect(url_for('project_details', project_id=project.id))
 
+@app.route('/job/<int:job_id>/status')
+@login_required
+def job_status(job_id):
+    job = BackupJob.query.get_or_404(job_id)
+    
+    # Security check - only allow the project owner to see the job
+    if job.project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this job'}), 403
+    
+    return jsonify(job.to_dict())
+
+@app.route('/project/<int:project_id>/retention')
+@login_required
+def project_retention(project_id):
+    project = BackupProject.query.get_or_404(project_id)
+    
+    # Security check - only allow the project owner to see the report
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this project'}), 403
+    
+    # Dry run only: deleting is left to the low-priority `runner.py prune` job
+    runs = BackupRun.query.filter_by(project_id=project.id).all()
+    report = prune_project(project, runs, BackupService.destination_dirs(project), dry_run=True)
+    return jsonify(report)
+
+def _event_stream(topic, until_finished):
+    """Server-Sent Events response relaying the events of one topic
+    
+    Events come from the in-process bus, so nothing is polled from the
+    database. Idle streams get a comment every EVENT_STREAM_HEARTBEAT seconds,
+    which also notices clients that went away. A stream ends after
+    EVENT_STREAM_LIFETIME seconds and at most EVENT_STREAM_LIMIT are open at
+    once, so streams never take every worker thread; EventSource reconnects
+    by itself and the bus replays the latest event.
+    """
+    def generate():
+        # Taken inside the generator: it only runs (and releases) once the response is sent
+        if not event_stream_slots.acquire(blocking=False):
+            yield f"retry: {EVENT_STREAM_BUSY_RETRY}\n: too many open event streams\n\n"
+            return
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY}\n\n"
+            deadline = time.monotonic() + EVENT_STREAM_LIFETIME
+            with get_event_bus().subscribe(topic) as subscription:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    event = subscription.get(timeout=min(EVENT_STREAM_HEARTBEAT, remaining))
+                    if event is None:
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                    if until_finished and event['type'] == 'finished':
+                        return
+        finally:
+            event_stream_slots.release()
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/job/<int:job_id>/events')
+@login_required
+def job_events(job_id):
+    job = BackupJob.query.get_or_404(job_id)
+    
+    # Security check - only allow the project owner to follow the job
+    if job.project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this job'}), 403
+    
+    if job.status not in BackupJob.ACTIVE_STATUSES:
+        # Already over: send the outcome once instead of waiting for events
+        event = dict(job.to_dict(), type='finished')
+        return Response(f"event: finished\ndata: {json.dumps(event)}\n\n", mimetype='text/event-stream')
+    return _event_stream(job_topic(job.id), until_finished=True)
+
+@app.route('/project/<int:project_id>/events')
+@login_required
+def project_events(project_id):
+    project = BackupProject.query.get_or_404(project_id)
+    
+    # Security check - only allow the project owner to follow its backups
+    if project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this project'}), 403
+    
+    return _event_stream(project_topic(project.id), until_finished=False)
+
+@app.route('/run/<int:run_id>/files')
+@login_required
+def run_files(run_id):
+    run = BackupRun.query.get_or_404(run_id)
+    
+    # Security check - only allow the project owner to browse the backup
+    if run.project.user_id != current_user.id:
+        return jsonify({'error': 'You do not have permission to view this backup'}), 403
+    
+    path = request.args.get('path', '')
+    try:
+        entries = list_directory(load_index(run), path)
+    except RestoreError as e:
+        return jsonify({'error': str(e)}), 404
+    return jsonify({'run_id': run.id, 'archive': run.remote_path, 'path': path, 'entries': entries})
+
+@app.route('/run/<int:run_id>/download')
+@login_required
+def run_download(run_id):
+    run = BackupRun.query.get_or_404(run_id)
+    
+    # Security check - only allow the project owner to restore from the backup
+    if run.project.user_id != current_user.id:
+        flash('You do not have permission to restore from this backup', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    # Only the byte range of the requested file is read from the archive
+    path = request.args.get('path', '')
+    try:
+        entry = find_file(load_index(run), path)
+    except RestoreError as e:
+        return jsonify({'error': str(e)}), 404
+    filename = os.path.basename(entry['name']).replace('"', '')
+    return Response(iter_file(run, entry['name']), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Content-Length': str(entry['size'])})
+
+def _bearer_token():
+    header = request.headers.get('Authorization', '')
+    return header[len('Bearer '):] if header.startswith('Bearer ') else ''
+
+def _publish_job_event(job, event_type, agent, **extra):
+    # Agents run the engine elsewhere, so their stage changes are relayed here
+    event = {'type': event_type, 'project_id': job.project_id, 'job_id': job.id, 'stage': job.stage,
+             'agent': agent.name, **extra}
+    get_event_bus().publish([project_topic(job.project_id), job_topic(job.id)], event)
+
+@app.route('/api/agents')
+@login_required
+def list_agents():
+    agents = BackupAgent.query.order_by(BackupAgent.name).all()
+    return jsonify({'agents': [agent.to_dict(is_online(agent)) for agent in agents]})
+
+@app.route('/api/agents/register', methods=['POST'])
+def agent_register():
+    # Agents authenticate with the shared registration token once, then with their own token
+    if not AGENT_TOKEN or not hmac.compare_digest(_bearer_token(), AGENT_TOKEN):
+        return jsonify({'error': 'Agent registration is disabled or the token is wrong'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    name = str(data.get('name') or '').strip()
+    if not name or len(name) > 100:
+        return jsonify({'error': 'An agent name of at most 100 characters is required'}), 400
+    agent, token = register_agent(db.session, name, data.get('hostname'), data.get('concurrency'))
+    return jsonify({'agent': agent.to_dict(True), 'token': token})
+
+@app.route('/api/agent/claim', methods=['POST'])
+def agent_claim():
+    try:
+        agent = authenticate(db.session, _bearer_token())
+    except AgentError as e:
+        return jsonify({'error': str(e)}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        max_jobs = int(data.get('max_jobs') or 0)
+        running = [int(job_id) for job_id in data.get('running') or []]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_jobs must be a number and running a list of job ids'}), 400
+    claimed = claim_jobs(db.session, agent, max_jobs, running)
+    for job, _ in claimed:
+        _publish_job_event(job, 'stage', agent, message=f"Claimed by agent {agent.name}")
+    return jsonify({'jobs': [{'job_id': job.id, 'project': encode_row(project)} for job, project in claimed],
+                    'poll_interval': AGENT_POLL_INTERVAL})
+
+@app.route('/api/agent/jobs/<int:job_id>/progress', methods=['POST'])
+def agent_job_progress(job_id):
+    try:
+        agent = authenticate(db.session, _bearer_token())
+        data = request.get_json(silent=True) or {}
+        job = record_progress(db.session, agent, job_id, data.get('stage'), data.get('message'))
+    except AgentError as e:
+        return jsonify({'error': str(e)}), 403
+    
+    stage = data.get('stage')
+    _publish_job_event(job, 'failed' if stage == 'failed' else 'stage', agent, message=data.get('message'))
+    return jsonify(job.to_dict())
+
+@app.route('/api/agent/jobs/<int:job_id>/result', methods=['POST'])
+def agent_job_result(job_id):
+    try:
+        agent = authenticate(db.session, _bearer_token())
+        data = request.get_json(silent=True) or {}
+        job = record_result(db.session, agent, job_id, bool(data.get('success')), data.get('error'),
+                            data.get('run'), data.get('project'))
+    except AgentError as e:
+        return jsonify({'error': str(e)}), 403
+    
+    _publish_job_event(job, 'finished', agent, status=job.status, message=job.message)
+    return jsonify(job.to_dict())
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrapes with a bearer token; browsers need a login session
+    token = request.headers.get('Authorization', '')
+    authorized = METRICS_TOKEN and hmac.compare_digest(token, f'Bearer {METRICS_TOKEN}')
+    if not authorized and not current_user.is_authenticated:
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # Error handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -0,0 +1,195 @@
+"""Lean entry point for scheduled backups
+
+    python3 runner.py execute <project_id> [<project_id> ...]
+    python3 runner.py verify [<project_id> ...]
+    python3 runner.py files <run_id> [<path>]
+    python3 runner.py restore <run_id> <target_dir> <path> [<path> ...]
+    python3 runner.py prune [--dry-run] [<project_id> ...]
+
+Loads only the models and the backup engine: no Flask app, login manager or
+schema check, and a single unpooled connection instead of the web app's
+engine. Import time and the time until the first container stop are logged so
+cold-start latency can be tracked. Several project ids are backed up as one
+batch that stops their shared containers once; projects pinned to an agent
+are queued for it instead (see agent.py). verify checks the latest
+uploaded archive of each project (or of all projects) against the remote's
+size and hash listing without downloading it. files and restore browse and
+restore single files or subtrees of a recorded run through range reads.
+prune applies the projects' retention policies at low priority.
+"""
+import time
+
+_started = time.perf_counter()
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from database import DATABASE_URL
+from models import BackupProject, BackupRun
+from backup_service import BackupService
+from batch import run_batch
+from integrity import verify_runs
+from restore import load_index, list_directory, restore_paths
+from retention import prune_project, lower_priority
+from agents import queue_agent_jobs
+
+_imported = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVEL = os.environ.get("BACKUP_LOG_LEVEL", "INFO")
+
+def _progress(stage, message=None):
+    if stage == 'stop_containers':
+        logger.info(f"First container stop {time.perf_counter() - _started:.3f}s after start")
+
+def _session(engine):
+    # Not expiring on commit keeps the project loaded, so with NullPool no
+    # connection is held open while the backup itself runs
+    return Session(engine, expire_on_commit=False)
+
+def run(project_ids):
+    """Back up the given projects and return True if every backup succeeded"""
+    logger.info(f"Runner imports took {_imported - _started:.3f}s")
+    # NullPool closes each connection as soon as its transaction ends
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        # Containers of pinned projects live on their agent's host
+        with _session(engine) as session:
+            pinned = queue_agent_jobs(session, project_ids)
+        project_ids = [project_id for project_id in project_ids if project_id not in pinned]
+        if not project_ids:
+            return True
+        if len(project_ids) == 1:
+            with _session(engine) as session:
+                return BackupService.execute_backup_with_session(session, project_ids[0], progress=_progress)
+
+        with _session(engine) as session:
+            projects = session.query(BackupProject).filter(BackupProject.id.in_(project_ids)).all()
+        missing = set(project_ids) - {project.id for project in projects}
+        if missing:
+            logger.error(f"Projects not found: {sorted(missing)}")
+
+        def run_project(project_id, window):
+            with _session(engine) as session:
+                return BackupService.execute_backup_with_session(session, project_id, progress=_progress,
+                                                                 window=window)
+
+        results = run_batch(projects, run_project)
+        return not missing and all(results.values())
+    finally:
+        engine.dispose()
+
+def verify(project_ids=None):
+    """Verify the latest successful archive of the given (or every) project"""
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        with _session(engine) as session:
+            latest = session.query(func.max(BackupRun.id)) \
+                .filter(BackupRun.status == BackupRun.SUCCEEDED, BackupRun.remote_path.isnot(None))
+            if project_ids:
+                latest = latest.filter(BackupRun.project_id.in_(project_ids))
+            latest = latest.group_by(BackupRun.project_id)
+            runs = session.query(BackupRun).filter(BackupRun.id.in_(latest)).all()
+            failed = verify_runs(runs)
+            session.commit()
+        logger.info(f"Verified {len(runs)} archives, {len(failed)} failed")
+        return not failed
+    finally:
+        engine.dispose()
+
+def list_files(run_id, path=''):
+    """Print the entries of a run's archive below path"""
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        with _session(engine) as session:
+            run = session.get(BackupRun, run_id)
+        if run is None:
+            logger.error(f"Run {run_id} not found")
+            return False
+        for item in list_directory(load_index(run), path):
+            print(f"{'d' if item['is_dir'] else '-'} {item['size'] or '':>12} {item['path']}")
+        return True
+    finally:
+        engine.dispose()
+
+def restore(run_id, target_dir, paths):
+    """Restore files or subtrees of a run's archive below target_dir"""
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        with _session(engine) as session:
+            run = session.get(BackupRun, run_id)
+        if run is None:
+            logger.error(f"Run {run_id} not found")
+            return False
+        restore_paths(run, paths, target_dir)
+        return True
+    finally:
+        engine.dispose()
+
+def prune(project_ids=None, dry_run=False):
+    """Apply the retention policy of the given (or every) project
+
+    Runs at lowered priority. A dry run prints the report as JSON and
+    deletes nothing.
+    """
+    lower_priority()
+    engine = create_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        with _session(engine) as session:
+            projects = session.query(BackupProject)
+            if project_ids:
+                projects = projects.filter(BackupProject.id.in_(project_ids))
+            reports = []
+            for project in projects.all():
+                reports.append(prune_project(project, project.runs, BackupService.destination_dirs(project),
+                                             dry_run=dry_run))
+                session.commit()
+        if dry_run:
+            print(json.dumps(reports, indent=2))
+        return not any('error' in plan for report in reports for plan in report['destinations'])
+    finally:
+        engine.dispose()
+
+def main(argv):
+    logging.basicConfig(level=LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(prog="runner.py", description="Run, verify and restore backups")
+    commands = parser.add_subparsers(dest='command', required=True)
+    execute_parser = commands.add_parser('execute', help="back up projects (several run as one batch)")
+    execute_parser.add_argument('project_ids', type=int, nargs='+')
+    verify_parser = commands.add_parser('verify', help="check uploaded archives against remote hashes")
+    verify_parser.add_argument('project_ids', type=int, nargs='*')
+    files_parser = commands.add_parser('files', help="list the contents of a run's archive")
+    files_parser.add_argument('run_id', type=int)
+    files_parser.add_argument('path', nargs='?', default='')
+    restore_parser = commands.add_parser('restore', help="restore files or directories from a run")
+    restore_parser.add_argument('run_id', type=int)
+    restore_parser.add_argument('target_dir')
+    restore_parser.add_argument('paths', nargs='+')
+    prune_parser = commands.add_parser('prune', help="delete archives expired by the retention policies")
+    prune_parser.add_argument('--dry-run', action='store_true', help="report what would be deleted")
+    prune_parser.add_argument('project_ids', type=int, nargs='*')
+    args = parser.parse_args(argv)
+
+    if args.command == 'execute':
+        success = run(args.project_ids)
+    elif args.command == 'verify':
+        success = verify(args.project_ids)
+    elif args.command == 'prune':
+        success = prune(args.project_ids, args.dry_run)
+    elif args.command == 'files':
+        success = list_files(args.run_id, args.path)
+    else:
+        success = restore(args.run_id, args.target_dir, args.paths)
+    return 0 if success else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
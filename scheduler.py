@@ -0,0 +1,179 @@
+import os
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from app import app, db
+from models import BackupProject
+from jobs import get_job_executor
+from batch import group_overlapping
+
+logger = logging.getLogger(__name__)
+
+# How often the project table is re-read to pick up new and edited projects
+REFRESH_INTERVAL = int(os.environ.get("BACKUP_SCHEDULER_REFRESH", "30"))
+# Run projects that are due together and share containers as one batch, so
+# their containers are stopped and started once
+COALESCE_RUNS = os.environ.get("BACKUP_COALESCE_RUNS", "1") == "1"
+
+def parse_run_time(value):
+    """Parse an HH:MM run time into (hour, minute), or None if it is invalid"""
+    try:
+        hour, minute = (int(part) for part in value.strip().split(':')[:2])
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    return hour, minute
+
+def next_occurrence(run_time, after):
+    """First local datetime strictly after `after` at the given (hour, minute)"""
+    candidate = after.replace(hour=run_time[0], minute=run_time[1], second=0, microsecond=0)
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+def previous_occurrence(run_time, now):
+    """Latest local datetime not after `now` at the given (hour, minute)"""
+    return next_occurrence(run_time, now) - timedelta(days=1)
+
+def _utc_to_local(value):
+    # Timestamps are stored as naive UTC, run times are local wall-clock times
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+class BackupScheduler:
+    """Long-running scheduler for the run_time of every enabled project
+
+    Replaces one systemd service/timer pair per project. Upcoming runs are kept
+    in a priority queue; the project table is re-read every refresh_interval
+    seconds so edits apply without any reload. Like systemd's Persistent=true,
+    a run that was missed while the scheduler was down is started once when the
+    scheduler starts. Projects enabled or rescheduled later simply wait for
+    their next run time, and a run is never caught up if it was missed before
+    the project's schedule last changed.
+    """
+
+    def __init__(self, executor=None, refresh_interval=REFRESH_INTERVAL, coalesce=COALESCE_RUNS):
+        self.executor = executor or get_job_executor()
+        self.refresh_interval = refresh_interval
+        self.coalesce = coalesce
+        self._heap = []  # (due, project_id)
+        self._schedule = {}  # project_id -> (run_time, due)
+        self._containers = {}  # project_id -> container names
+        self._stop = threading.Event()
+        self._loaded = False  # Set once the first refresh, which catches up on missed runs, is done
+
+    def _schedule_project(self, project_id, run_time, due):
+        self._schedule[project_id] = (run_time, due)
+        heapq.heappush(self._heap, (due, project_id))
+
+    def refresh(self, now=None):
+        """Sync the queue with the enabled projects in the database"""
+        now = now or datetime.now()
+        rows = db.session.query(BackupProject.id, BackupProject.run_time,
+                                BackupProject.last_backup, BackupProject.created_at,
+                                BackupProject.schedule_changed_at, BackupProject.container_names) \
+            .filter(BackupProject.service_enabled.is_(True)).all()
+        db.session.remove()
+
+        seen = set()
+        for project_id, run_time_text, last_backup, created_at, changed_at, container_names in rows:
+            self._containers[project_id] = {name for tier in BackupProject.parse_container_tiers(container_names)
+                                            for name in tier}
+            run_time = parse_run_time(run_time_text)
+            if run_time is None:
+                logger.warning(f"Project {project_id} has an invalid run time: {run_time_text!r}")
+                continue
+            seen.add(project_id)
+            current = self._schedule.get(project_id)
+            if current and current[0] == run_time:
+                continue
+
+            # Catch up on a run missed since the last backup (Persistent=true),
+            # but only at startup: a project that appears or changes later was
+            # just enabled or edited, and backing it up now would stop its
+            # containers in the middle of the day
+            due = next_occurrence(run_time, now)
+            missed = previous_occurrence(run_time, now)
+            last_backup = _utc_to_local(last_backup)
+            changed_at = _utc_to_local(changed_at or created_at)
+            if (not self._loaded and changed_at and changed_at < missed
+                    and (last_backup is None or last_backup < missed)):
+                logger.info(f"Project {project_id} missed its run at {missed}, catching up")
+                due = now
+            self._schedule_project(project_id, run_time, due)
+
+        for project_id in set(self._schedule) - seen:
+            del self._schedule[project_id]
+            self._containers.pop(project_id, None)
+        self._loaded = True
+
+    def run_due(self, now=None):
+        """Submit every project whose run is due and queue its next run
+
+        Due projects that share containers are submitted as one batch.
+        """
+        now = now or datetime.now()
+        due_projects = []
+        while self._heap and self._heap[0][0] <= now:
+            due, project_id = heapq.heappop(self._heap)
+            entry = self._schedule.get(project_id)
+            if entry is None or entry[1] != due:
+                continue  # Stale entry for a removed or rescheduled project
+            due_projects.append(project_id)
+            self._schedule_project(project_id, entry[0], next_occurrence(entry[0], now))
+
+        if self.coalesce:
+            groups = group_overlapping({project_id: self._containers.get(project_id, ())
+                                        for project_id in due_projects})
+        else:
+            groups = [[project_id] for project_id in due_projects]
+        for group in groups:
+            self._submit(group)
+
+    def _submit(self, project_ids):
+        try:
+            if len(project_ids) == 1:
+                job = self.executor.submit(project_ids[0])
+                logger.info(f"Scheduled backup of project {project_ids[0]} started as job {job.id}")
+            else:
+                jobs = self.executor.submit_batch(project_ids)
+                logger.info(f"Scheduled batch backup of projects {sorted(project_ids)} started as jobs "
+                            f"{sorted(job.id for job in jobs.values())}")
+        except Exception as e:
+            logger.error(f"Error submitting scheduled backup for projects {project_ids}: {e}")
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+    def next_wakeup(self, now):
+        """Seconds to sleep until the next due run or refresh"""
+        wait = self.refresh_interval
+        if self._heap:
+            wait = min(wait, (self._heap[0][0] - now).total_seconds())
+        return max(wait, 0)
+
+    def run_forever(self):
+        logger.info(f"Backup scheduler started (refresh every {self.refresh_interval}s)")
+        next_refresh = datetime.now()
+        while not self._stop.is_set():
+            now = datetime.now()
+            if now >= next_refresh:
+                try:
+                    self.refresh(now)
+                except Exception as e:
+                    logger.error(f"Error refreshing backup schedule: {e}")
+                    db.session.remove()
+                next_refresh = now + timedelta(seconds=self.refresh_interval)
+            self.run_due(now)
+            self._stop.wait(self.next_wakeup(datetime.now()))
+
+    def stop(self):
+        self._stop.set()
+
+if __name__ == "__main__":
+    with app.app_context():
+        BackupScheduler().run_forever()
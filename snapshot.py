@@ -0,0 +1,84 @@
+import os
+import shutil
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import walk_tree
+
+logger = logging.getLogger(__name__)
+
+# Point-in-time copies are created here. For reflink and hardlink snapshots
+# this must be on the same filesystem as the project's source_path.
+SNAPSHOT_DIR = os.environ.get("BACKUP_SNAPSHOT_DIR", "/BkUp/.snapshots")
+
+SNAPSHOT_METHODS = ('reflink', 'hardlink', 'copy')
+
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def _reflink_copy(source_path, snapshot_path):
+    # --reflink=always fails instead of silently falling back to a full copy
+    subprocess.run(["cp", "-a", "--reflink=always", f"{source_path}/.", snapshot_path],
+                   check=True, capture_output=True)
+
+def _hardlink_copy(source_path, snapshot_path):
+    subprocess.run(["cp", "-al", f"{source_path}/.", snapshot_path], check=True, capture_output=True)
+
+def _copy_one(args):
+    source, target = args
+    shutil.copy2(source, target)
+
+def parallel_copy(source_path, snapshot_path, workers=COPY_WORKERS):
+    """Copy a tree with a pool of workers, one task per file"""
+    directories = []
+    for root, dirs, _ in os.walk(source_path):
+        for name in dirs:
+            source_dir = os.path.join(root, name)
+            target_dir = os.path.join(snapshot_path, os.path.relpath(source_dir, source_path))
+            os.makedirs(target_dir, exist_ok=True)
+            directories.append((source_dir, target_dir))
+    jobs = [(path, os.path.join(snapshot_path, os.path.relpath(path, source_path)))
+            for path in walk_tree(source_path)]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy') as executor:
+        for _ in executor.map(_copy_one, jobs):
+            pass
+    # Directory metadata last, since copying files into them changes mtimes
+    for source_dir, target_dir in directories:
+        shutil.copystat(source_dir, target_dir)
+
+def create_snapshot(source_path, name, method='reflink'):
+    """Take a point-in-time copy of source_path and return its path
+
+    reflink: copy-on-write clone (btrfs, xfs, ...), falls back to a parallel
+             copy on filesystems without reflink support
+    hardlink: hardlink tree; only safe for applications that replace files
+              instead of writing them in place
+    copy: parallel full copy
+    """
+    if method not in SNAPSHOT_METHODS:
+        raise ValueError(f"Unknown snapshot method: {method}")
+
+    snapshot_path = os.path.join(SNAPSHOT_DIR, name)
+    os.makedirs(snapshot_path)
+    try:
+        if method == 'reflink':
+            try:
+                _reflink_copy(source_path, snapshot_path)
+            except subprocess.CalledProcessError as e:
+                reason = e.stderr.decode(errors='replace').strip().split('\n')[0]
+                logger.warning(f"Reflink snapshot failed ({reason}), falling back to a parallel copy")
+                shutil.rmtree(snapshot_path)
+                os.makedirs(snapshot_path)
+                parallel_copy(source_path, snapshot_path)
+        elif method == 'hardlink':
+            _hardlink_copy(source_path, snapshot_path)
+        else:
+            parallel_copy(source_path, snapshot_path)
+    except BaseException:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        raise
+    return snapshot_path
+
+def remove_snapshot(snapshot_path):
+    """Delete a snapshot created by create_snapshot"""
+    shutil.rmtree(snapshot_path, ignore_errors=True)
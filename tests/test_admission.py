@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import admission
+from admission import AdmissionController, parse_bandwidth
+
+def _controller(tmp_path, **limits):
+    return AdmissionController(lock_dir=str(tmp_path / 'admission'), **limits)
+
+def test_parse_bandwidth():
+    assert parse_bandwidth("40M") == 40 * 1024 * 1024
+    assert parse_bandwidth("512") == 512 * 1024
+    assert parse_bandwidth("") is None
+
+def test_limits_are_shared_between_controllers(tmp_path):
+    # Two controllers on one lock directory stand for two runner.py processes
+    first = _controller(tmp_path, max_archive_jobs=1)
+    second = _controller(tmp_path, max_archive_jobs=1)
+    held = first.acquire(archive=True)
+    admitted = threading.Event()
+
+    def acquire():
+        second.release(second.acquire(archive=True))
+        admitted.set()
+
+    threading.Thread(target=acquire, daemon=True).start()
+    assert not admitted.wait(1.5)
+    first.release(held)
+    assert admitted.wait(5)
+
+def test_limits_are_shared_with_other_processes(tmp_path):
+    lock_dir = str(tmp_path / 'admission')
+    holder = subprocess.Popen(
+        [sys.executable, '-c',
+         "import sys, time; from admission import AdmissionController as C; "
+         f"held = C(max_uploads=1, lock_dir={lock_dir!r}).acquire(upload=True); print('held', flush=True); time.sleep(2)"],
+        stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(admission.__file__)))
+    try:
+        assert holder.stdout.readline().strip() == 'held'
+        started = time.monotonic()
+        _controller(tmp_path, max_uploads=1).acquire(upload=True)
+        assert time.monotonic() - started > 0.5
+    finally:
+        holder.wait()
+
+def test_a_failed_acquire_holds_nothing(tmp_path):
+    controller = _controller(tmp_path, max_archive_jobs=2, max_jobs_per_disk=1)
+    held = controller.acquire(paths=[str(tmp_path)])
+    assert controller._try_acquire(True, False, held.devices) is None
+    slots = controller._try_acquire(True, False, set())
+    assert slots is not None and len(slots) == 1
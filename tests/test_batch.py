@@ -0,0 +1,50 @@
+import threading
+from types import SimpleNamespace
+
+from admission import AdmissionController
+from batch import ContainerWindow
+
+def _project(project_id, containers):
+    return SimpleNamespace(id=project_id, stop_tiers=[containers], stop_timeout=None, health_timeout=None)
+
+def _admit_all(window, controller, members, tmp_path):
+    shares = {}
+
+    def admit(project_id, upload):
+        shares[project_id] = window.admit(project_id, controller, [str(tmp_path)], upload=upload)
+
+    threads = [threading.Thread(target=admit, args=member, daemon=True) for member in members]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    return shares
+
+def test_batch_is_admitted_as_a_whole(tmp_path):
+    # Per-process limits smaller than the batch must not serialize it
+    controller = AdmissionController(max_archive_jobs=1, max_uploads=1, max_jobs_per_disk=1,
+                                     upload_bwlimit="30M", lock_dir=str(tmp_path / 'admission'))
+    window = ContainerWindow([_project(1, ['a']), _project(2, ['a']), _project(3, ['a', 'b'])])
+    shares = _admit_all(window, controller, [(1, True), (2, True), (3, False)], tmp_path)
+
+    assert controller._try_acquire(True, False, set()) is None
+    assert controller._try_acquire(False, True, set()) is None
+    assert shares[1].bwlimit == shares[2].bwlimit == "15360K"
+    assert shares[3].bwlimit is None
+
+    for project_id in (1, 2):
+        window.leave_admission(project_id)
+    assert controller._try_acquire(True, False, set()) is None
+    window.leave_admission(3)
+    window.leave_admission(3)
+    assert controller._try_acquire(True, True, {tmp_path.stat().st_dev}) is not None
+
+def test_member_leaving_before_admission_does_not_block(tmp_path):
+    controller = AdmissionController(max_archive_jobs=1, lock_dir=str(tmp_path / 'admission'))
+    window = ContainerWindow([_project(1, ['a']), _project(2, ['a'])])
+    window.release(2, None)  # e.g. project 2 failed its preflight check
+    shares = _admit_all(window, controller, [(1, False)], tmp_path)
+    assert set(shares) == {1}
+    window.leave_admission(1)
+    assert controller._try_acquire(True, False, set()) is not None
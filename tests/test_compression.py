@@ -0,0 +1,29 @@
+import io
+import struct
+import time
+import zipfile
+
+from compression import ParallelZipWriter, ZipEntry, ZIP_STORED
+
+def test_archive_round_trip(tmp_path):
+    path = tmp_path / 'data.txt'
+    path.write_bytes(b'line\n' * 100000)
+    out = io.BytesIO()
+    with ParallelZipWriter(out, workers=2, block_size=64 * 1024) as writer:
+        writer.add_file(str(path), 'data.txt')
+        writer.writestr('note.txt', 'hello')
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as archive:
+        assert archive.read('data.txt') == path.read_bytes()
+        assert archive.read('note.txt') == b'hello'
+
+def test_entry_that_grew_past_the_limit_gets_zip64_sizes():
+    # add_file picks the header from st_size; a live file can outgrow it while being read
+    writer = ParallelZipWriter(io.BytesIO(), workers=1)
+    entry = ZipEntry('grown.log', 0o100644, time.time(), ZIP_STORED)
+    entry.file_size = entry.compress_size = 5 << 30
+    writer._write_data_descriptor(entry)
+    writer.close()
+    descriptor = writer.fileobj.getvalue()[:24]
+    assert struct.unpack('<IIQQ', descriptor)[2:] == (5 << 30, 5 << 30)
+    record = writer._central_directory_record(entry)
+    assert struct.unpack_from('<H', record, 6)[0] == 45
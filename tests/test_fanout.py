@@ -0,0 +1,73 @@
+import os
+import stat
+import threading
+
+import pytest
+
+import fanout
+from fanout import DestinationFailed, FanoutWriter, SpillBuffer
+
+@pytest.fixture
+def fake_rclone(tmp_path, monkeypatch):
+    """An `rclone` on PATH that reads stdin until EOF, like a slow rcat"""
+    path = tmp_path / 'rclone'
+    path.write_text("#!/bin/sh\ncat > /dev/null\n")
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    return path
+
+def _finishes(target, timeout=10):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def test_fail_wakes_a_waiting_reader():
+    buffer = SpillBuffer()
+    errors = []
+
+    def read():
+        try:
+            buffer.read()
+        except DestinationFailed as e:
+            errors.append(str(e))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    buffer.fail("aborted")
+    reader.join(10)
+    assert not reader.is_alive()
+    assert errors == ["aborted"]
+
+def test_abort_with_pump_running(fake_rclone):
+    writer = FanoutWriter(['bench:x/a.zip'])
+    writer.write(b'x' * 1000)
+    assert _finishes(writer.abort)
+    assert all(destination.error for destination in writer.destinations)
+
+def test_abort_after_a_failed_source(fake_rclone, tmp_path, monkeypatch):
+    def broken_archive(source_path, out, **kwargs):
+        out.write(b'x' * 1000)
+        raise OSError("exec stream failed")
+
+    import backup_service
+    monkeypatch.setattr(backup_service, 'write_archive', broken_archive)
+    monkeypatch.setattr(backup_service, 'TEMP_DIR', str(tmp_path))
+    errors = []
+
+    def stream():
+        try:
+            backup_service.BackupService.stream_archive(str(tmp_path), ['bench:x/a.zip', 'bench:y/a.zip'])
+        except OSError as e:
+            errors.append(str(e))
+
+    assert _finishes(stream)
+    assert errors == ["exec stream failed"]
+
+def test_close_delivers_everything(fake_rclone):
+    writer = FanoutWriter(['bench:x/a.zip', 'bench:y/a.zip'])
+    for _ in range(10):
+        writer.write(b'x' * fanout.READ_SIZE)
+    destinations = writer.close()
+    assert [d.bytes for d in destinations] == [10 * fanout.READ_SIZE] * 2
+    assert all(d.ok for d in destinations)
@@ -0,0 +1,80 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+import backup_service
+import retention
+from admission import AdmissionController
+from backup_service import BackupService
+from capacity import STAGED
+from database import db
+from fanout import Destination
+from models import BackupProject, BackupRun
+from retention import prune_project
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'backup.db'}")
+    db.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def project(engine, tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'data.txt').write_text('data')
+    with Session(engine) as session:
+        project = BackupProject(project_name='app', folder_name='app', container_names='app',
+                                source_path=str(source), destination_path='gdrive:backups', run_time='02:00',
+                                retention_keep_last=1, user_id=1)
+        session.add(project)
+        session.commit()
+        return project.id
+
+@pytest.fixture
+def offline_backup(monkeypatch, tmp_path):
+    """Run _run_backup without Docker, rclone or a capacity check"""
+    staging = tmp_path / 'staging'
+    staging.mkdir()
+    controller = AdmissionController(lock_dir=str(tmp_path / 'admission'))
+    plan = SimpleNamespace(mode=STAGED, to_dict=lambda: {'mode': STAGED})
+    monkeypatch.setattr(backup_service, 'TEMP_DIR', str(staging))
+    monkeypatch.setattr(backup_service, 'preflight_check', lambda project: None)
+    monkeypatch.setattr(backup_service, 'plan_capacity', lambda *args, **kwargs: plan)
+    monkeypatch.setattr(backup_service, 'get_admission_controller', lambda: controller)
+    monkeypatch.setattr(backup_service, 'remote_hash_type', lambda remote_dir: None)
+    monkeypatch.setattr(backup_service, 'upload_to_all',
+                        lambda path, dirs, *args: [Destination(f"{d}/{os.path.basename(path)}") for d in dirs])
+    for name in ('_stop_containers', '_start_containers', '_record_archive', '_upload_index'):
+        monkeypatch.setattr(BackupService, name, staticmethod(lambda *args, **kwargs: None))
+
+def test_prune_during_a_backup_keeps_its_archive(engine, project, offline_backup, monkeypatch):
+    reports = []
+
+    def write_archive(source_path, out, **kwargs):
+        # A manual run that finished in the meantime left a newer archive
+        running = os.path.basename(out.name)
+        listing = {running: (0, None), 'app_Backup_2099-01-01_00-00-00.zip': (10, None)}
+        monkeypatch.setattr(retention, 'list_remote_hashes', lambda remote_dir: listing)
+        # The prune job runs in its own process with its own session
+        with Session(engine) as session:
+            pruned = session.get(BackupProject, project)
+            reports.append((running, prune_project(pruned, pruned.runs, ['gdrive:backups'], dry_run=True)))
+        out.write(b'archive')
+        return {'bytes_read': 4, 'bytes_written': 7}
+
+    monkeypatch.setattr(backup_service, 'write_archive', write_archive)
+    with Session(engine, expire_on_commit=False) as session:
+        assert BackupService.execute_backup_with_session(session, project)
+
+    (running, report), = reports
+    plan, = report['destinations']
+    assert [archive['name'] for archive in plan['delete']] == []
+    assert {archive['name']: archive['reasons'] for archive in plan['keep']}[running] == ['running']
+    with Session(engine) as session:
+        run = session.query(BackupRun).one()
+        assert f"{run.archive_name}.zip" == running and run.status == BackupRun.SUCCEEDED
@@ -1,15 +1,24 @@
 import os
 import subprocess
+import time
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
+from rclone_rc import get_rclone, RcloneRCError
+
 logger = logging.getLogger(__name__)
 
 def check_rclone_config():
     """Check if rclone is configured with a Google Drive remote named 'gdrive'"""
     try:
-        result = subprocess.run(["rclone", "listremotes"], capture_output=True, text=True, check=True)
-        remotes = result.stdout.strip().split('\n')
+        rclone = get_rclone()
+        if rclone is not None:
+            remotes = rclone.list_remotes()
+        else:
+            result = subprocess.run(["rclone", "listremotes"], capture_output=True, text=True, check=True)
+            remotes = result.stdout.strip().split('\n')
         
         # Check for gdrive: remote
         if 'gdrive:' in remotes:
@@ -17,7 +26,7 @@ def check_rclone_config():
         else:
             logger.warning("Google Drive remote 'gdrive:' not found in rclone configuration")
             return False
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, RcloneRCError, OSError) as e:
         logger.error(f"Error checking rclone configuration: {e}")
         return False
 
@@ -36,10 +45,9 @@ def setup_rclone():
 
 def validate_docker_container(container_name):
     """Check if a Docker container exists"""
+    from validation import check_containers
     try:
-        result = subprocess.run(["docker", "inspect", container_name], 
-                                capture_output=True, text=True, check=False)
-        return result.returncode == 0
+        return check_containers([container_name])[container_name] is not None
     except Exception as e:
         logger.error(f"Error validating Docker container: {e}")
         return False
@@ -60,10 +68,98 @@ def format_datetime(dt):
 
 def get_system_info():
     """Get system information for diagnostics"""
-    info = {
-        "python_version": subprocess.run(["python3", "--version"], capture_output=True, text=True).stdout.strip(),
-        "rclone_version": subprocess.run(["rclone", "version"], capture_output=True, text=True).stdout.split('\n')[0],
-        "docker_version": subprocess.run(["docker", "--version"], capture_output=True, text=True).stdout.strip(),
-        "zip_version": subprocess.run(["zip", "--version"], capture_output=True, text=True).stdout.split('\n')[0]
-    }
-    return info
+    from validation import get_system_info as cached_system_info
+    return cached_system_info()
+
+class StageTimer:
+    """Wall-clock timings of the stages of one backup run, including container downtime
+    
+    on_stage, if given, is called with the stage name whenever a stage begins.
+    """
+    
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.started = time.monotonic()
+        self.stages = {}
+        self.stage_times = {}  # stage name -> [first start, last end] as UTC datetimes
+        self.downtime = 0.0
+        self.containers_stopped = False  # This run stopped (or began stopping) containers
+        self.containers_restarted = False
+        self._down_since = None
+    
+    @contextmanager
+    def stage(self, name):
+        """Time a block of work under the given stage name"""
+        if self.on_stage is not None:
+            self.on_stage(name)
+        started = time.monotonic()
+        times = self.stage_times.setdefault(name, [datetime.utcnow(), None])
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - started
+            times[1] = datetime.utcnow()
+    
+    def containers_down(self):
+        """Mark the moment the first container is being stopped"""
+        if self._down_since is None:
+            self._down_since = time.monotonic()
+        self.containers_stopped = True
+    
+    def containers_up(self):
+        """Mark the moment all containers are running again"""
+        if self._down_since is not None:
+            self.downtime += time.monotonic() - self._down_since
+            self._down_since = None
+        self.containers_restarted = True
+    
+    @property
+    def total(self):
+        return time.monotonic() - self.started
+    
+    def summary(self):
+        """Human readable one-line summary for the logs"""
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.stages.items())
+        return f"total {self.total:.1f}s, container downtime {self.downtime:.1f}s ({stages})"
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after ttl seconds"""
+    
+    _MISSING = object()
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+    
+    def get_or_set(self, key, compute):
+        """Return the cached value for key, computing and caching it if needed"""
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+    
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
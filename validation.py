@@ -0,0 +1,142 @@
+import os
+import sys
+import logging
+import subprocess
+
+from docker_client import get_docker_client
+from utils import TTLCache
+from encryption import load_key, EncryptionError
+
+logger = logging.getLogger(__name__)
+
+# Seconds a container or path check stays valid
+VALIDATION_TTL = int(os.environ.get("BACKUP_VALIDATION_TTL", "60"))
+
+_containers = TTLCache(VALIDATION_TTL)
+_paths = TTLCache(VALIDATION_TTL)
+# Tool versions only change on upgrades
+_versions = TTLCache(int(os.environ.get("BACKUP_VERSION_CACHE_TTL", "3600")))
+
+def check_containers(names):
+    """Return {name: container summary or None} for the given container names
+
+    Names that are not cached are looked up together in a single list call
+    against the Docker API instead of one `docker inspect` per container.
+    """
+    results = {}
+    missing = []
+    for name in names:
+        cached = _containers.get(name, TTLCache._MISSING)
+        if cached is TTLCache._MISSING:
+            missing.append(name)
+        else:
+            results[name] = cached
+
+    if missing:
+        found = {}
+        for container in get_docker_client().list_containers(names=missing):
+            for container_name in container.get('Names', []):
+                found[container_name.lstrip('/')] = container
+        for name in missing:
+            results[name] = found.get(name)
+            _containers.set(name, results[name])
+    return results
+
+def check_directory(path):
+    """Return None if path is a readable directory, else a description of the problem"""
+    def compute():
+        if not os.path.exists(path):
+            return f"Source path {path} does not exist"
+        if not os.path.isdir(path):
+            return f"Source path {path} is not a directory"
+        if not os.access(path, os.R_OK | os.X_OK):
+            return f"Source path {path} is not readable"
+        return None
+    return _paths.get_or_set(path, compute)
+
+def validate_project(container_names, source_path, running_containers=()):
+    """Check a project's containers and source path together
+
+    running_containers must also exist and be running (containers backed up
+    through a hot-backup hook). Returns {field: problem} for the
+    'container_names', 'hot_backup_hooks' and 'source_path' fields that
+    failed, empty if the project is ready to back up.
+    """
+    problems = {}
+    running_containers = list(running_containers)
+    names = list(dict.fromkeys(list(container_names) + running_containers))
+    if names:
+        try:
+            containers = check_containers(names)
+        except Exception as e:
+            logger.error(f"Error validating Docker containers: {e}")
+            problems['container_names'] = f"Could not reach Docker to check containers: {e}"
+        else:
+            unknown = [name for name in container_names if containers[name] is None]
+            if unknown:
+                problems['container_names'] = f"Unknown containers: {', '.join(unknown)}"
+            not_running = [name for name in running_containers
+                           if (containers[name] or {}).get('State') != 'running']
+            if not_running:
+                problems['hot_backup_hooks'] = f"Containers not running: {', '.join(not_running)}"
+    path_problem = check_directory(source_path)
+    if path_problem:
+        problems['source_path'] = path_problem
+    return problems
+
+def preflight_check(project):
+    """Validate a project before its containers are stopped
+
+    Raises ValueError describing every problem found.
+    """
+    problems = validate_project(project.containers_list, project.source_path,
+                                running_containers=project.hot_backup_commands)
+    if project.hot_backup_commands and project.backup_backend == 'dedup':
+        problems['hot_backup_hooks'] = "Hot-backup hooks need the zip archive storage"
+    if project.encryption_key_ref:
+        if project.backup_backend == 'dedup':
+            problems['encryption_key_ref'] = "Encryption needs the zip archive storage"
+        else:
+            try:
+                load_key(project.encryption_key_ref)
+            except EncryptionError as e:
+                problems['encryption_key_ref'] = f"Encryption key unavailable: {e}"
+    if problems:
+        raise ValueError(f"Pre-flight check failed: {'; '.join(problems.values())}")
+
+def invalidate_project(container_names=(), source_path=None):
+    """Drop cached results for a project's containers and source path after an edit"""
+    _containers.invalidate(*container_names)
+    if source_path:
+        _paths.invalidate(source_path)
+
+def _first_line(command):
+    try:
+        return subprocess.run(command, capture_output=True, text=True).stdout.split('\n')[0].strip()
+    except OSError as e:
+        return f"unavailable ({e})"
+
+def _docker_version():
+    try:
+        return f"Docker version {get_docker_client().version().get('Version')}"
+    except Exception as e:
+        return f"unavailable ({e})"
+
+def _rclone_version():
+    from rclone_rc import get_rclone
+    try:
+        client = get_rclone()
+        if client is not None:
+            return f"rclone {client.call('core/version').get('version')}"
+    except Exception as e:
+        logger.warning(f"Could not get rclone version over rc: {e}")
+    return _first_line(["rclone", "version"])
+
+def get_system_info():
+    """Versions of the tools backups depend on, cached so diagnostics don't spawn processes every call"""
+    return {
+        "python_version": f"Python {sys.version.split()[0]}",
+        "rclone_version": _versions.get_or_set('rclone', _rclone_version),
+        "docker_version": _versions.get_or_set('docker', _docker_version),
+        "zip_version": _versions.get_or_set('zip', lambda: _first_line(["zip", "--version"])),
+    }